@@ -1,7 +1,8 @@
 import inspect
 import logging
 import sys
-from dbbackup import config
+from dbbackup import config, encryption, storage
+from dbbackup.callbacks.prometheus import PrometheusPushGatewayCallback
 from dbbackup.providers import AbstractProvider
 from dbbackup.providers.mysql import MySQL
 from dbbackup.providers.postgres import Postgres
@@ -44,6 +45,72 @@ class ProviderClassNotFoundError(Exception):
     pass
 
 
+def get_checksum_algorithm():
+    if config.CHECKSUM_ALGORITHM == "none":
+        return None
+    return config.CHECKSUM_ALGORITHM
+
+
+def get_storage():
+    """
+    Returns the S3 storage of the backups (or of their copies with S3_COPY),
+    or None if there is none.
+    """
+    if not config.S3_BUCKET:
+        return None
+    return storage.S3Storage(
+        config.S3_BUCKET,
+        prefix=config.S3_PREFIX,
+        endpoint_url=config.S3_ENDPOINT_URL or None,
+        part_size=config.S3_PART_SIZE,
+        upload_workers=config.S3_UPLOAD_WORKERS,
+        download_workers=config.S3_DOWNLOAD_WORKERS)
+
+
+def get_encryption():
+    """
+    Returns the encryption.Encryption of the backups, or None if they are
+    not encrypted.
+    """
+    if not (config.ENCRYPTION_KEY or config.ENCRYPTION_KEY_FILE):
+        return None
+    return encryption.Encryption(
+        encryption.load_key(key=config.ENCRYPTION_KEY or None,
+                            key_file=config.ENCRYPTION_KEY_FILE or None),
+        cipher=config.ENCRYPTION_CIPHER,
+        workers=config.ENCRYPTION_WORKERS)
+
+
+def get_copies():
+    """
+    Returns the storages getting a copy of the backups.
+    """
+    copies = []
+    if config.COPY_DIRECTORIES:
+        copies += [
+            storage.LocalStorage(directory)
+            for directory in config.COPY_DIRECTORIES.split(",")
+        ]
+    if config.S3_BUCKET and config.S3_COPY:
+        copies.append(get_storage())
+    return copies
+
+
+def get_callbacks():
+    """
+    Returns the callbacks notified of the backups.
+    """
+    callbacks = []
+    if config.PROMETHEUS_PUSHGATEWAY_URL:
+        callbacks.append(
+            PrometheusPushGatewayCallback(
+                config.PROMETHEUS_PUSHGATEWAY_URL,
+                suffix=config.BACKUP_SUFFIX or None,
+                timeout=config.PROMETHEUS_PUSHGATEWAY_TIMEOUT,
+                retries=config.PROMETHEUS_PUSHGATEWAY_RETRIES))
+    return callbacks
+
+
 class MySQLConfigBuilder:
     """
     Builds a mysql provider instance from the app config values
@@ -59,7 +126,15 @@ class MySQLConfigBuilder:
             or False
         kwargs = {
             "mysql_bin_directory": config.MYSQL_BIN_DIRECTORY,
-            "compress": config.MYSQL_COMPRESS
+            "compress": config.MYSQL_COMPRESSION or config.MYSQL_COMPRESS,
+            "dump_jobs": config.MYSQL_DUMP_JOBS,
+            "compress_workers": config.COMPRESS_WORKERS,
+            "compress_block_size": config.COMPRESS_BLOCK_SIZE,
+            "compress_seekable": config.COMPRESS_SEEKABLE,
+            "checksum": get_checksum_algorithm(),
+            "dedup": config.DEDUP,
+            "skip_unchanged": config.SKIP_UNCHANGED,
+            "table_index": config.TABLE_INDEX
         }
         if config.MYSQL_HOST:
             kwargs["host"] = config.MYSQL_HOST
@@ -71,7 +146,19 @@ class MySQLConfigBuilder:
             kwargs["exclude_databases"] = exclude_databases
         if config.BACKUP_SUFFIX:
             kwargs["backup_suffix"] = config.BACKUP_SUFFIX
+        if config.TEMP_DIRECTORY:
+            kwargs["temp_directory"] = config.TEMP_DIRECTORY
+        if config.COMPRESSION_LEVEL:
+            kwargs["compress_level"] = int(config.COMPRESSION_LEVEL)
+        if config.S3_BUCKET and not config.S3_COPY:
+            kwargs["storage"] = get_storage()
+        if config.COPY_DIRECTORIES or config.S3_COPY:
+            kwargs["copies"] = get_copies()
+        if config.ENCRYPTION_KEY or config.ENCRYPTION_KEY_FILE:
+            kwargs["encryption"] = get_encryption()
         instance = MySQL(config.BACKUP_DIRECTORY, **kwargs)
+        for callback in get_callbacks():
+            instance.register_callback(callback)
         self._instance = instance
         return instance
 
@@ -89,13 +176,37 @@ class PostgresConfigBuilder:
         exclude_databases = config.EXCLUDE_DATABASES \
             and config.EXCLUDE_DATABASES.split(",") \
             or False
-        kwargs = {"psql_bin_directory": config.PG_BIN_DIRECTORY}
+        kwargs = {
+            "psql_bin_directory": config.PG_BIN_DIRECTORY,
+            "compress": config.PG_COMPRESSION or config.PG_COMPRESS,
+            "dump_jobs": config.PG_DUMP_JOBS,
+            "pack_directory": config.PG_PACK_DIRECTORY,
+            "compress_workers": config.COMPRESS_WORKERS,
+            "compress_block_size": config.COMPRESS_BLOCK_SIZE,
+            "compress_seekable": config.COMPRESS_SEEKABLE,
+            "checksum": get_checksum_algorithm(),
+            "dedup": config.DEDUP,
+            "skip_unchanged": config.SKIP_UNCHANGED,
+            "table_index": config.TABLE_INDEX
+        }
         if config.PG_BACKUP_TYPE:
             kwargs["backup_type"] = config.PG_BACKUP_TYPE
         if exclude_databases:
             kwargs["exclude_databases"] = exclude_databases
         if config.BACKUP_SUFFIX:
             kwargs["backup_suffix"] = config.BACKUP_SUFFIX
+        if config.TEMP_DIRECTORY:
+            kwargs["temp_directory"] = config.TEMP_DIRECTORY
+        if config.COMPRESSION_LEVEL:
+            kwargs["compress_level"] = int(config.COMPRESSION_LEVEL)
+        if config.S3_BUCKET and not config.S3_COPY:
+            kwargs["storage"] = get_storage()
+        if config.COPY_DIRECTORIES or config.S3_COPY:
+            kwargs["copies"] = get_copies()
+        if config.ENCRYPTION_KEY or config.ENCRYPTION_KEY_FILE:
+            kwargs["encryption"] = get_encryption()
         instance = Postgres(config.BACKUP_DIRECTORY, **kwargs)
+        for callback in get_callbacks():
+            instance.register_callback(callback)
         self._instance = instance
         return instance
@@ -1,27 +1,151 @@
+import atexit
+import logging
 import socket
-from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
+import threading
+import time
+import weakref
+from prometheus_client import CollectorRegistry, Gauge, pushadd_to_gateway
+
+_logger = logging.getLogger(__name__)
+JOB = "dbbackup"
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 3
+# Delay before the first retry, doubled for each of the next ones
+RETRY_DELAY = 1
+# The callbacks whose pushes the exit waits for
+_callbacks = weakref.WeakSet()
+
+
+@atexit.register
+def _wait_for_pushes():
+    for callback in list(_callbacks):
+        callback.wait()
 
 
 class PrometheusPushGatewayCallback:
-    def __init__(self, address):
+    """
+    Pushes the metrics of the backups to the Pushgateway at address.
+    The backups are collected in memory, and pushed once all of them are
+    done, to the dbbackup job, in a group per database (and suffix), so
+    that each database keeps its metrics until it is backed up again (the
+    Pushgateway replaces the metrics of a whole group, a single group for
+    the run would lose those of the databases not backed up by it). That
+    is one request per database.
+    A failed backup only updates dbbackup_last_backup_success, the time and
+    size of the last successful backup are kept.
+    The pushes run in a background thread, with timeout seconds per request
+    and up to retries retries, so a slow or unavailable gateway never holds
+    up the backups; the exit waits for all of them (see wait).
+    """
+
+    def __init__(self,
+                 address,
+                 suffix=None,
+                 timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES):
         self.address = address
+        self.suffix = suffix
+        self.timeout = timeout
+        self.retries = retries
+        self._backups = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pending = 0
+        _callbacks.add(self)
+
+    def backup_done(self, date_iso, database, filename, size, checksum=None):
+        with self._lock:
+            self._backups[database] = (time.time(), size)
 
-    def backup_done(self, date_iso, database, filename, size):
+    def backups_done(self, results):
+        """
+        Pushes the backups collected since the previous push, and whether
+        the backup of each database of results (providers.BackupResult)
+        succeeded.
+        """
+        with self._lock:
+            backups, self._backups = self._backups, {}
+        registries = [(result.database,
+                       self.get_registry(not result.error,
+                                         backups.get(result.database)))
+                      for result in results]
+        self.wait()
+        self._pending = len(registries)
+        self._thread = threading.Thread(target=self.push_all,
+                                        args=(registries, ),
+                                        name="prometheus-push",
+                                        daemon=True)
+        self._thread.start()
+
+    def get_registry(self, success, backup=None):
+        """
+        Returns the metrics of the backup of a database: whether it
+        succeeded, and its (timestamp, size) if it did.
+        """
         registry = CollectorRegistry()
-        g = Gauge(
-            'dbbackup_last_success_timestamp',
-            'Last time a batch job successfully finished',
-            registry=registry)
-        g.set_to_current_time()
-        g2 = Gauge(
-            'dbbackup_last_backup_file_size',
-            'Last backup file size',
-            registry=registry)
-        g2.set(size)
-        push_to_gateway(
-            self.address,
-            job=f'{self.get_hostname()}-{database}',
-            registry=registry)
+        Gauge('dbbackup_last_backup_success',
+              'Whether the last backup succeeded',
+              registry=registry).set(1 if success else 0)
+        if success and backup:
+            finished, size = backup
+            Gauge('dbbackup_last_success_timestamp',
+                  'Last time a backup successfully finished',
+                  registry=registry).set(finished)
+            Gauge('dbbackup_last_backup_file_size',
+                  'Last backup file size',
+                  registry=registry).set(size or 0)
+        return registry
+
+    def get_grouping_key(self, database):
+        grouping_key = {'instance': self.get_hostname(), 'database': database}
+        if self.suffix:
+            grouping_key['suffix'] = self.suffix
+        return grouping_key
+
+    def push_all(self, registries):
+        for database, registry in registries:
+            self.push(database, registry)
+
+    def push(self, database, registry):
+        """
+        Pushes registry to the group of database, replacing only the metrics
+        it has.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                pushadd_to_gateway(
+                    self.address,
+                    job=JOB,
+                    registry=registry,
+                    grouping_key=self.get_grouping_key(database),
+                    timeout=self.timeout)
+                _logger.debug(
+                    f"Pushed the metrics of {database} to {self.address}")
+                return
+            except Exception as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(RETRY_DELAY * 2**attempt)
+        _logger.warning(f"Could not push the metrics of {database} to "
+                        f"{self.address}: {error}")
+
+    def wait(self, timeout=None):
+        """
+        Waits for the pushes in progress, at most timeout seconds (by
+        default, as long as all the attempts of all the pushes can take).
+        """
+        if not self._thread:
+            return
+        if timeout is None:
+            timeout = self._pending * (
+                (self.retries + 1) * self.timeout +
+                RETRY_DELAY * (2**self.retries - 1))
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            _logger.warning(
+                f"Gave up waiting for the push of the metrics to "
+                f"{self.address}")
+        self._thread = None
 
     def get_hostname(self):
         return socket.gethostname()
@@ -0,0 +1,151 @@
+import collections
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+_logger = logging.getLogger(__name__)
+CATALOG_FILENAME = ".dbbackup-catalog.db"
+SCHEMA_VERSION = 1
+# The journal is kept in rollback mode (not WAL), which is not supported
+# on network filesystems such as NFS.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    filename TEXT PRIMARY KEY,
+    database TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    suffix TEXT NOT NULL,
+    format TEXT NOT NULL,
+    codec TEXT,
+    size INTEGER,
+    checksum TEXT,
+    duration REAL,
+    mtime REAL NOT NULL,
+    marker TEXT
+);
+CREATE INDEX IF NOT EXISTS backups_format ON backups (format, filename);
+CREATE INDEX IF NOT EXISTS backups_database ON backups (database, timestamp);
+CREATE INDEX IF NOT EXISTS backups_mtime ON backups (mtime);
+"""
+
+# marker identifies the state of the database when it was backuped
+# (see AbstractProvider.get_change_marker)
+BackupEntry = collections.namedtuple("BackupEntry", [
+    "filename", "database", "timestamp", "suffix", "format", "codec", "size",
+    "checksum", "duration", "mtime", "marker"
+],
+                                     defaults=(None, ))
+
+
+class Catalog:
+    """
+    Index of the backups of a directory, stored in an SQLite database inside
+    the directory, so that listing and cleaning up the backups doesn't need
+    to list and stat every file.
+    The catalog is updated whenever a backup is written or removed, and can
+    be rebuilt from the directory with replace (see the reindex command).
+    created is True if the catalog did not exist before.
+    Can be used from several threads.
+    """
+
+    def __init__(self, directory, filename=CATALOG_FILENAME):
+        self.path = Path(directory) / filename
+        self.created = not self.path.exists()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            str(self.path), timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(SCHEMA)
+            self._connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        if self.created:
+            _logger.debug(f"Created backup catalog {self.path}")
+
+    def add(self, entry):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO backups "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                entry)
+
+    def remove(self, filename):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM backups WHERE filename = ?",
+                                     (filename, ))
+
+    def get(self, filename):
+        """
+        Returns the BackupEntry of filename, or None if it is not indexed.
+        """
+        entries = self._select("WHERE filename = ?", (filename, ))
+        return entries[0] if entries else None
+
+    def find(self,
+             formats=None,
+             suffix=None,
+             database=None,
+             modified_before=None):
+        """
+        Returns the BackupEntry of the backups matching all the given
+        criteria, most recent (by filename) first.
+        Like the backup file names, suffix matches anywhere in the filename.
+        modified_before is a timestamp, the backups modified at this time
+        are included.
+        """
+        clauses = []
+        parameters = []
+        if formats:
+            clauses.append(
+                f"format IN ({', '.join('?' for _ in formats)})")
+            parameters += formats
+        if suffix:
+            clauses.append("instr(filename, ?) > 0")
+            parameters.append(suffix)
+        if database:
+            clauses.append("database = ?")
+            parameters.append(database)
+        if modified_before is not None:
+            clauses.append("mtime <= ?")
+            parameters.append(modified_before)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return self._select(f"{where} ORDER BY filename DESC", parameters)
+
+    def replace(self, entries, formats=None):
+        """
+        Replace the entries (of the given formats, or all of them) by entries,
+        in a single transaction.
+        The checksum, duration, marker and mtime of the backups already
+        indexed are kept, as they can't be recomputed from the directory
+        listing (linked backups share the modification time of their file).
+        """
+        known = {
+            entry.filename: entry
+            for entry in self.find(formats=formats)
+        }
+        entries = [
+            entry._replace(
+                checksum=entry.checksum or known[entry.filename].checksum,
+                duration=entry.duration or known[entry.filename].duration,
+                marker=entry.marker or known[entry.filename].marker,
+                mtime=known[entry.filename].mtime)
+            if entry.filename in known else entry for entry in entries
+        ]
+        with self._lock, self._connection:
+            if formats:
+                self._connection.execute(
+                    f"DELETE FROM backups WHERE format IN "
+                    f"({', '.join('?' for _ in formats)})", formats)
+            else:
+                self._connection.execute("DELETE FROM backups")
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO backups "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                entries)
+
+    def _select(self, clause, parameters):
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT * FROM backups {clause}", parameters).fetchall()
+        return [BackupEntry(*row) for row in rows]
+
+    def close(self):
+        self._connection.close()
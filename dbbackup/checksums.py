@@ -0,0 +1,179 @@
+import hashlib
+import io
+import logging
+import mmap
+import os
+import threading
+import time
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+_logger = logging.getLogger(__name__)
+DEFAULT_ALGORITHM = "sha256"
+CHUNK_SIZE = 1024 * 1024
+# Size of the slices hashed at once, hashlib releases the GIL for large data
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+XXHASH_ALGORITHMS = ("xxh64", "xxh3_64", "xxh3_128")
+
+
+def get_hasher(algorithm):
+    """
+    Returns a new hash object for algorithm: sha256, blake2b, or one of
+    the xxhash algorithms if the xxhash package is installed.
+    """
+    if algorithm in ("sha256", "blake2b"):
+        return hashlib.new(algorithm)
+    if algorithm in XXHASH_ALGORITHMS:
+        if not xxhash:
+            raise Exception(
+                f"{algorithm} checksums require the xxhash package.")
+        return getattr(xxhash, algorithm)()
+    raise Exception(f"Unknown checksum algorithm {algorithm}, must be one of "
+                    f"sha256, blake2b, {', '.join(XXHASH_ALGORITHMS)}.")
+
+
+def format_checksum(algorithm, hexdigest):
+    """
+    Checksums are stored with their algorithm, for instance sha256:<hex>.
+    """
+    return f"{algorithm}:{hexdigest}"
+
+
+def parse_checksum(checksum):
+    """
+    Returns the (algorithm, hexdigest) of a checksum made by format_checksum.
+    """
+    algorithm, _, hexdigest = checksum.partition(":")
+    return algorithm, hexdigest
+
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM, limiter=None):
+    """
+    Returns the checksum of the file at path (see format_checksum).
+    The file is memory-mapped, and hashed by slices without copying it.
+    limiter is an optional RateLimiter.
+    """
+    hasher = get_hasher(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    for offset in range(0, size, HASH_BLOCK_SIZE):
+                        block = view[offset:offset + HASH_BLOCK_SIZE]
+                        if limiter:
+                            limiter.consume(len(block))
+                        hasher.update(block)
+                        block.release()
+    return format_checksum(algorithm, hasher.hexdigest())
+
+
+def verify_file(path, checksum):
+    """
+    Hash the file at path with the algorithm of checksum, and returns
+    True if it matches.
+    """
+    algorithm, _ = parse_checksum(checksum)
+    return hash_file(path, algorithm) == checksum
+
+
+class HashingWriter(io.RawIOBase):
+    """
+    Write-only file object hashing everything written to it, before writing
+    it to fileobj, so that the checksum of a file is computed while it is
+    written, without reading it again. Without fileobj, it only hashes.
+    Closing it does not close fileobj.
+    """
+
+    def __init__(self, fileobj, algorithm=DEFAULT_ALGORITHM):
+        self.fileobj = fileobj
+        self.algorithm = algorithm
+        self._hasher = get_hasher(algorithm)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.fileobj is not None:
+            self.fileobj.write(b)
+        self._hasher.update(b)
+        return len(b)
+
+    def flush(self):
+        if self.fileobj is not None:
+            return self.fileobj.flush()
+
+    @property
+    def checksum(self):
+        return format_checksum(self.algorithm, self._hasher.hexdigest())
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Read-only file object hashing everything read from fileobj, for instance
+    to check the checksum of a compressed file while decompressing it,
+    in a single pass. Reads are throttled by limiter (a RateLimiter),
+    if specified.
+    """
+
+    def __init__(self, fileobj, algorithm=DEFAULT_ALGORITHM, limiter=None):
+        self.fileobj = fileobj
+        self.algorithm = algorithm
+        self.limiter = limiter
+        self._hasher = get_hasher(algorithm)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if self.limiter:
+            self.limiter.consume(len(data))
+        self._hasher.update(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def drain(self):
+        """
+        Hash the rest of fileobj (data a decompressor did not need).
+        """
+        while self.read(CHUNK_SIZE):
+            pass
+
+    @property
+    def checksum(self):
+        return format_checksum(self.algorithm, self._hasher.hexdigest())
+
+
+class RateLimiter:
+    """
+    Limits the rate at which bytes are consumed to bytes_per_second,
+    shared between threads (token bucket allowing bursts of one second).
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = float(bytes_per_second)
+        self._lock = threading.Lock()
+        self._allowance = self.bytes_per_second
+        self._last = time.monotonic()
+
+    def consume(self, size):
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(
+                self.bytes_per_second, self._allowance +
+                (now - self._last) * self.bytes_per_second)
+            self._last = now
+            self._allowance -= size
+            wait = -self._allowance / self.bytes_per_second
+        if wait > 0:
+            time.sleep(wait)
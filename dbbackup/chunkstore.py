@@ -0,0 +1,416 @@
+import collections
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from dbbackup import compression
+from dbbackup.utils import PARTIAL_SUFFIX
+
+_logger = logging.getLogger(__name__)
+STORE_DIRECTORY = ".chunks"
+INDEX_FILENAME = "index.db"
+MANIFEST_EXTENSION = ".chunks"
+MANIFEST_HEADER = "dbbackup-chunks"
+MANIFEST_VERSION = "1"
+MIN_CHUNK_SIZE = 256 * 1024
+AVERAGE_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Bytes before a line end hashed to decide if it is a chunk boundary
+WINDOW_SIZE = 64
+# Unreferenced chunks are only deleted after this delay, as a backup running
+# concurrently may reference them
+GC_GRACE_PERIOD = 24 * 60 * 60
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    name TEXT PRIMARY KEY,
+    refs INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_refs ON chunks (refs, last_used);
+"""
+
+
+def is_manifest(path):
+    name = Path(path).name
+    # The store directory has the extension of the manifests
+    return name.endswith(MANIFEST_EXTENSION) and name != STORE_DIRECTORY
+
+
+def chunk_name(chunk_hash, codec=None):
+    """
+    Returns the name of a chunk compressed with codec: its hash, followed
+    by the extension of the codec, so that the same content compressed
+    differently is stored as another chunk.
+    """
+    return chunk_hash + (codec.extension if codec else "")
+
+
+def strip_extension(filename):
+    """
+    Returns filename without the manifest extension.
+    """
+    if is_manifest(filename):
+        return filename[:-len(MANIFEST_EXTENSION)]
+    return filename
+
+
+class Chunker:
+    """
+    Content-defined chunker: the stream is cut at positions depending only on
+    the content around them, so that an insertion or a deletion only changes
+    the chunks around it, and the other ones are deduplicated.
+    Dumps are mostly made of lines, so the boundaries are line ends: the
+    rolling window of bytes ending at each line end is hashed with crc32,
+    and the line end is a boundary with a probability proportional to the
+    line length, so that chunks get about average_size bytes longer than
+    min_size.
+    Only the line ends are visited in Python, the scanning and hashing are
+    done in C, which keeps the chunking fast.
+    Chunks are between min_size and max_size bytes (cut anywhere if no line
+    ends before max_size).
+    """
+
+    def __init__(self,
+                 min_size=MIN_CHUNK_SIZE,
+                 average_size=AVERAGE_CHUNK_SIZE,
+                 max_size=MAX_CHUNK_SIZE):
+        self.min_size = min_size
+        self.average_size = average_size
+        self.max_size = max_size
+        self._buffer = bytearray()
+        self._position = None
+        self._line_start = 0
+
+    def feed(self, data):
+        """
+        Add data to the stream, and returns the complete chunks.
+        """
+        self._buffer += data
+        chunks = []
+        while True:
+            boundary = self._find_boundary()
+            if boundary is None:
+                return chunks
+            chunks.append(bytes(self._buffer[:boundary]))
+            del self._buffer[:boundary]
+
+    def finish(self):
+        """
+        Returns the last chunks of the stream.
+        """
+        chunks = []
+        while self._buffer:
+            boundary = self._find_boundary() or len(self._buffer)
+            chunks.append(bytes(self._buffer[:boundary]))
+            del self._buffer[:boundary]
+        return chunks
+
+    def _find_boundary(self):
+        buffer = self._buffer
+        if len(buffer) < self.min_size:
+            return None
+        if self._position is None:
+            self._line_start = buffer.rfind(b"\n", 0, self.min_size - 1) + 1
+            self._position = self.min_size - 1
+        end = min(len(buffer), self.max_size)
+        position = buffer.find(b"\n", self._position, end)
+        while position != -1:
+            line_length = position + 1 - self._line_start
+            window = buffer[max(position - WINDOW_SIZE, 0):position]
+            if zlib.crc32(window) * self.average_size < line_length << 32:
+                self._position = None
+                return position + 1
+            self._line_start = position + 1
+            position = buffer.find(b"\n", self._line_start, end)
+        if len(buffer) >= self.max_size:
+            self._position = None
+            return self.max_size
+        # The next scan starts after the line ends already visited
+        self._position = end
+        return None
+
+
+class ChunkStore:
+    """
+    Deduplicated store of chunks, in the .chunks directory of the backup
+    directory. Each unique chunk is stored once per codec, compressed, under
+    its SHA-256 (see chunk_name). A backup is a manifest listing its chunks
+    (see ChunkWriter).
+    The number of manifests referencing each chunk is kept in an SQLite
+    index. References are added before a manifest is written, and removed
+    after it is deleted, so a crash can only leak chunks, never lose
+    referenced ones (recount fixes the counts from the manifests).
+    Can be used from several threads.
+    """
+
+    def __init__(self, backup_directory):
+        self.directory = Path(backup_directory) / STORE_DIRECTORY
+        self.directory.mkdir(exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            str(self.directory / INDEX_FILENAME),
+            timeout=30,
+            check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(SCHEMA)
+
+    def chunk_path(self, chunk_hash, codec=None):
+        return self._path(chunk_name(chunk_hash, codec))
+
+    def _path(self, name):
+        return self.directory / name[:2] / name
+
+    def put(self, chunk, codec=None, level=None):
+        """
+        Store chunk compressed with codec if it is not already, and returns
+        its hash.
+        """
+        chunk_hash = hashlib.sha256(chunk).hexdigest()
+        path = self.chunk_path(chunk_hash, codec)
+        # Marking the chunk as used and checking it exists is atomic with
+        # respect to collect_garbage, so the chunk can't be deleted once
+        # found
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO chunks VALUES (?, 0, ?) ON CONFLICT(name) "
+                "DO UPDATE SET last_used = excluded.last_used",
+                (chunk_name(chunk_hash, codec), time.time()))
+            if path.exists():
+                return chunk_hash
+        path.parent.mkdir(exist_ok=True)
+        if codec:
+            chunk = codec.compress_block(
+                chunk, codec.default_level if level is None else level)
+        fd, partial = tempfile.mkstemp(
+            suffix=PARTIAL_SUFFIX, dir=str(path.parent))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(chunk)
+            os.replace(partial, path)
+        except Exception:
+            os.unlink(partial)
+            raise
+        return chunk_hash
+
+    def get(self, chunk_hash, codec=None):
+        """
+        Returns the content of a chunk, checking its hash.
+        """
+        data = self.chunk_path(chunk_hash, codec).read_bytes()
+        if codec:
+            data = codec.decompress_block(data)
+        if hashlib.sha256(data).hexdigest() != chunk_hash:
+            raise Exception(f"Chunk {chunk_hash} is corrupted.")
+        return data
+
+    def add_references(self, hashes, codec=None):
+        """
+        Add a reference to each chunk of a manifest.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO chunks VALUES (?, 1, ?) ON CONFLICT(name) "
+                "DO UPDATE SET refs = refs + 1, "
+                "last_used = excluded.last_used",
+                [(name, now) for name in _chunk_names(hashes, codec)])
+
+    def remove_references(self, hashes, codec=None):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "UPDATE chunks SET refs = refs - 1 WHERE name = ?",
+                [(name, ) for name in _chunk_names(hashes, codec)])
+
+    def acquire(self, manifest):
+        """
+        Add the references of the manifest at path manifest, before it is
+        linked under another name.
+        """
+        codec, hashes = read_manifest(manifest)
+        self.add_references((chunk_hash for chunk_hash, _ in hashes),
+                            codec and compression.get_codec(codec))
+
+    def release(self, manifest):
+        """
+        Remove the references of the manifest at path manifest, before it is
+        deleted.
+        """
+        codec, hashes = read_manifest(manifest)
+        self.remove_references((chunk_hash for chunk_hash, _ in hashes),
+                               codec and compression.get_codec(codec))
+
+    def recount(self, manifests):
+        """
+        Set the references of every chunk from the given manifests.
+        """
+        counts = collections.Counter()
+        for manifest in manifests:
+            codec, hashes = read_manifest(manifest)
+            counts.update(
+                _chunk_names((chunk_hash for chunk_hash, _ in hashes),
+                             codec and compression.get_codec(codec)))
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE chunks SET refs = 0")
+            self._connection.executemany(
+                "INSERT INTO chunks VALUES (?, ?, ?) ON CONFLICT(name) "
+                "DO UPDATE SET refs = excluded.refs",
+                [(name, count, now) for name, count in counts.items()])
+
+    def collect_garbage(self, grace_period=GC_GRACE_PERIOD):
+        """
+        Delete the chunks no manifest references, and not used for
+        grace_period seconds. Returns the number of chunks and of bytes
+        deleted.
+        """
+        cutoff = time.time() - grace_period
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT name FROM chunks WHERE refs <= 0 AND last_used <= ?",
+                (cutoff, )).fetchall()
+        deleted = 0
+        size = 0
+        for (name, ) in rows:
+            # Checked again in the transaction, the chunk may have been
+            # used since
+            with self._lock, self._connection:
+                cursor = self._connection.execute(
+                    "DELETE FROM chunks WHERE name = ? AND refs <= 0 "
+                    "AND last_used <= ?", (name, cutoff))
+                if not cursor.rowcount:
+                    continue
+                path = self._path(name)
+                try:
+                    size += path.stat().st_size
+                    path.unlink()
+                    deleted += 1
+                except FileNotFoundError:
+                    pass
+        _logger.debug(f"Deleted {deleted} unreferenced chunks ({size} bytes)")
+        return deleted, size
+
+    def open_writer(self, manifest, codec=None, level=None, chunker=None):
+        return ChunkWriter(self, manifest, codec, level, chunker)
+
+    def open_reader(self, manifest):
+        return ChunkReader(self, manifest)
+
+    def close(self):
+        self._connection.close()
+
+
+class ChunkWriter(io.RawIOBase):
+    """
+    Write-only file object splitting what is written to it in chunks
+    (see Chunker), stored in store, and writing the manifest of the
+    backup to the manifest file object when closed.
+    Closing it does not close manifest.
+    """
+
+    def __init__(self, store, manifest, codec=None, level=None, chunker=None):
+        self.store = store
+        self.manifest = manifest
+        self.codec = codec
+        self.level = level
+        self.chunker = chunker or Chunker()
+        self.hashes = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        for chunk in self.chunker.feed(b):
+            self._put(chunk)
+        return len(b)
+
+    def _put(self, chunk):
+        self.hashes.append((self.store.put(chunk, self.codec, self.level),
+                            len(chunk)))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            for chunk in self.chunker.finish():
+                self._put(chunk)
+            # The references are added before the manifest exists, so that
+            # its chunks can't be collected
+            self.store.add_references(
+                (chunk_hash for chunk_hash, _ in self.hashes), self.codec)
+            codec_name = self.codec.name if self.codec else "-"
+            lines = [f"{MANIFEST_HEADER} {MANIFEST_VERSION} {codec_name}\n"]
+            lines += [
+                f"{chunk_hash} {size}\n" for chunk_hash, size in self.hashes
+            ]
+            self.manifest.write("".join(lines).encode())
+            _logger.debug(f"Wrote {len(self.hashes)} chunks")
+        finally:
+            super().close()
+
+    def discard(self):
+        """
+        Close without writing the manifest, its chunks will be collected.
+        """
+        super().close()
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Read-only file object reassembling a backup from its manifest,
+    one chunk at a time.
+    """
+
+    def __init__(self, store, manifest):
+        self.store = store
+        codec, self.hashes = read_manifest(manifest)
+        self.codec = codec and compression.get_codec(codec)
+        self._index = 0
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            if self._index >= len(self.hashes):
+                return 0
+            chunk_hash, size = self.hashes[self._index]
+            self._index += 1
+            chunk = self.store.get(chunk_hash, self.codec)
+            if len(chunk) != size:
+                raise Exception(f"Chunk {chunk_hash} has an invalid size.")
+            self._chunk = memoryview(chunk)
+        size = min(len(b), len(self._chunk))
+        b[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def _chunk_names(hashes, codec):
+    return set(chunk_name(chunk_hash, codec) for chunk_hash in hashes)
+
+
+def read_manifest(manifest):
+    """
+    Returns the codec name (or None) and the list of (hash, size) of the
+    chunks of the manifest at path manifest.
+    """
+    with open(manifest) as f:
+        header = f.readline().split()
+        if len(header) != 3 or header[0] != MANIFEST_HEADER:
+            raise Exception(f"{manifest} is not a chunk manifest.")
+        if header[1] != MANIFEST_VERSION:
+            raise Exception(f"Unsupported chunk manifest version {header[1]} "
+                            f"in {manifest}.")
+        hashes = []
+        for line in f:
+            chunk_hash, size = line.split()
+            hashes.append((chunk_hash, int(size)))
+    return None if header[2] == "-" else header[2], hashes
@@ -1,7 +1,7 @@
 import logging
 import click
 
-from dbbackup import builders
+from dbbackup import builders, config
 
 _logger = logging.getLogger(__package__)
 
@@ -14,7 +14,11 @@ class MySQLDatabaseCommand(click.MultiCommand):
             "backup": self.cmd_backup,
             "list": self.cmd_list,
             "restore": self.cmd_restore,
-            "cleanup": self.cmd_cleanup
+            "cleanup": self.cmd_cleanup,
+            "reindex": self.cmd_reindex,
+            "prune": self.cmd_prune,
+            "verify": self.cmd_verify,
+            "scrub": self.cmd_scrub
         }
 
     def cmd_backup(self):
@@ -26,7 +30,30 @@ class MySQLDatabaseCommand(click.MultiCommand):
                     ["-e", "--exclude"],
                     multiple=True,
                     help="Exclude database. You can use this option multiple times \
-                    to exclude multiple databases.")],
+                    to exclude multiple databases."),
+                click.Option(
+                    ["-j", "--jobs"],
+                    type=int,
+                    default=config.BACKUP_JOBS,
+                    show_default=True,
+                    help="Number of databases to backup concurrently, "
+                    "largest first."),
+                click.Option(
+                    ["--plan"],
+                    is_flag=True,
+                    help="Display how the databases would be distributed "
+                    "between the jobs, and the predicted makespan, "
+                    "without running the backups."),
+                click.Option(
+                    ["--throughput"],
+                    type=float,
+                    help="Expected dump throughput in MiB/s, used to "
+                    "estimate the duration with --plan."),
+                click.Option(
+                    ["--force"],
+                    is_flag=True,
+                    help="Dump the databases even if they have not changed "
+                    "since their previous backup (see SKIP_UNCHANGED).")],
             help="Backup the specified database, or all if none is specified. System databases "
             "such as information_schema and performance_schema will not be included by default, "
             "unless specified.")
@@ -50,7 +77,16 @@ class MySQLDatabaseCommand(click.MultiCommand):
                 click.Option(["--create"],
                              is_flag=True,
                              help="Create the database. Will raise an \
-                             exception if the database already exists.")
+                             exception if the database already exists."),
+                click.Option(
+                    ["-j", "--jobs"],
+                    type=int,
+                    default=config.RESTORE_JOBS,
+                    show_default=True,
+                    help="Number of tables restored concurrently."),
+                click.Option(
+                    ["-t", "--table"],
+                    help="Restore only this table (see TABLE_INDEX).")
             ])
 
     def cmd_cleanup(self):
@@ -60,6 +96,61 @@ class MySQLDatabaseCommand(click.MultiCommand):
             params=[
                 click.Argument(["days_to_keep"])])
 
+    def cmd_prune(self):
+        return click.Command(
+            "prune",
+            callback=getattr(self.provider, "prune"),
+            params=[
+                click.Option(
+                    ["--policy"],
+                    default=config.RETENTION_POLICY,
+                    help="Retention policy, for instance "
+                    "hourly=24,daily=14,weekly=8,monthly=12 "
+                    "(defaults to RETENTION_POLICY)."),
+                click.Option(
+                    ["--dry-run"],
+                    is_flag=True,
+                    help="Only display the backups that would be kept "
+                    "and deleted.")
+            ],
+            help="Delete the backups not kept by the retention policy.")
+
+    def cmd_verify(self):
+        return click.Command(
+            "verify",
+            callback=getattr(self.provider, "verify_backup"),
+            params=[click.Argument(["backup_file"])],
+            help="Check the backup against the checksum recorded when it "
+            "was written.")
+
+    def cmd_scrub(self):
+        return click.Command(
+            "scrub",
+            callback=getattr(self.provider, "scrub"),
+            params=[
+                click.Option(
+                    ["-j", "--jobs"],
+                    type=int,
+                    default=config.SCRUB_JOBS,
+                    show_default=True,
+                    help="Number of backups checked concurrently."),
+                click.Option(
+                    ["--rate-limit"],
+                    type=float,
+                    default=config.SCRUB_RATE_LIMIT or None,
+                    help="Maximum read rate in MiB/s.")
+            ],
+            help="Check every backup against its recorded size and checksum, "
+            "and check the integrity of the compressed ones. Exits with an "
+            "error if a backup is corrupted or missing.")
+
+    def cmd_reindex(self):
+        return click.Command(
+            "reindex",
+            callback=getattr(self.provider, "reindex"),
+            help="Rebuild the backup catalog from the content of the backup "
+            "directory.")
+
     def list_commands(self, ctx):
         return self.commands.keys()
 
@@ -75,7 +166,11 @@ class PostgreSQLDatabaseCommand(click.MultiCommand):
             "backup": self.cmd_backup,
             "list": self.cmd_list,
             "restore": self.cmd_restore,
-            "cleanup": self.cmd_cleanup
+            "cleanup": self.cmd_cleanup,
+            "reindex": self.cmd_reindex,
+            "prune": self.cmd_prune,
+            "verify": self.cmd_verify,
+            "scrub": self.cmd_scrub
         }
 
     def cmd_backup(self):
@@ -87,7 +182,30 @@ class PostgreSQLDatabaseCommand(click.MultiCommand):
                     ["-e", "--exclude"],
                     multiple=True,
                     help="Exclude database. You can use this option multiple times "
-                    "to exclude multiple databases.")],
+                    "to exclude multiple databases."),
+                click.Option(
+                    ["-j", "--jobs"],
+                    type=int,
+                    default=config.BACKUP_JOBS,
+                    show_default=True,
+                    help="Number of databases to backup concurrently, "
+                    "largest first."),
+                click.Option(
+                    ["--plan"],
+                    is_flag=True,
+                    help="Display how the databases would be distributed "
+                    "between the jobs, and the predicted makespan, "
+                    "without running the backups."),
+                click.Option(
+                    ["--throughput"],
+                    type=float,
+                    help="Expected dump throughput in MiB/s, used to "
+                    "estimate the duration with --plan."),
+                click.Option(
+                    ["--force"],
+                    is_flag=True,
+                    help="Dump the databases even if they have not changed "
+                    "since their previous backup (see SKIP_UNCHANGED).")],
             help="Backup the specified database, or all if none is specified.")
 
     def cmd_list(self):
@@ -109,7 +227,19 @@ class PostgreSQLDatabaseCommand(click.MultiCommand):
                 click.Option(["--create"],
                              is_flag=True,
                              help="Create the database. Will raise an "
-                             "exception if the database already exists.")
+                             "exception if the database already exists."),
+                click.Option(
+                    ["-j", "--jobs"],
+                    type=int,
+                    default=config.RESTORE_JOBS,
+                    show_default=True,
+                    help="Number of concurrent pg_restore jobs (or psql "
+                    "sessions for plain backups), for plain, custom and "
+                    "directory backups."),
+                click.Option(
+                    ["-t", "--table"],
+                    help="Restore only this table (schema.table or table), "
+                    "see TABLE_INDEX.")
             ])
 
     def cmd_cleanup(self):
@@ -119,6 +249,61 @@ class PostgreSQLDatabaseCommand(click.MultiCommand):
             params=[
                 click.Argument(["days_to_keep"])])
 
+    def cmd_prune(self):
+        return click.Command(
+            "prune",
+            callback=getattr(self.provider, "prune"),
+            params=[
+                click.Option(
+                    ["--policy"],
+                    default=config.RETENTION_POLICY,
+                    help="Retention policy, for instance "
+                    "hourly=24,daily=14,weekly=8,monthly=12 "
+                    "(defaults to RETENTION_POLICY)."),
+                click.Option(
+                    ["--dry-run"],
+                    is_flag=True,
+                    help="Only display the backups that would be kept "
+                    "and deleted.")
+            ],
+            help="Delete the backups not kept by the retention policy.")
+
+    def cmd_verify(self):
+        return click.Command(
+            "verify",
+            callback=getattr(self.provider, "verify_backup"),
+            params=[click.Argument(["backup_file"])],
+            help="Check the backup against the checksum recorded when it "
+            "was written.")
+
+    def cmd_scrub(self):
+        return click.Command(
+            "scrub",
+            callback=getattr(self.provider, "scrub"),
+            params=[
+                click.Option(
+                    ["-j", "--jobs"],
+                    type=int,
+                    default=config.SCRUB_JOBS,
+                    show_default=True,
+                    help="Number of backups checked concurrently."),
+                click.Option(
+                    ["--rate-limit"],
+                    type=float,
+                    default=config.SCRUB_RATE_LIMIT or None,
+                    help="Maximum read rate in MiB/s.")
+            ],
+            help="Check every backup against its recorded size and checksum, "
+            "and check the integrity of the compressed ones. Exits with an "
+            "error if a backup is corrupted or missing.")
+
+    def cmd_reindex(self):
+        return click.Command(
+            "reindex",
+            callback=getattr(self.provider, "reindex"),
+            help="Rebuild the backup catalog from the content of the backup "
+            "directory.")
+
     def list_commands(self, ctx):
         return self.commands.keys()
 
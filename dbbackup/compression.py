@@ -0,0 +1,618 @@
+import bz2
+import collections
+import contextlib
+import functools
+import gzip
+import io
+import logging
+import lzma
+import os
+import struct
+import tarfile
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_logger = logging.getLogger(__name__)
+GZIP_EXTENSION = ".gz"
+DEFAULT_COMPRESS_LEVEL = 6
+DEFAULT_COMPRESS_WORKERS = 1
+DEFAULT_COMPRESS_BLOCK_SIZE = 1024 * 1024
+MAGIC_SIZE = 6
+# Blocks of seekable files decompressed concurrently
+DEFAULT_DECOMPRESS_WORKERS = os.cpu_count() or 1
+
+
+class Codec:
+    """
+    A compression format, identified by its name, the extension appended to
+    the backup files, and the magic bytes at the start of compressed files.
+    Subclasses implement the streaming writer and reader, and the compression
+    of an independent block (used to compress blocks concurrently,
+    see ParallelBlockWriter).
+    Seekable codecs can also write and read a block index after the blocks
+    (see SeekableBlockWriter).
+    """
+    name = None
+    extension = None
+    magic = None
+    default_level = None
+    seekable = False
+
+    def open_writer(self,
+                    fileobj,
+                    filename,
+                    level=None,
+                    workers=DEFAULT_COMPRESS_WORKERS,
+                    block_size=DEFAULT_COMPRESS_BLOCK_SIZE,
+                    seekable=False):
+        """
+        Returns a file object compressing everything written to it into
+        fileobj. With more than one worker, blocks are compressed concurrently.
+        If seekable is set, blocks are always compressed independently, and
+        followed by their index, so that the file can be read from any block.
+        Closing the returned object does not close fileobj.
+        """
+        if level is None:
+            level = self.default_level
+        if seekable:
+            if not self.seekable:
+                raise Exception(
+                    f"{self.name} compression can't be seekable, "
+                    f"use {' or '.join(SEEKABLE_CODECS)}.")
+            return SeekableBlockWriter(
+                fileobj, self, level, workers=workers, block_size=block_size)
+        if workers > 1:
+            return ParallelBlockWriter(
+                fileobj,
+                functools.partial(self.compress_block, level=level),
+                workers=workers,
+                block_size=block_size)
+        return self._open_stream_writer(fileobj, filename, level)
+
+    def open_reader(self, fileobj):
+        """
+        Returns a file object decompressing the content of fileobj.
+        Concatenated streams (as written by ParallelBlockWriter) are supported.
+        """
+        raise NotImplementedError()
+
+    def compress_block(self, block, level):
+        raise NotImplementedError()
+
+    def decompress_block(self, block):
+        raise NotImplementedError()
+
+    def block_index(self, blocks):
+        """
+        Returns the bytes to write after the blocks to index them, blocks
+        being their (compressed size, size). They must be ignored by the
+        usual readers of the format.
+        """
+        raise NotImplementedError()
+
+    def read_block_index(self, fileobj):
+        """
+        Returns the (compressed size, size) of the blocks of the seekable
+        file object fileobj, read from their index, or None if it has none.
+        The position of fileobj is restored.
+        """
+        return None
+
+    def _open_stream_writer(self, fileobj, filename, level):
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return f"<Codec {self.name}>"
+
+
+class GzipCodec(Codec):
+    """
+    gzip codec. The block index of seekable files is the comment of an
+    empty gzip member, followed by another empty member with the size of
+    the index member in an extra field, so that the index is found from
+    the end of the file (gzip readers ignore both).
+    """
+    name = "gzip"
+    extension = GZIP_EXTENSION
+    magic = b"\x1f\x8b"
+    default_level = DEFAULT_COMPRESS_LEVEL
+    seekable = True
+    # Empty deflate stream, CRC32 and size of an empty member
+    EMPTY_MEMBER_END = b"\x03\x00" + bytes(8)
+    # Header of the index member: FCOMMENT flag, no mtime, unknown OS, then
+    # the start of the comment
+    INDEX_HEADER = (b"\x1f\x8b\x08\x10" + bytes(4) + b"\x00\xff" +
+                    b"dbbackup-blocks 1 ")
+    # Header of the footer member: FEXTRA flag, no mtime, unknown OS, and
+    # a "DB" extra subfield of 8 bytes
+    FOOTER_HEADER = (b"\x1f\x8b\x08\x04" + bytes(4) + b"\x00\xff" +
+                     struct.pack("<H", 12) + b"DB" + struct.pack("<H", 8))
+    FOOTER_SIZE = len(FOOTER_HEADER) + 8 + len(EMPTY_MEMBER_END)
+
+    def open_reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+    def compress_block(self, block, level):
+        # mtime is fixed so that the same input always gives the same output
+        return gzip.compress(block, compresslevel=level, mtime=0)
+
+    def decompress_block(self, block):
+        return gzip.decompress(block)
+
+    def block_index(self, blocks):
+        # The comment ends with a zero byte
+        index = (self.INDEX_HEADER +
+                 ",".join(f"{csize}:{size}"
+                          for csize, size in blocks).encode() + b"\x00" +
+                 self.EMPTY_MEMBER_END)
+        return (index + self.FOOTER_HEADER + struct.pack("<Q", len(index)) +
+                self.EMPTY_MEMBER_END)
+
+    def read_block_index(self, fileobj):
+        position = fileobj.tell()
+        try:
+            end = fileobj.seek(0, io.SEEK_END)
+            if end < self.FOOTER_SIZE:
+                return None
+            fileobj.seek(end - self.FOOTER_SIZE)
+            footer = fileobj.read(self.FOOTER_SIZE)
+            if (not footer.startswith(self.FOOTER_HEADER)
+                    or not footer.endswith(self.EMPTY_MEMBER_END)):
+                return None
+            index_size, = struct.unpack_from("<Q", footer,
+                                             len(self.FOOTER_HEADER))
+            end_of_blocks = end - self.FOOTER_SIZE - index_size
+            if end_of_blocks < 0:
+                return None
+            fileobj.seek(end_of_blocks)
+            index = fileobj.read(index_size - len(self.EMPTY_MEMBER_END) - 1)
+            if not index.startswith(self.INDEX_HEADER):
+                return None
+            index = index[len(self.INDEX_HEADER):]
+            blocks = [
+                tuple(int(size) for size in block.split(b":"))
+                for block in index.split(b",") if block
+            ]
+            if sum(csize for csize, _ in blocks) != end_of_blocks:
+                return None
+            return blocks
+        finally:
+            fileobj.seek(position)
+
+    def _open_stream_writer(self, fileobj, filename, level):
+        # Neither the (timestamped) name nor the time are written, so that
+        # the same input always gives the same output, like compress_block
+        return gzip.GzipFile(filename="",
+                             mode='wb',
+                             compresslevel=level,
+                             fileobj=fileobj,
+                             mtime=0)
+
+
+class Bzip2Codec(Codec):
+    name = "bz2"
+    extension = ".bz2"
+    magic = b"BZh"
+    default_level = 9
+
+    def open_reader(self, fileobj):
+        return bz2.BZ2File(fileobj, mode='rb')
+
+    def compress_block(self, block, level):
+        return bz2.compress(block, compresslevel=level)
+
+    def decompress_block(self, block):
+        return bz2.decompress(block)
+
+    def _open_stream_writer(self, fileobj, filename, level):
+        return bz2.BZ2File(fileobj, mode='wb', compresslevel=level)
+
+
+class LzmaCodec(Codec):
+    name = "lzma"
+    extension = ".xz"
+    magic = b"\xfd7zXZ\x00"
+    default_level = 6
+
+    def open_reader(self, fileobj):
+        return lzma.LZMAFile(fileobj, mode='rb')
+
+    def compress_block(self, block, level):
+        return lzma.compress(block, preset=level)
+
+    def decompress_block(self, block):
+        return lzma.decompress(block)
+
+    def _open_stream_writer(self, fileobj, filename, level):
+        return lzma.LZMAFile(fileobj, mode='wb', preset=level)
+
+
+class ZstdCodec(Codec):
+    """
+    Zstandard codec, only available if the zstandard package is installed.
+    zstd has its own multi-threaded compression, which is used instead of
+    ParallelBlockWriter.
+    Seekable files use the Zstandard seekable format: one frame per block,
+    followed by a skippable frame holding the seek table.
+    """
+    name = "zstd"
+    extension = ".zst"
+    magic = b"\x28\xb5\x2f\xfd"
+    default_level = 3
+    seekable = True
+    SKIPPABLE_MAGIC = 0x184D2A5E
+    SEEKABLE_MAGIC = 0x8F92EAB1
+    SEEK_TABLE_FOOTER_SIZE = 9
+
+    def open_writer(self,
+                    fileobj,
+                    filename,
+                    level=None,
+                    workers=DEFAULT_COMPRESS_WORKERS,
+                    block_size=DEFAULT_COMPRESS_BLOCK_SIZE,
+                    seekable=False):
+        if level is None:
+            level = self.default_level
+        if seekable:
+            return super().open_writer(
+                fileobj,
+                filename,
+                level=level,
+                workers=workers,
+                block_size=block_size,
+                seekable=seekable)
+        compressor = zstandard.ZstdCompressor(
+            level=level, threads=workers if workers > 1 else 0)
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    def open_reader(self, fileobj):
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True, closefd=False)
+
+    def compress_block(self, block, level):
+        return zstandard.ZstdCompressor(level=level).compress(block)
+
+    def decompress_block(self, block):
+        return zstandard.ZstdDecompressor().decompress(block)
+
+    def block_index(self, blocks):
+        entries = b"".join(
+            struct.pack("<II", csize, size) for csize, size in blocks)
+        # No checksums in the entries
+        footer = struct.pack("<IBI", len(blocks), 0, self.SEEKABLE_MAGIC)
+        return (struct.pack("<II", self.SKIPPABLE_MAGIC,
+                            len(entries) + len(footer)) + entries + footer)
+
+    def read_block_index(self, fileobj):
+        position = fileobj.tell()
+        try:
+            end = fileobj.seek(0, io.SEEK_END)
+            if end < self.SEEK_TABLE_FOOTER_SIZE + 8:
+                return None
+            fileobj.seek(end - self.SEEK_TABLE_FOOTER_SIZE)
+            count, descriptor, magic = struct.unpack(
+                "<IBI", fileobj.read(self.SEEK_TABLE_FOOTER_SIZE))
+            if magic != self.SEEKABLE_MAGIC:
+                return None
+            entry_size = 12 if descriptor & 0x80 else 8
+            table_size = count * entry_size + self.SEEK_TABLE_FOOTER_SIZE
+            end_of_blocks = end - table_size - 8
+            if end_of_blocks < 0:
+                return None
+            fileobj.seek(end_of_blocks + 8)
+            table = fileobj.read(count * entry_size)
+            blocks = [
+                struct.unpack_from("<II", table, i * entry_size)
+                for i in range(count)
+            ]
+            if sum(csize for csize, _ in blocks) != end_of_blocks:
+                return None
+            return blocks
+        finally:
+            fileobj.seek(position)
+
+
+CODECS = collections.OrderedDict()
+SEEKABLE_CODECS = (GzipCodec.name, ZstdCodec.name)
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+register_codec(GzipCodec())
+register_codec(Bzip2Codec())
+register_codec(LzmaCodec())
+if zstandard:
+    register_codec(ZstdCodec())
+
+
+def get_codec(name):
+    """
+    Returns the codec registered under name.
+    For backward compatibility, True is the gzip codec.
+    """
+    if name is True:
+        name = GzipCodec.name
+    try:
+        return CODECS[name]
+    except KeyError:
+        if name == ZstdCodec.name:
+            raise Exception(
+                "zstd compression requires the zstandard package.")
+        raise Exception(f"Unknown compression {name}, "
+                        f"must be one of {', '.join(CODECS)}.")
+
+
+def codec_from_filename(filename):
+    """
+    Returns the codec matching the extension of filename, or None.
+    """
+    for codec in CODECS.values():
+        if str(filename).endswith(codec.extension):
+            return codec
+    return None
+
+
+def codec_from_magic(path):
+    """
+    Returns the codec matching the first bytes of the file, or None.
+    """
+    if not Path(path).is_file():
+        return None
+    with open(path, 'rb') as f:
+        header = f.read(MAGIC_SIZE)
+    for codec in CODECS.values():
+        if header.startswith(codec.magic):
+            return codec
+    return None
+
+
+def detect_codec(path):
+    """
+    Returns the codec used to compress the file at path, based on its
+    extension, then on its magic bytes. None if it is not compressed.
+    """
+    return codec_from_filename(path) or codec_from_magic(path)
+
+
+def strip_extension(filename):
+    """
+    Returns filename without the extension of the codec it is compressed with.
+    """
+    codec = codec_from_filename(filename)
+    if codec:
+        return filename[:-len(codec.extension)]
+    return filename
+
+
+class ParallelBlockWriter(io.RawIOBase):
+    """
+    Write-only file object compressing data with several threads, like pigz.
+    The data is split in blocks of block_size bytes, each block is compressed
+    independently by a thread pool (zlib, bz2 and lzma release the GIL),
+    and the compressed blocks are written to fileobj in order.
+    gzip, bzip2, xz and zstd all accept concatenated streams, so the result
+    can be read by the usual tools and modules.
+    At most 2 blocks per worker are kept in memory, writes block otherwise.
+    The (compressed size, size) of the blocks written are listed in blocks.
+    Closing it does not close fileobj.
+    """
+
+    def __init__(self,
+                 fileobj,
+                 compress_block,
+                 workers=DEFAULT_COMPRESS_WORKERS,
+                 block_size=DEFAULT_COMPRESS_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.compress_block = compress_block
+        self.workers = workers
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self.blocks = []
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="compress")
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(b)
+
+    def _submit(self, block):
+        if len(self._pending) >= 2 * self.workers:
+            self._write_member(self._pending.popleft())
+        self._pending.append(
+            (self._executor.submit(self.compress_block, block), len(block)))
+
+    def _write_member(self, pending):
+        future, size = pending
+        member = future.result()
+        self.fileobj.write(member)
+        self.blocks.append((len(member), size))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or not (self.blocks or self._pending):
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_member(self._pending.popleft())
+            _logger.debug(f"Wrote {len(self.blocks)} compressed blocks")
+        finally:
+            self._executor.shutdown(wait=True)
+            super().close()
+
+
+class SeekableBlockWriter(ParallelBlockWriter):
+    """
+    ParallelBlockWriter writing the index of the blocks after them, in the
+    format of the seekable codec (see Codec.block_index), so that they can
+    be read independently (see SeekableBlockReader).
+    """
+
+    def __init__(self,
+                 fileobj,
+                 codec,
+                 level,
+                 workers=DEFAULT_COMPRESS_WORKERS,
+                 block_size=DEFAULT_COMPRESS_BLOCK_SIZE):
+        super().__init__(
+            fileobj,
+            functools.partial(codec.compress_block, level=level),
+            workers=workers,
+            block_size=block_size)
+        self.codec = codec
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.fileobj.write(self.codec.block_index(self.blocks))
+
+
+class SeekableBlockReader(io.RawIOBase):
+    """
+    Seekable read-only file object decompressing a file written by
+    SeekableBlockWriter, given the (compressed size, size) of its blocks.
+    Seeking only decompresses the block it lands in, and while a block is
+    read, the next ones are decompressed ahead by workers threads.
+    Closing it does not close fileobj.
+    """
+
+    def __init__(self,
+                 fileobj,
+                 codec,
+                 blocks,
+                 workers=DEFAULT_DECOMPRESS_WORKERS):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.workers = max(int(workers), 1)
+        self._blocks = blocks
+        # Compressed and uncompressed offsets of the blocks
+        self._offsets = []
+        self._starts = []
+        offset = start = 0
+        for csize, size in blocks:
+            self._offsets.append(offset)
+            self._starts.append(start)
+            offset += csize
+            start += size
+        self.size = start
+        self._position = 0
+        self._block = None
+        self._ahead = collections.OrderedDict()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="decompress")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def readinto(self, b):
+        if self._position >= self.size:
+            return 0
+        number = bisect_right(self._starts, self._position) - 1
+        if self._block is None or self._block[0] != number:
+            self._block = (number, self._get_block(number))
+        data = self._block[1]
+        offset = self._position - self._starts[number]
+        count = min(len(b), len(data) - offset)
+        b[:count] = memoryview(data)[offset:offset + count]
+        self._position += count
+        return count
+
+    def _get_block(self, number):
+        """
+        Returns the content of block number, decompressing the next blocks
+        ahead, and forgetting the ones before.
+        """
+        for other in list(self._ahead):
+            if other < number:
+                self._ahead.pop(other).cancel()
+        last = min(number + 2 * self.workers, len(self._blocks))
+        for ahead in range(number, last):
+            if ahead not in self._ahead:
+                self.fileobj.seek(self._offsets[ahead])
+                compressed = self.fileobj.read(self._blocks[ahead][0])
+                self._ahead[ahead] = self._executor.submit(
+                    self.codec.decompress_block, compressed)
+        data = self._ahead.pop(number).result()
+        if len(data) != self._blocks[number][1]:
+            raise Exception(f"Block {number} is {len(data)} bytes long "
+                            f"instead of {self._blocks[number][1]}.")
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        for future in self._ahead.values():
+            future.cancel()
+        self._ahead.clear()
+        self._executor.shutdown(wait=True)
+        super().close()
+
+
+@contextlib.contextmanager
+def open_decompressed(path, codec=None, workers=DEFAULT_DECOMPRESS_WORKERS):
+    """
+    Context manager opening the backup file at path for reading,
+    decompressing it on the fly. The codec is detected if not specified,
+    the file is read as is if it is not compressed.
+    Seekable files (see SeekableBlockWriter) are decompressed by workers
+    threads, and can be seeked.
+    Backups made by older versions were tar.gz archives containing the dump
+    (for instance .sql.gz), the dump is streamed from the archive.
+    """
+    codec = codec or detect_codec(path)
+    with open(path, 'rb') as f:
+        blocks = codec.read_block_index(f) if codec else None
+        if not codec:
+            yield f
+        elif blocks is not None:
+            _logger.debug(f"Reading {len(blocks)} blocks of {path}")
+            with SeekableBlockReader(f, codec, blocks, workers) as reader:
+                yield reader
+        elif _is_legacy_archive(path, Path(strip_extension(str(path))),
+                                codec):
+            _logger.debug(f"Streaming dump from legacy archive {path}")
+            with tarfile.open(fileobj=f, mode="r|gz") as tf:
+                yield tf.extractfile(tf.next())
+        else:
+            with codec.open_reader(f) as reader:
+                yield reader
+
+
+def _is_legacy_archive(compressed_file, decompressed_file, codec):
+    return (codec.name == GzipCodec.name
+            and decompressed_file.suffix != ".tar"
+            and tarfile.is_tarfile(compressed_file))
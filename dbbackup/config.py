@@ -20,13 +20,72 @@ except KeyError as e:
 # General
 DAYS_TO_KEEP = os.environ.get("DAYS_TO_KEEP", 7)
 BACKUP_SUFFIX = os.environ.get("BACKUP_SUFFIX", False)
+# Grandfather-father-son retention policy used by prune,
+# for instance hourly=24,daily=14,weekly=8,monthly=12
+RETENTION_POLICY = os.environ.get("RETENTION_POLICY", False)
 PROVIDER = os.environ.get("PROVIDER", False)
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 EXCLUDE_DATABASES = os.environ.get("EXCLUDE_DATABASES", False)
+# Directory used to write the dumps before moving them to BACKUP_DIRECTORY.
+# By default, dumps are written directly in BACKUP_DIRECTORY.
+TEMP_DIRECTORY = os.environ.get("TEMP_DIRECTORY", False)
+# Number of databases backuped concurrently
+BACKUP_JOBS = int(os.environ.get("BACKUP_JOBS", 1))
+# Number of concurrent restore jobs
+RESTORE_JOBS = int(os.environ.get("RESTORE_JOBS", 1))
+# Number of threads used to compress a dump, and size of the compressed blocks
+COMPRESS_WORKERS = int(os.environ.get("COMPRESS_WORKERS", 1))
+COMPRESS_BLOCK_SIZE = int(os.environ.get("COMPRESS_BLOCK_SIZE", 1024 * 1024))
+# Write seekable compressed files, made of independent blocks and their index
+COMPRESS_SEEKABLE = get_bool(os.environ.get("COMPRESS_SEEKABLE", False))
+# Compression level, the default depends on the codec
+COMPRESSION_LEVEL = os.environ.get("COMPRESSION_LEVEL", False)
+# Checksum computed while writing the backups,
+# sha256|blake2b|xxh64|xxh3_64|xxh3_128 or none
+CHECKSUM_ALGORITHM = os.environ.get("CHECKSUM_ALGORITHM", "sha256")
+# Number of backups checked concurrently by scrub, and its maximum read rate
+# in MiB/s (unlimited by default)
+SCRUB_JOBS = int(os.environ.get("SCRUB_JOBS", 4))
+SCRUB_RATE_LIMIT = os.environ.get("SCRUB_RATE_LIMIT", False)
+# Store the backups as deduplicated chunks, shared between backups
+DEDUP = get_bool(os.environ.get("DEDUP", False))
+# Reuse the previous backup of the databases that have not changed since
+SKIP_UNCHANGED = get_bool(os.environ.get("SKIP_UNCHANGED", False))
+# Write the offsets of the tables of plain SQL dumps next to the backups
+TABLE_INDEX = get_bool(os.environ.get("TABLE_INDEX", False))
+
+# Store the backups in an S3 (or S3 compatible) bucket, under S3_PREFIX,
+# instead of BACKUP_DIRECTORY (which only keeps the catalog)
+S3_BUCKET = os.environ.get("S3_BUCKET", False)
+S3_PREFIX = os.environ.get("S3_PREFIX", "")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL", False)
+# Size of the parts of the uploads, and number of parts uploaded concurrently
+S3_PART_SIZE = int(os.environ.get("S3_PART_SIZE", 16 * 1024 * 1024))
+S3_UPLOAD_WORKERS = int(os.environ.get("S3_UPLOAD_WORKERS", 4))
+# Number of parts downloaded concurrently (by ranged GETs) when restoring
+S3_DOWNLOAD_WORKERS = int(os.environ.get("S3_DOWNLOAD_WORKERS", 4))
+# Encrypt the backups with this key (32 bytes, base64 encoded), or the key
+# read from ENCRYPTION_KEY_FILE (32 raw bytes, or base64 encoded)
+ENCRYPTION_KEY = os.environ.get("ENCRYPTION_KEY", False)
+ENCRYPTION_KEY_FILE = os.environ.get("ENCRYPTION_KEY_FILE", False)
+# aes-256-gcm|chacha20-poly1305
+ENCRYPTION_CIPHER = os.environ.get("ENCRYPTION_CIPHER", "aes-256-gcm")
+# Number of threads encrypting (and decrypting) a backup
+ENCRYPTION_WORKERS = int(os.environ.get("ENCRYPTION_WORKERS", 1))
+
+# Keep the backups in BACKUP_DIRECTORY, and upload a copy to S3_BUCKET
+S3_COPY = get_bool(os.environ.get("S3_COPY", False))
+# Directories getting a copy of the backups (comma separated)
+COPY_DIRECTORIES = os.environ.get("COPY_DIRECTORIES", False)
 
 # Prometheus Pushgateway - metrics
 PROMETHEUS_PUSHGATEWAY_URL = os.environ.get("PROMETHEUS_PUSHGATEWAY_URL",
                                             False)
+# Timeout of each push in seconds, and number of retries of a failed push
+PROMETHEUS_PUSHGATEWAY_TIMEOUT = float(
+    os.environ.get("PROMETHEUS_PUSHGATEWAY_TIMEOUT", 10))
+PROMETHEUS_PUSHGATEWAY_RETRIES = int(
+    os.environ.get("PROMETHEUS_PUSHGATEWAY_RETRIES", 3))
 
 # Provider - Postgres
 PGHOST = os.environ.get("PGHOST", False)
@@ -36,6 +95,12 @@ PGPASSWORD = os.environ.get("PGPASSWORD", False)
 PG_BACKUP_TYPE = os.environ.get("PG_BACKUP_TYPE", False)
 PGPASSFILE = os.environ.get("PGPASSFILE", False)
 PG_BIN_DIRECTORY = os.environ.get("PG_BIN_DIRECTORY", "/usr/local/bin")
+# Number of parallel pg_dump jobs, requires PG_BACKUP_TYPE=d (directory)
+PG_DUMP_JOBS = int(os.environ.get("PG_DUMP_JOBS", 1))
+# Pack directory backups in a single (compressed) tar file
+PG_PACK_DIRECTORY = get_bool(os.environ.get("PG_PACK_DIRECTORY", False))
+PG_COMPRESS = get_bool(os.environ.get("PG_COMPRESS", False))
+PG_COMPRESSION = os.environ.get("PG_COMPRESSION", False)  # gzip|bz2|lzma|zstd
 
 # Provider - MySQL
 MYSQL_HOST = os.environ.get("MYSQL_HOST", False)
@@ -43,3 +108,7 @@ MYSQL_USER = os.environ.get("MYSQL_USER", "root")
 MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD", False)
 MYSQL_BIN_DIRECTORY = os.environ.get("MYSQL_BIN_DIRECTORY", "/usr/local/bin/")
 MYSQL_COMPRESS = get_bool(os.environ.get("MYSQL_COMPRESS", False))
+# gzip|bz2|lzma|zstd
+MYSQL_COMPRESSION = os.environ.get("MYSQL_COMPRESSION", False)
+# Number of tables dumped concurrently, in a directory backup, if above 1
+MYSQL_DUMP_JOBS = int(os.environ.get("MYSQL_DUMP_JOBS", 1))
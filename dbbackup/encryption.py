@@ -0,0 +1,277 @@
+import base64
+import binascii
+import collections
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import (
+        AESGCM, ChaCha20Poly1305)
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:
+    AESGCM = None
+
+_logger = logging.getLogger(__name__)
+EXTENSION = ".enc"
+MAGIC = b"DBBKENC1"
+# Cipher names, and their identifier in the header of the files
+CIPHERS = collections.OrderedDict([("aes-256-gcm", 1),
+                                   ("chacha20-poly1305", 2)])
+DEFAULT_CIPHER = "aes-256-gcm"
+DEFAULT_WORKERS = 1
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+KEY_SIZE = 32
+SALT_SIZE = 16
+TAG_SIZE = 16
+# Magic, cipher identifier, chunk size and salt
+HEADER_SIZE = len(MAGIC) + 1 + 4 + SALT_SIZE
+
+
+class DecryptionError(Exception):
+    pass
+
+
+def is_encrypted(path):
+    return str(path).endswith(EXTENSION)
+
+
+def strip_extension(filename):
+    """
+    Returns filename without the encryption extension.
+    """
+    if is_encrypted(filename):
+        return filename[:-len(EXTENSION)]
+    return filename
+
+
+def load_key(key=None, key_file=None):
+    """
+    Returns the encryption key (KEY_SIZE bytes), base64 encoded in key,
+    or read from key_file (raw, or base64 encoded).
+    """
+    if key_file:
+        data = Path(key_file).read_bytes()
+        if len(data) == KEY_SIZE:
+            return data
+        key = data.strip()
+    try:
+        decoded = base64.b64decode(key, validate=True)
+    except (binascii.Error, ValueError, TypeError):
+        raise Exception("The encryption key must be base64 encoded.")
+    if len(decoded) != KEY_SIZE:
+        raise Exception(f"The encryption key must be {KEY_SIZE} bytes, "
+                        f"not {len(decoded)}.")
+    return decoded
+
+
+class Encryption:
+    """
+    Authenticated encryption of the backups with key, by chunks of
+    chunk_size bytes encrypted (and decrypted) by workers threads, with
+    AES-256-GCM or ChaCha20-Poly1305. Only available if the cryptography
+    package is installed.
+    Each file gets its own key, derived from key and a random salt (HKDF),
+    and each chunk its own nonce: its index, and whether it is the last one,
+    so that reordered, truncated or extended files are detected.
+    The file starts with a header (MAGIC, cipher, chunk size and salt),
+    authenticated with every chunk, followed by the encrypted chunks and
+    their tags.
+    """
+    extension = EXTENSION
+
+    def __init__(self,
+                 key,
+                 cipher=DEFAULT_CIPHER,
+                 workers=DEFAULT_WORKERS,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        if not AESGCM:
+            raise Exception("Encryption requires the cryptography package.")
+        if cipher not in CIPHERS:
+            raise Exception(f"Unknown cipher {cipher}, must be one of "
+                            f"{', '.join(CIPHERS)}.")
+        if len(key) != KEY_SIZE:
+            raise Exception(f"The encryption key must be {KEY_SIZE} bytes.")
+        self.key = key
+        self.cipher = cipher
+        self.workers = max(int(workers or DEFAULT_WORKERS), 1)
+        self.chunk_size = int(chunk_size)
+
+    def __repr__(self):
+        # Never show the key
+        return f"Encryption({self.cipher})"
+
+    def open_writer(self, fileobj):
+        return EncryptingWriter(fileobj, self.key, self.cipher, self.workers,
+                                self.chunk_size)
+
+    def open_reader(self, fileobj):
+        return DecryptingReader(fileobj, self.key, self.workers)
+
+
+def _get_aead(cipher, key, salt):
+    file_key = HKDF(algorithm=hashes.SHA256(),
+                    length=KEY_SIZE,
+                    salt=salt,
+                    info=b"dbbackup " + cipher.encode()).derive(key)
+    if cipher == "chacha20-poly1305":
+        return ChaCha20Poly1305(file_key)
+    return AESGCM(file_key)
+
+
+def _get_nonce(index, last):
+    return index.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+
+
+def _read_exactly(fileobj, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+class EncryptingWriter(io.RawIOBase):
+    """
+    Write-only file object encrypting what is written to it (see
+    Encryption), the chunks being encrypted by a thread pool and written to
+    fileobj in order. At most 2 chunks per worker are kept in memory, writes
+    block otherwise.
+    Closing it does not close fileobj.
+    """
+
+    def __init__(self,
+                 fileobj,
+                 key,
+                 cipher=DEFAULT_CIPHER,
+                 workers=DEFAULT_WORKERS,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.workers = workers
+        self.chunk_size = chunk_size
+        salt = os.urandom(SALT_SIZE)
+        self._header = (MAGIC + bytes([CIPHERS[cipher]]) +
+                        chunk_size.to_bytes(4, "big") + salt)
+        self._aead = _get_aead(cipher, key, salt)
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._index = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="encrypt")
+        self.fileobj.write(self._header)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        # The last chunk is only encrypted once closed, as the last one
+        while len(self._buffer) > self.chunk_size:
+            chunk = bytes(self._buffer[:self.chunk_size])
+            del self._buffer[:self.chunk_size]
+            self._submit(chunk)
+        return len(b)
+
+    def _submit(self, chunk, last=False):
+        if len(self._pending) >= 2 * self.workers:
+            self.fileobj.write(self._pending.popleft().result())
+        self._pending.append(
+            self._executor.submit(self._aead.encrypt,
+                                  _get_nonce(self._index, last), chunk,
+                                  self._header))
+        self._index += 1
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown(wait=True)
+            super().close()
+
+
+class DecryptingReader(io.RawIOBase):
+    """
+    Read-only file object decrypting a file written by EncryptingWriter,
+    read from fileobj. The chunks are decrypted by a thread pool, up to
+    2 chunks per worker ahead, and checked: a corrupted, truncated or
+    extended file, or a wrong key, raises an exception.
+    Closing it does not close fileobj.
+    """
+
+    def __init__(self, fileobj, key, workers=DEFAULT_WORKERS):
+        self.fileobj = fileobj
+        self.workers = workers
+        self._header = _read_exactly(fileobj, HEADER_SIZE)
+        cipher = next((name for name, identifier in CIPHERS.items()
+                       if self._header[len(MAGIC):len(MAGIC) + 1] == bytes(
+                           [identifier])), None)
+        if (len(self._header) < HEADER_SIZE
+                or not self._header.startswith(MAGIC) or not cipher):
+            raise DecryptionError(
+                "Not an encrypted backup, or an unknown cipher.")
+        chunk_size = int.from_bytes(
+            self._header[len(MAGIC) + 1:len(MAGIC) + 5], "big")
+        self._aead = _get_aead(cipher, key, self._header[-SALT_SIZE:])
+        self._record_size = chunk_size + TAG_SIZE
+        self._next_record = _read_exactly(fileobj, self._record_size)
+        self._index = 0
+        self._last_requested = False
+        self._pending = collections.deque()
+        self._buffer = memoryview(b"")
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="decrypt")
+        self._request_chunks()
+
+    def _request_chunks(self):
+        while (not self._last_requested
+               and len(self._pending) < 2 * self.workers):
+            record = self._next_record
+            self._next_record = _read_exactly(self.fileobj, self._record_size)
+            last = not self._next_record
+            self._pending.append(
+                self._executor.submit(self._decrypt, self._index, record,
+                                      last))
+            self._index += 1
+            self._last_requested = last
+
+    def _decrypt(self, index, record, last):
+        try:
+            return self._aead.decrypt(_get_nonce(index, last), record,
+                                      self._header)
+        except InvalidTag:
+            raise DecryptionError(
+                f"Chunk {index} of the encrypted backup can't be decrypted: "
+                "it is corrupted or truncated, or the key is wrong.")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            if not self._pending:
+                return 0
+            self._buffer = memoryview(self._pending.popleft().result())
+            self._request_chunks()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._pending.clear()
+        super().close()
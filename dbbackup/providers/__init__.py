@@ -1,20 +1,112 @@
 import abc
-from datetime import datetime
+import collections
+import contextlib
+import filecmp
+import io
+import lzma
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 import os
 from pathlib import Path
 import logging
+import subprocess
+import tempfile
+import time
+import zlib
+
+from dbbackup import (catalog, checksums, chunkstore, compression, encryption,
+                      retention, scheduler, sqlsplit, streaming)
+from dbbackup.storage import LocalStorage, REMOTE_ERRORS
+from dbbackup.streaming import run_from_file, run_to_file
+from dbbackup.tempbackupfile import TemporaryBackupFile
+from dbbackup.utils import link_file, replace_with_link, sizeof_fmt
 
 _logger = logging.getLogger(__name__)
+DEFAULT_JOBS = 1
+# Extension of the backups made of a directory of files
+DIRECTORY_EXTENSION = ".dir"
+
+DEFAULT_SCRUB_JOBS = 4
+SCRUB_READ_SIZE = 8 * 1024 * 1024
+# Errors reading or decoding a backup, which scrub reports as corruption
+SCRUB_ERRORS = (OSError, EOFError, zlib.error, lzma.LZMAError,
+                encryption.DecryptionError) + REMOTE_ERRORS
+
+# unchanged is True if the database had not changed since its previous
+# backup, which was reused. copies are the errors of the copies of the backup
+# by destination (None for the successful ones).
+BackupResult = collections.namedtuple(
+    "BackupResult", [
+        "database", "filename", "size", "duration", "error", "checksum",
+        "marker", "unchanged", "copies"
+    ],
+    defaults=(None, None, False, None))
+ScrubResult = collections.namedtuple("ScrubResult",
+                                     ["filename", "status", "detail"])
 
 
 class AbstractProvider(abc.ABC):
     callbacks = []
+    # Extensions of the backups (before compression), longest first
+    formats = ()
+    backup_suffix = None
+    codec = None
+    compress_level = None
+    compress_seekable = False
+    # encryption.Encryption of the backups
+    encryption = None
+    checksum = None
+    dedup = False
+    skip_unchanged = False
+    table_index = False
+    # sqlsplit dialect finding the sections of the plain SQL dumps
+    dialect = None
 
-    def __init__(self, backup_directory):
+    def __init__(self,
+                 backup_directory,
+                 temp_directory=None,
+                 storage=None,
+                 copies=None):
         self.backup_directory = backup_directory
+        self.temp_directory = temp_directory
+        # Where the backups are stored, the backup directory by default.
+        # The catalog is always in the backup directory.
+        self.storage = storage or LocalStorage(backup_directory)
+        # Storages getting a copy of the backups, written with them
+        self.copies = list(copies or [])
+        self._catalog = None
+        self._chunk_store = None
+        # Checksums of the backups written by backup_database, by filename,
+        # until _run_backup returns them
+        self._checksums = {}
+        # Errors of the copies of the backups (see TemporaryBackupFile),
+        # by filename, until _timed_backup returns them
+        self._copy_errors = {}
+
+    @abc.abstractclassmethod
+    def execute_backup(self,
+                       database=None,
+                       exclude=None,
+                       jobs=DEFAULT_JOBS,
+                       plan=False,
+                       throughput=None,
+                       force=False):
+        pass
 
     @abc.abstractclassmethod
-    def execute_backup(self, database=None, exclude=None):
+    def get_databases(self, with_sizes=False):
+        """
+        Returns the list of databases, or of (database, size in bytes) tuples
+        if with_sizes is True.
+        """
+        pass
+
+    @abc.abstractclassmethod
+    def _run_backup(self, database):
+        """
+        Backup the database, and returns the backup filename, size,
+        and checksum (None if it could not be computed).
+        """
         pass
 
     @abc.abstractclassmethod
@@ -23,27 +115,964 @@ class AbstractProvider(abc.ABC):
 
     @abc.abstractclassmethod
     def restore_backup(self, backup_file, database, recreate=None,
-                       create=None):
+                       create=None, jobs=DEFAULT_JOBS, table=None):
         pass
 
+    def get_change_marker(self, database):
+        """
+        Returns a string identifying the current state of the database
+        (changing whenever its content changes), or None if it can't
+        be known. Used to skip the backups of unchanged databases.
+        """
+        return None
+
+    def run_backups(self,
+                    databases,
+                    jobs=DEFAULT_JOBS,
+                    plan=False,
+                    throughput=None,
+                    force=False):
+        """
+        Backup the databases, running at most jobs backups concurrently.
+        With several jobs, the largest databases are started first
+        (see scheduler.schedule).
+        If plan is True, only display the plan (see display_plan).
+        With skip_unchanged, the previous backup of a database that has not
+        changed since is reused instead of dumping it again, unless force
+        is True (see _reuse_backup).
+        A failing backup does not stop the others, the errors are raised
+        together once all the backups are done.
+        Callbacks are notified once per successful backup (backup_done), then
+        once with all the results (backups_done), from the calling thread.
+        """
+        jobs = max(int(jobs or DEFAULT_JOBS), 1)
+        if jobs > 1 or plan:
+            backup_plan = self.plan_backups(databases, jobs)
+            if plan:
+                self.display_plan(backup_plan, throughput)
+                return []
+            databases = backup_plan.order
+        _logger.debug(
+            f"Starting backup of databases: {databases} ({jobs} jobs)")
+        results = []
+        with ThreadPoolExecutor(
+                max_workers=jobs, thread_name_prefix="backup") as executor:
+            futures = {
+                executor.submit(self._timed_backup, database, force): database
+                for database in databases
+            }
+            for future in as_completed(futures):
+                database = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    _logger.error(f"Backup of database {database} failed: {e}")
+                    results.append(BackupResult(database, None, None, None, e))
+                    continue
+                self.record_backup(result.filename, result.size,
+                                   result.duration, result.checksum,
+                                   result.marker)
+                self.notify_callbacks(
+                    'backup_done',
+                    datetime.now().isoformat(),
+                    database,
+                    result.filename,
+                    result.size,
+                    checksum=result.checksum)
+                results.append(result)
+
+        results.sort(key=lambda result: databases.index(result.database))
+        self.notify_callbacks('backups_done', results)
+        self.display_summary(results)
+        errors = [result for result in results if result.error]
+        failed_copies = [
+            f"{result.filename} to {destination}: {error}"
+            for result in results if result.copies
+            for destination, error in result.copies.items() if error
+        ]
+        messages = []
+        if errors:
+            messages.append(
+                f"Could not backup {len(errors)} of {len(results)} "
+                "database(s): " + "; ".join(
+                    str(result.error) for result in errors))
+        if failed_copies:
+            messages.append(f"Could not copy {len(failed_copies)} "
+                            "backup(s): " + "; ".join(failed_copies))
+        if messages:
+            raise Exception(". ".join(messages))
+        return results
+
+    def plan_backups(self, databases, jobs=DEFAULT_JOBS):
+        sizes = dict(self.get_databases(with_sizes=True))
+        return scheduler.schedule(
+            {database: sizes.get(database, 0)
+             for database in databases}, jobs)
+
+    def display_plan(self, plan, throughput=None):
+        """
+        Display the databases backuped by each worker, and the predicted
+        makespan. If throughput (MiB/s) is given, also display the
+        estimated duration.
+        """
+        for worker, worker_plan in enumerate(plan.workers, start=1):
+            print(f"Worker {worker}\t{sizeof_fmt(worker_plan.load)}\t"
+                  f"{', '.join(worker_plan.databases)}")
+        makespan = f"Predicted makespan: {sizeof_fmt(plan.makespan)}"
+        if throughput:
+            duration = plan.makespan / (float(throughput) * 1024 * 1024)
+            makespan += (f" ({timedelta(seconds=round(duration))} "
+                         f"at {throughput}MiB/s)")
+        print(makespan)
+
+    def _timed_backup(self, database, force=False):
+        start = time.monotonic()
+        marker = None
+        if self.skip_unchanged:
+            try:
+                marker = self.get_change_marker(database)
+            except Exception as e:
+                _logger.warning(
+                    f"Could not check whether database {database} changed: {e}"
+                )
+        # The marker is read before the dump, so that changes made during
+        # the dump make the next backup dump the database again
+        if marker and not force:
+            reused = self._reuse_backup(database, marker)
+            if reused:
+                filename, size, checksum = reused
+                return BackupResult(database, filename, size,
+                                    time.monotonic() - start, None, checksum,
+                                    marker, True)
+        filename, size, checksum = self._run_backup(database)
+        copies = {
+            str(destination): error and str(error)
+            for destination, error in self._copy_errors.pop(
+                filename, {}).items()
+        }
+        if checksum:
+            self._link_identical_backup(database,
+                                        self.get_backup_file(filename), size,
+                                        checksum)
+        return BackupResult(database, filename, size,
+                            time.monotonic() - start, None, checksum, marker,
+                            copies=copies or None)
+
+    def _reuse_backup(self, database, marker):
+        """
+        If the latest backup of database was made when the database was in
+        the state identified by marker, and has the name a new backup would
+        have (same suffix, format and compression), link it under a new
+        name, and returns its filename (like _run_backup), size and checksum.
+        Returns None if there is no such backup.
+        """
+        filename = self.construct_backup_filename(database)
+        if self.dedup:
+            filename += chunkstore.MANIFEST_EXTENSION
+        backup_file = self.get_backup_file(filename)
+        previous = self._get_previous_backup(database, backup_file)
+        if not previous or previous.marker != marker:
+            return None
+        source = Path(self.backup_directory, previous.filename)
+        if not source.is_file():
+            return None
+        if chunkstore.is_manifest(backup_file):
+            self.get_chunk_store().acquire(source)
+        link_file(source, Path(self.backup_directory, backup_file))
+        if sqlsplit.get_index_path(source).exists():
+            link_file(sqlsplit.get_index_path(source),
+                      sqlsplit.get_index_path(
+                          Path(self.backup_directory, backup_file)))
+        _logger.info(f"Database {database} has not changed since backup "
+                     f"{previous.filename}, linked as {backup_file}")
+        return filename, previous.size, previous.checksum
+
+    def _link_identical_backup(self, database, backup_file, size, checksum):
+        """
+        If the new backup_file is identical to the previous backup of the
+        database (same checksum and size), replace it by a link to it,
+        so that their content is stored once. Returns True if it was linked.
+        """
+        if self.storage.remote:
+            # Objects can't be linked
+            return False
+        previous = self._get_previous_backup(database, backup_file)
+        if (not previous or previous.checksum != checksum
+                or previous.size != size):
+            return False
+        source = Path(self.backup_directory, previous.filename)
+        target = Path(self.backup_directory, backup_file)
+        algorithm, _ = checksums.parse_checksum(checksum)
+        try:
+            # xxhash checksums are not collision resistant
+            if (algorithm in checksums.XXHASH_ALGORITHMS
+                    and not filecmp.cmp(source, target, shallow=False)):
+                return False
+            linked = replace_with_link(source, target)
+        except OSError as e:
+            _logger.warning(f"Could not link backup {backup_file} to "
+                            f"{previous.filename}: {e}")
+            return False
+        if linked:
+            _logger.info(f"Backup {backup_file} is identical to "
+                         f"{previous.filename}, linked to it")
+        return linked
+
+    def _get_previous_backup(self, database, backup_file):
+        """
+        Returns the catalog entry of the most recent backup of database with
+        the same suffix as backup_file, if it has the same name apart from its
+        timestamp (same format and compression).
+        """
+        suffix = self.backup_suffix or ""
+        previous = next(
+            (entry for entry in self.get_backup_entries(database)
+             if entry.suffix == suffix and entry.filename != backup_file),
+            None)
+        # The names only differ by their timestamp, before the first "-"
+        if previous and previous.filename.partition(
+                "-")[2] == backup_file.partition("-")[2]:
+            return previous
+        return None
+
+    def get_identical_backups(self, entries):
+        """
+        Returns a dict of the backups of entries (most recent first) having
+        the same content as an older backup of the same database (same
+        checksum and size), to the oldest of them.
+        """
+        identical = {}
+        originals = {}
+        for entry in reversed(entries):
+            if not entry.checksum:
+                continue
+            key = (entry.database, entry.checksum, entry.size)
+            if key in originals:
+                identical[entry.filename] = originals[key]
+            else:
+                originals[key] = entry.filename
+        return identical
+
+    def display_summary(self, results):
+        succeeded = len([result for result in results if not result.error])
+        unchanged = len([result for result in results if result.unchanged])
+        print(f"Backup summary: {succeeded} succeeded "
+              f"({unchanged} unchanged), "
+              f"{len(results) - succeeded} failed")
+        for result in results:
+            if result.error:
+                print(f"FAILED\t{result.database}\t{result.error}")
+            else:
+                print(f"{'UNCHANGED' if result.unchanged else 'OK'}\t"
+                      f"{result.database}\t{result.filename}\t"
+                      f"{sizeof_fmt(int(result.size))}\t"
+                      f"{result.duration:.1f}s")
+            for destination, error in (result.copies or {}).items():
+                if error:
+                    print(f"COPY FAILED\t{result.database}\t{destination}\t"
+                          f"{error}")
+                else:
+                    print(f"COPIED\t{result.database}\t{destination}")
+
     def cleanup(self, days_to_keep):
-        backups = self.get_backups()
-        for backup in backups:
-            backup_absolute = Path(self.backup_directory + "/" + backup)
-            if self._is_older_than(backup_absolute, days_to_keep):
-                _logger.info(
-                    f"Removing backup {backup} >= {days_to_keep} days")
-                self._remove(backup_absolute)
-
-    def _is_older_than(self, backup, days):
-        now = datetime.now().timestamp()
-        backup_timestamp = os.path.getmtime(backup)
-        age_days = (now - backup_timestamp) / (60 * 60 * 24)
-        _logger.debug(f"Backup {backup} age {age_days} days")
-        return age_days >= float(days)
-
-    def _remove(self, backup):
-        return backup.unlink()
+        cutoff = time.time() - float(days_to_keep) * 60 * 60 * 24
+        for entry in self.get_backup_entries(modified_before=cutoff):
+            _logger.info(
+                f"Removing backup {entry.filename} >= {days_to_keep} days")
+            self._remove_backup(entry)
+        self._collect_chunks()
+
+    def prune(self, policy, dry_run=False):
+        """
+        Apply a grandfather-father-son retention policy (see
+        retention.parse_policy) to each series of backups (same database
+        and suffix), deleting the backups no tier keeps.
+        With dry_run, only display which backups would be kept and deleted.
+        """
+        policy = retention.parse_policy(policy)
+        series = collections.defaultdict(list)
+        for entry in self.get_backup_entries():
+            series[(entry.database, entry.suffix)].append(entry)
+
+        kept = deleted = 0
+        for (database, suffix), entries in sorted(series.items()):
+            entries_by_name = {entry.filename: entry for entry in entries}
+            backups = []
+            for entry in entries:
+                try:
+                    backups.append((entry.filename,
+                                    retention.parse_timestamp(
+                                        entry.timestamp)))
+                except ValueError:
+                    _logger.warning(
+                        f"Keeping backup {entry.filename}, "
+                        f"its timestamp can't be parsed")
+            for decision in retention.select(backups, policy):
+                if decision.tiers:
+                    kept += 1
+                    if dry_run:
+                        print(f"keep\t{decision.name}\t"
+                              f"{','.join(decision.tiers)}")
+                    continue
+                deleted += 1
+                if dry_run:
+                    print(f"delete\t{decision.name}")
+                    continue
+                _logger.info(f"Removing backup {decision.name}")
+                self._remove_backup(entries_by_name[decision.name])
+        if not dry_run:
+            self._collect_chunks()
+        print(f"{kept} backups kept, {deleted} "
+              f"{'would be ' if dry_run else ''}deleted")
+
+    def _remove_backup(self, entry):
+        path = Path(self.backup_directory + "/" + entry.filename)
+        try:
+            if path.is_file() and path.stat().st_nlink > 1:
+                # Hard linked by an identical backup, only the name is removed
+                _logger.info(f"Backup {entry.filename} shares its content "
+                             "with another backup, which keeps it")
+            if chunkstore.is_manifest(entry.filename):
+                self.get_chunk_store().release(path)
+            self._remove(entry.filename)
+            sqlsplit.get_index_path(path).unlink(missing_ok=True)
+        except FileNotFoundError:
+            _logger.warning(f"Backup {entry.filename} was already removed")
+        self.get_catalog().remove(entry.filename)
+
+    def get_chunk_store(self):
+        if self._chunk_store is None:
+            self._chunk_store = chunkstore.ChunkStore(self.backup_directory)
+        return self._chunk_store
+
+    def _has_chunk_store(self):
+        return (self.dedup or Path(self.backup_directory,
+                                   chunkstore.STORE_DIRECTORY).is_dir())
+
+    def _collect_chunks(self):
+        """
+        Delete the chunks of the chunk store no backup references anymore.
+        """
+        if not self._has_chunk_store():
+            return
+        deleted, size = self.get_chunk_store().collect_garbage()
+        if deleted:
+            _logger.info(
+                f"Deleted {deleted} unreferenced chunks ({sizeof_fmt(size)})")
+
+    def _backup_to_chunk_store(self, database, filename):
+        """
+        Dump the database in the chunk store, compressing the new chunks
+        with the codec, and write its manifest as backup file.
+        Returns the name of the manifest.
+        """
+        filename += chunkstore.MANIFEST_EXTENSION
+        manifest = TemporaryBackupFile(
+            filename,
+            self.backup_directory,
+            temp_directory=self.temp_directory,
+            checksum=self.checksum)
+        indexer = self._get_indexer()
+        with manifest as manifest_file:
+            writer = self.get_chunk_store().open_writer(
+                manifest_file, self.codec, self.compress_level)
+            try:
+                run_to_file(
+                    self._get_backup_command(database),
+                    sqlsplit.IndexingWriter(writer, indexer)
+                    if indexer else writer)
+            except subprocess.CalledProcessError as e:
+                writer.discard()
+                raise Exception(
+                    f"Could not backup database {database}: retcode "
+                    f"{e.returncode} - stderr {e.stderr}.")
+            writer.close()
+        self._checksums[filename] = manifest.checksum
+        self._write_table_index(filename, indexer)
+        return filename
+
+    def _get_indexer(self):
+        """
+        Returns a SectionIndexer to index the tables of a plain SQL dump
+        while it is written (see sqlsplit.IndexingWriter), or None if
+        table_index is not set.
+        """
+        if not (self.table_index and self.dialect):
+            return None
+        return sqlsplit.SectionIndexer(self.dialect())
+
+    def _write_table_index(self, filename, indexer):
+        """
+        Write the table index of the backup filename (see backup_database)
+        found by indexer, next to it. The backup is kept if it fails.
+        """
+        if not indexer:
+            return
+        backup_path = Path(self.backup_directory,
+                           self.get_backup_file(filename))
+        try:
+            sqlsplit.write_index(sqlsplit.get_index_path(backup_path),
+                                 indexer.index())
+        except OSError as e:
+            _logger.warning(
+                f"Could not write the table index of {backup_path.name}: {e}")
+
+    @property
+    def remote_storage(self):
+        """
+        The storage the backups are uploaded to while they are written
+        (see TemporaryBackupFile), None if they are written to the backup
+        directory.
+        """
+        return self.storage if self.storage.remote else None
+
+    def validate_storage(self, directory_backups=False):
+        """
+        Raises an exception if the storage is remote, and the configuration
+        needs the backups to be local files (directory_backups tells whether
+        the backups are directories).
+        """
+        if not self.storage.remote:
+            return
+        local_only = [
+            option for option, enabled in (
+                ("deduplicated backups (dedup)", self.dedup),
+                ("unchanged backups reuse (skip_unchanged)",
+                 self.skip_unchanged),
+                ("table indexes (table_index)", self.table_index),
+                ("directory backups", directory_backups)) if enabled
+        ]
+        if local_only:
+            raise Exception(f"{', '.join(local_only)} require the backups to "
+                            f"be stored locally, not in {self.storage}")
+
+    def validate_copies(self, directory_backups=False):
+        """
+        Raises an exception if the backups are copied, and the configuration
+        writes backups that can't be (the copies are written while
+        TemporaryBackupFile writes the backups).
+        """
+        if not self.copies:
+            return
+        not_copied = [
+            option for option, enabled in (
+                ("deduplicated backups (dedup)", self.dedup),
+                ("unchanged backups reuse (skip_unchanged)",
+                 self.skip_unchanged),
+                ("directory backups", directory_backups)) if enabled
+        ]
+        if not_copied:
+            raise Exception(f"{', '.join(not_copied)} can't be copied "
+                            f"(copies), only single file backups are")
+
+    def validate_encryption(self, directory_backups=False):
+        """
+        Raises an exception if the backups are encrypted, and the
+        configuration writes backups that can't be (only the backups
+        written by TemporaryBackupFile are).
+        """
+        if not self.encryption:
+            return
+        not_encrypted = [
+            option for option, enabled in (
+                ("deduplicated backups (dedup)", self.dedup),
+                ("seekable compression (compress_seekable)",
+                 self.compress_seekable),
+                ("directory backups", directory_backups)) if enabled
+        ]
+        if not_encrypted:
+            raise Exception(f"{', '.join(not_encrypted)} can't be encrypted "
+                            f"(encryption), only single file backups are")
+
+    def get_backup_file(self, filename):
+        """
+        Returns the name of the file written for the backup filename
+        returned by backup_database.
+        """
+        if (chunkstore.is_manifest(filename)
+                or filename.endswith(DIRECTORY_EXTENSION)):
+            # The files of a directory backup are compressed separately
+            return filename
+        if self.codec:
+            filename += self.codec.extension
+        if self.encryption:
+            filename += self.encryption.extension
+        return filename
+
+    def get_dump_name(self, backup_file):
+        """
+        Returns the name of the dump, without compression, encryption or
+        manifest extension.
+        """
+        return compression.strip_extension(
+            encryption.strip_extension(
+                chunkstore.strip_extension(backup_file)))
+
+    def get_encryption(self, backup_file):
+        """
+        Returns the encryption.Encryption decrypting backup_file, raises an
+        exception if there is no key.
+        """
+        if not self.encryption:
+            raise Exception(f"Backup {Path(backup_file).name} is encrypted, "
+                            "its key is needed (encryption)")
+        return self.encryption
+
+    @contextlib.contextmanager
+    def _open_decoded(self, fileobj, backup_file, codec):
+        """
+        Context manager decrypting (if backup_file is encrypted) and
+        decompressing (with codec, if any) fileobj, the content of
+        backup_file.
+        """
+        with contextlib.ExitStack() as stack:
+            reader = fileobj
+            if encryption.is_encrypted(backup_file):
+                reader = stack.enter_context(
+                    self.get_encryption(backup_file).open_reader(reader))
+            if codec:
+                reader = stack.enter_context(codec.open_reader(reader))
+            yield reader
+
+    @contextlib.contextmanager
+    def open_backup(self, backup_file, stages=None):
+        """
+        Context manager opening a backup for reading, decompressing it or
+        reassembling it from the chunk store on the fly. Encrypted backups are
+        decrypted before decompression. Remote backups are decoded
+        (decrypted and decompressed) in a separate thread while they are
+        downloaded, and the streaming.Stages of their pipeline (download,
+        decoding, and the consumer of the data) are appended to stages if
+        given.
+        """
+        encrypted = encryption.is_encrypted(backup_file)
+        if chunkstore.is_manifest(backup_file):
+            with self.get_chunk_store().open_reader(backup_file) as reader:
+                yield reader
+        elif self.storage.remote:
+            codec = self.get_backup_codec(backup_file)
+            download = streaming.Stage("download",
+                                       self.storage.download_workers)
+            restore = streaming.Stage("restore")
+            with self.storage.open_reader(
+                    os.path.relpath(backup_file, self.backup_directory),
+                    download) as f:
+                if not (codec or encrypted):
+                    if stages is not None:
+                        stages += [download, restore]
+                    yield streaming.MeteredReader(f, consumer=restore)
+                    return
+                decode = streaming.Stage(" and ".join(
+                    step for step, enabled in (("decrypt", encrypted),
+                                               ("decompress", codec))
+                    if enabled))
+                if stages is not None:
+                    stages += [download, decode, restore]
+                downloaded = streaming.MeteredReader(f)
+                with self._open_decoded(downloaded, backup_file,
+                                        codec) as decoded, \
+                        streaming.ReadAheadReader(
+                            streaming.MeteredReader(
+                                decoded, decode,
+                                upstream=downloaded)) as reader:
+                    yield streaming.MeteredReader(reader, consumer=restore)
+        elif encrypted:
+            with open(backup_file, 'rb') as f, self._open_decoded(
+                    f, backup_file,
+                    self.get_backup_codec(backup_file)) as reader:
+                yield reader
+        else:
+            with compression.open_decompressed(
+                    backup_file,
+                    self.get_backup_codec(backup_file)) as reader:
+                yield reader
+
+    def _log_throughput(self, backup_file, stages, started):
+        """
+        Log the throughput of the stages of the restore of backup_file,
+        started at started (time.monotonic()), if it was streamed from the
+        remote storage (see open_backup).
+        """
+        if stages:
+            _logger.info(
+                f"Restored {Path(backup_file).name}: " +
+                streaming.format_stages(stages, time.monotonic() - started))
+
+    def _get_split_jobs(self, backup_file, jobs):
+        """
+        Returns the number of sessions restoring the plain dump backup_file
+        (see _restore_split): 1 for encrypted backups, whose sections would
+        be written decrypted to disk.
+        """
+        jobs = max(int(jobs or DEFAULT_JOBS), 1)
+        if jobs > 1 and encryption.is_encrypted(backup_file):
+            _logger.warning(
+                f"{Path(backup_file).name} is encrypted, restoring it with a "
+                "single session so that it is not written decrypted to disk.")
+            return 1
+        return jobs
+
+    def _restore_split(self, backup_file, database, command,
+                       jobs=DEFAULT_JOBS):
+        """
+        Restore a plain SQL dump with jobs concurrent sessions: the dump is
+        split (see sqlsplit.split_dump) in a temporary directory, then its
+        schema is loaded, then the data of its tables, jobs at a time,
+        largest first, then its post-data (constraints, indexes, views...).
+        """
+        with tempfile.TemporaryDirectory(dir=self.temp_directory) as tmpdir:
+            with self.open_backup(backup_file) as f:
+                if isinstance(f, io.RawIOBase):
+                    # Read line by line
+                    f = io.BufferedReader(f)
+                schema, data, post_data = sqlsplit.split_dump(
+                    f, self.dialect(), tmpdir)
+            _logger.info(f"Restoring the data of {len(data)} tables "
+                         f"of {Path(backup_file).name} with {jobs} jobs")
+            self._load_files(database, command,
+                             [("schema", s.path) for s in schema])
+            data = sorted(data, key=lambda s: s.size, reverse=True)
+            self._load_files(
+                database, command,
+                [(f"table {s.name}" if s.name else "data", s.path)
+                 for s in data], jobs)
+            self._load_files(database, command,
+                             [("post-data", s.path) for s in post_data])
+
+    def _restore_table(self, backup_file, database, command, table):
+        """
+        Restore a single table of a plain SQL dump: the header of the dump,
+        then the definition, data and constraints of the table, read from
+        the backup at the offsets of its table index (seeking to them if
+        it is not compressed). Without index, the whole dump is read once
+        to find them.
+        """
+        index_path = sqlsplit.get_index_path(backup_file)
+        if index_path.exists():
+            index = sqlsplit.read_index(index_path)
+        else:
+            _logger.info(f"{Path(backup_file).name} has no table index, "
+                         "reading it to find the table")
+            indexer = sqlsplit.SectionIndexer(self.dialect())
+            with self.open_backup(backup_file) as f:
+                for block in iter(lambda: f.read(sqlsplit.SKIP_SIZE), b""):
+                    indexer.feed(block)
+            index = indexer.index()
+        ranges = sqlsplit.get_table_ranges(index, table)
+        size = sum(end - start for start, end in ranges)
+        _logger.info(f"Restoring table {table} ({sizeof_fmt(size)})")
+        try:
+            with self.open_backup(backup_file) as f:
+                run_from_file(command, sqlsplit.RangeReader(f, ranges))
+        except subprocess.CalledProcessError as e:
+            raise Exception(
+                f"Could not restore table {table} in database {database}: "
+                f"{e.output}, {e.stderr}")
+
+    def _load_files(self,
+                    database,
+                    command,
+                    files,
+                    jobs=DEFAULT_JOBS,
+                    codec=None):
+        """
+        Load the SQL files (a list of (description, path)) with the restore
+        command, jobs at a time, in order. Once a file fails, the files not
+        started yet are skipped.
+        """
+        def load(path):
+            with compression.open_decompressed(path, codec) as f:
+                run_from_file(command, f)
+
+        errors = []
+        with ThreadPoolExecutor(
+                max_workers=jobs, thread_name_prefix="restore") as executor:
+            futures = {
+                executor.submit(load, path): description
+                for description, path in files
+            }
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                try:
+                    future.result()
+                except subprocess.CalledProcessError as e:
+                    errors.append(f"{futures[future]}: {e.stderr}")
+                    for other in futures:
+                        other.cancel()
+        if errors:
+            raise Exception(f"Could not restore database {database}: "
+                            + "; ".join(errors))
+
+    def get_catalog(self):
+        """
+        Returns the catalog of the backup directory. If there is none yet,
+        it is created from the content of the directory.
+        """
+        if self._catalog is None:
+            self._catalog = catalog.Catalog(self.backup_directory)
+            if self._catalog.created:
+                _logger.info("Indexing the backup directory")
+                self._index_backups()
+        return self._catalog
+
+    def reindex(self):
+        """
+        Rebuild the catalog from the content of the backup directory,
+        for instance after backups were copied or removed by hand.
+        """
+        _logger.info(f"Backup directory: {self.backup_directory}")
+        self.get_catalog()
+        count = self._index_backups()
+        print(f"Indexed {count} backups")
+
+    def _index_backups(self):
+        entries = []
+        manifests = []
+        for stored in self.storage.list(lambda name: self.is_backup(
+                name) or chunkstore.is_manifest(name)):
+            if chunkstore.is_manifest(stored.name):
+                manifests.append(self.backup_directory + "/" + stored.name)
+            if not self.is_backup(stored.name):
+                continue
+            entry = self.make_catalog_entry(stored.name, stored.size,
+                                            stored.mtime)
+            try:
+                # A linked backup has the modification time of the first
+                # backup of its file, it was made at its timestamp at least
+                made = retention.parse_timestamp(entry.timestamp).timestamp()
+                entry = entry._replace(mtime=max(entry.mtime, made))
+            except ValueError:
+                pass
+            entries.append(entry)
+        self._catalog.replace(entries, formats=self.formats)
+        if self._has_chunk_store():
+            # Every manifest, whatever its provider, references chunks
+            self.get_chunk_store().recount(manifests)
+        return len(entries)
+
+    def record_backup(self,
+                      filename,
+                      size,
+                      duration=None,
+                      checksum=None,
+                      marker=None):
+        """
+        Add the backup written by _run_backup to the catalog. As the backup
+        has already been written, failing to index it is only a warning
+        (reindex will find it).
+        """
+        backup_file = self.get_backup_file(filename)
+        try:
+            self.get_catalog().add(
+                self.make_catalog_entry(
+                    backup_file,
+                    size,
+                    time.time(),
+                    duration=duration,
+                    checksum=checksum,
+                    marker=marker))
+        except Exception as e:
+            _logger.warning(
+                f"Could not add backup {backup_file} to the catalog: {e}")
+
+    def make_catalog_entry(self,
+                           backup_file,
+                           size,
+                           mtime,
+                           duration=None,
+                           checksum=None,
+                           marker=None):
+        """
+        Returns the catalog.BackupEntry of backup_file, the database,
+        timestamp, suffix, format and codec being parsed from its name.
+        """
+        codec = compression.codec_from_filename(
+            encryption.strip_extension(backup_file))
+        dump_name = self.get_dump_name(backup_file)
+        backup_format = next(
+            (backup_format for backup_format in self.formats
+             if dump_name.endswith(backup_format)), Path(dump_name).suffix)
+        timestamp, _, database = dump_name[:-len(backup_format)].partition(
+            "-")
+        suffix = self.backup_suffix or ""
+        if suffix and database.endswith(suffix):
+            database = database[:-len(suffix)]
+        else:
+            suffix = ""
+        return catalog.BackupEntry(backup_file, database, timestamp, suffix,
+                                   backup_format, codec and codec.name,
+                                   int(size), checksum, duration, mtime,
+                                   marker)
+
+    def get_backup_entries(self, database=None, modified_before=None):
+        """
+        Returns the catalog entries of the backups of this provider,
+        most recent first.
+        """
+        return self.get_catalog().find(
+            formats=self.formats,
+            suffix=self.backup_suffix,
+            database=database,
+            modified_before=modified_before)
+
+    def verify_backup(self, backup_file):
+        """
+        Hash backup_file again, and compare with the checksum recorded
+        in the catalog when it was written.
+        """
+        backup_file = self.verify_backup_file(backup_file)
+        name = os.path.relpath(backup_file, self.backup_directory)
+        entry = self.get_catalog().get(name)
+        if not entry or not entry.checksum:
+            raise Exception(f"No checksum recorded for backup {name}.")
+        algorithm, _ = checksums.parse_checksum(entry.checksum)
+        if self._hash_backup(name, algorithm) != entry.checksum:
+            raise Exception(
+                f"Backup {name} is corrupted, its checksum does not match "
+                f"{entry.checksum}.")
+        print(f"OK\t{name}\t{entry.checksum}")
+
+    def scrub(self, jobs=DEFAULT_SCRUB_JOBS, rate_limit=None):
+        """
+        Check every backup of the catalog, with jobs threads: its size and
+        checksum must match the ones recorded when it was written, and
+        compressed backups must decompress without error (the output is
+        discarded). The file is read only once for both checks.
+        rate_limit is the maximum read rate in MiB/s, for all the threads.
+        Prints one line per backup: OK, CORRUPTED, MISSING or UNVERIFIED
+        (no checksum and nothing to decompress), the file and the details,
+        separated by tabs. Raises an exception if any backup is corrupted
+        or missing.
+        """
+        limiter = checksums.RateLimiter(
+            float(rate_limit) * 1024 * 1024) if rate_limit else None
+        jobs = max(int(jobs or DEFAULT_SCRUB_JOBS), 1)
+        failed = 0
+        with ThreadPoolExecutor(
+                max_workers=jobs, thread_name_prefix="scrub") as executor:
+            futures = [
+                executor.submit(self._scrub_backup, entry, limiter)
+                for entry in self.get_backup_entries()
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                if result.status in ("CORRUPTED", "MISSING"):
+                    failed += 1
+                print(f"{result.status}\t{result.filename}\t{result.detail}")
+        if failed:
+            raise Exception(
+                f"{failed} of {len(futures)} backup(s) are corrupted or "
+                "missing.")
+
+    def _scrub_backup(self, entry, limiter=None):
+        """
+        Returns the ScrubResult of the backup of entry. Read errors (for
+        instance EIO) make it CORRUPTED, they must not stop the scrub; any
+        other error is a bug, and is raised.
+        """
+        try:
+            return self._check_backup(entry, limiter)
+        except SCRUB_ERRORS as e:
+            return ScrubResult(entry.filename, "CORRUPTED", f"read error: {e}")
+
+    def _check_backup(self, entry, limiter=None):
+        path = Path(self.backup_directory + "/" + entry.filename)
+        try:
+            size = self.storage.get_size(entry.filename)
+        except FileNotFoundError:
+            return ScrubResult(entry.filename, "MISSING", "")
+        if size != entry.size:
+            return ScrubResult(entry.filename, "CORRUPTED",
+                               f"size {size} instead of {entry.size}")
+        # Encrypted backups are only decoded with their key, their checksum
+        # is checked anyway
+        encrypted = encryption.is_encrypted(entry.filename)
+        stream = None
+        if self.encryption or not encrypted:
+            stream = " ".join(
+                step for step in ("encrypted" if encrypted else None,
+                                  entry.codec) if step)
+        if path.is_dir() or not (entry.checksum or stream or
+                                 chunkstore.is_manifest(entry.filename)):
+            return ScrubResult(entry.filename, "UNVERIFIED", "no checksum")
+
+        if stream:
+            algorithm = (entry.checksum and checksums.parse_checksum(
+                entry.checksum)[0]) or checksums.DEFAULT_ALGORITHM
+            with self.storage.open_reader(entry.filename) as f:
+                reader = checksums.HashingReader(f, algorithm, limiter)
+                try:
+                    with self._open_decoded(
+                            reader, entry.filename, entry.codec
+                            and compression.get_codec(
+                                entry.codec)) as decoded:
+                        while decoded.read(SCRUB_READ_SIZE):
+                            pass
+                except Exception as e:
+                    return ScrubResult(entry.filename, "CORRUPTED",
+                                       f"{stream} stream: {e}")
+                reader.drain()
+            checksum = reader.checksum
+        else:
+            checksum = entry.checksum and self._hash_backup(
+                entry.filename,
+                checksums.parse_checksum(entry.checksum)[0], limiter)
+            if chunkstore.is_manifest(entry.filename):
+                try:
+                    with self.open_backup(str(path)) as reader:
+                        while reader.read(SCRUB_READ_SIZE):
+                            pass
+                except Exception as e:
+                    return ScrubResult(entry.filename, "CORRUPTED",
+                                       f"chunks: {e}")
+
+        if entry.checksum and checksum != entry.checksum:
+            return ScrubResult(entry.filename, "CORRUPTED",
+                               f"checksum {checksum} instead of "
+                               f"{entry.checksum}")
+        return ScrubResult(entry.filename, "OK", entry.checksum or
+                           f"{stream or 'chunks'} stream")
+
+    def _hash_backup(self, backup_file, algorithm, limiter=None):
+        """
+        Returns the checksum of backup_file (see checksums.hash_file).
+        Remote backups are hashed while they are downloaded.
+        """
+        if not self.storage.remote:
+            return checksums.hash_file(
+                Path(self.backup_directory, backup_file), algorithm, limiter)
+        with self.storage.open_reader(backup_file) as f:
+            reader = checksums.HashingReader(f, algorithm, limiter)
+            reader.drain()
+        return reader.checksum
+
+    def get_backup_codec(self, backup_file):
+        """
+        Returns the codec backup_file is compressed with, from the catalog,
+        or detected from the file if it is not indexed.
+        """
+        entry = self.get_catalog().get(
+            os.path.relpath(backup_file, self.backup_directory))
+        if entry:
+            return entry.codec and compression.get_codec(entry.codec)
+        if encryption.is_encrypted(backup_file):
+            # The content can't be read without decrypting it
+            return compression.codec_from_filename(
+                encryption.strip_extension(backup_file))
+        return compression.detect_codec(backup_file)
+
+    def _remove(self, backup_file):
+        for copy in self.copies:
+            try:
+                copy.delete(backup_file)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                _logger.warning(
+                    f"Could not remove the copy of {backup_file} "
+                    f"from {copy}: {e}")
+        return self.storage.delete(backup_file)
 
     def verify_backup_file(self, backup_file):
         backup_file_path = Path(backup_file)
@@ -51,7 +1080,8 @@ class AbstractProvider(abc.ABC):
             backup_file_path = Path(self.backup_directory) / backup_file
             backup_file_path = backup_file_path.resolve()
 
-        if not backup_file_path.exists():
+        if not self.storage.exists(
+                os.path.relpath(backup_file_path, self.backup_directory)):
             raise Exception(f"File {backup_file_path} does not exist.")
 
         try:
@@ -64,12 +1094,14 @@ class AbstractProvider(abc.ABC):
         return str(backup_file_path)
 
     def register_callback(self, callback):
-        self.callbacks.append(callback)
+        # Not appended, callbacks is shared by the providers until set
+        self.callbacks = self.callbacks + [callback]
 
     def notify_callbacks(self, event, *args, **kwargs):
         for callback in self.callbacks:
             try:
                 getattr(callback, event)(*args, **kwargs)
             except Exception as e:
-                _logger.warn(
-                    f"Could not call method {event} on callback {callback}", e)
+                _logger.warning(
+                    f"Could not call method {event} on callback {callback}: "
+                    f"{e}")
@@ -1,26 +1,36 @@
+import hashlib
 import logging
+import os
 from pathlib import Path
+import shutil
 import subprocess
-import os
 from datetime import datetime
 import re
-import tarfile
-import tempfile
-import shutil
-
-from dbbackup.providers import AbstractProvider
+import time
+from contextlib import ExitStack
+
+from dbbackup import (checksums, compression, scheduler, sqlsplit,
+                      tabledump)
+from dbbackup.providers import (AbstractProvider, DEFAULT_JOBS,
+                                DIRECTORY_EXTENSION)
+from dbbackup.streaming import run_from_file, run_to_file
 from dbbackup.tempbackupfile import TemporaryBackupFile
-from dbbackup.utils import get_file_size, sizeof_fmt
+from dbbackup.utils import get_file_size, sizeof_fmt, PARTIAL_SUFFIX
 
 _logger = logging.getLogger(__name__)
 DEFAULT_MYSQL_HOST = "127.0.0.1"
 DEFAULT_MYSQL_USER = "root"
 DEFAULT_MYSQL_BIN_DIRECTORY = "/usr/local/bin/"
 DEFAULT_COMPRESS = False
+DEFAULT_DUMP_JOBS = 1
 MYSQL_SYSTEM_DATABASES = ["performance_schema", "information_schema"]
+BATCH_ESCAPES = {"t": "\t", "n": "\n", "0": "\0"}
 
 
 class MySQL(AbstractProvider):
+    formats = (".sql", DIRECTORY_EXTENSION)
+    dialect = sqlsplit.MySQLDialect
+
     def __init__(self,
                  backup_directory,
                  host=DEFAULT_MYSQL_HOST,
@@ -28,14 +38,59 @@ class MySQL(AbstractProvider):
                  password=None,
                  backup_suffix=None,
                  mysql_bin_directory=DEFAULT_MYSQL_BIN_DIRECTORY,
-                 compress=DEFAULT_COMPRESS):
-        super().__init__(backup_directory)
+                 compress=DEFAULT_COMPRESS,
+                 temp_directory=None,
+                 compress_workers=compression.DEFAULT_COMPRESS_WORKERS,
+                 compress_block_size=compression.DEFAULT_COMPRESS_BLOCK_SIZE,
+                 compress_level=None,
+                 compress_seekable=False,
+                 checksum=checksums.DEFAULT_ALGORITHM,
+                 dedup=False,
+                 skip_unchanged=False,
+                 dump_jobs=DEFAULT_DUMP_JOBS,
+                 table_index=False,
+                 storage=None,
+                 copies=None,
+                 encryption=None):
+        super().__init__(backup_directory,
+                         temp_directory=temp_directory,
+                         storage=storage,
+                         copies=copies)
         self.host = host
         self.user = user
         self.password = password
         self.backup_suffix = backup_suffix
         self.mysql_bin_directory = mysql_bin_directory
         self.compress = compress
+        self.compress_workers = compress_workers
+        self.compress_block_size = compress_block_size
+        self.compress_level = compress_level
+        self.codec = compression.get_codec(compress) if compress else None
+        self.compress_seekable = compress_seekable
+        if compress_seekable and self.codec and not self.codec.seekable:
+            raise Exception(
+                f"{self.codec.name} compression can't be seekable "
+                f"(compress_seekable), use "
+                f"{' or '.join(compression.SEEKABLE_CODECS)}")
+        self.checksum = checksum
+        self.dedup = dedup
+        self.skip_unchanged = skip_unchanged
+        self.dump_jobs = max(int(dump_jobs or DEFAULT_DUMP_JOBS), 1)
+        self.table_index = table_index
+        self.encryption = encryption
+        if checksum:
+            checksums.get_hasher(checksum)
+        if self.dedup and self.dump_jobs > 1:
+            raise Exception(
+                "deduplicated backups (dedup) can't be dumped in parallel "
+                "(dump_jobs)")
+        if self.table_index and self.dump_jobs > 1:
+            raise Exception(
+                "table indexes (table_index) are written for single file "
+                "backups, parallel dumps (dump_jobs) have a file per table")
+        self.validate_storage(directory_backups=self.dump_jobs > 1)
+        self.validate_copies(directory_backups=self.dump_jobs > 1)
+        self.validate_encryption(directory_backups=self.dump_jobs > 1)
 
     def _get_default_command_args(self):
         args = ['-h', self.host, '-u', self.user]
@@ -43,7 +98,13 @@ class MySQL(AbstractProvider):
             args.append(f"-p{self.password}")
         return args
 
-    def execute_backup(self, database=None, exclude=None):
+    def execute_backup(self,
+                       database=None,
+                       exclude=None,
+                       jobs=DEFAULT_JOBS,
+                       plan=False,
+                       throughput=None,
+                       force=False):
         databases = self.get_databases()
 
         if database:
@@ -67,21 +128,31 @@ class MySQL(AbstractProvider):
         if exclude:
             databases = [db for db in databases if db not in exclude]
 
-        _logger.debug(f"Starting backup of databases: {databases}")
-        for database in databases:
-            filename = self.backup_database(database)
+        self.run_backups(databases,
+                         jobs,
+                         plan=plan,
+                         throughput=throughput,
+                         force=force)
+
+    def _run_backup(self, database):
+        filename = self.backup_database(database)
+        if self.storage.remote:
+            size = self.storage.get_size(self.get_backup_file(filename))
+        else:
             size = get_file_size(
                 str(
-                    Path(self.backup_directory + "/" + filename +
-                         (self.compress and ".gz" or "")).resolve()))
-            self.notify_callbacks('backup_done',
-                                  datetime.now().isoformat(), database,
-                                  filename, size)
-
-    def get_databases(self):
-        get_db_cmd = self._get_databases_command()
+                    Path(self.backup_directory + "/" +
+                         self.get_backup_file(filename)).resolve()))
+        return filename, size, self._checksums.pop(filename, None)
+
+    def get_databases(self, with_sizes=False):
+        get_db_cmd = self._get_databases_command(with_sizes)
         databases = subprocess.check_output(get_db_cmd).splitlines()
         databases = [database.decode('utf-8') for database in databases]
+        if with_sizes:
+            databases = [database.split("\t") for database in databases]
+            databases = [(database, int(float(size)))
+                         for database, size in databases]
         return databases
 
     def _get_command(self):
@@ -93,9 +164,20 @@ class MySQL(AbstractProvider):
         command += self._get_default_command_args()
         return command
 
-    def _get_databases_command(self):
+    def _get_databases_command(self, with_sizes=False):
         command = self._get_command()
-        command += ['--skip-column-names', '-e', 'SHOW DATABASES;']
+        if with_sizes:
+            command += [
+                '--skip-column-names', '--batch', '-e',
+                'SELECT s.SCHEMA_NAME, '
+                'COALESCE(SUM(t.DATA_LENGTH + t.INDEX_LENGTH), 0) '
+                'FROM information_schema.SCHEMATA s '
+                'LEFT JOIN information_schema.TABLES t '
+                'ON t.TABLE_SCHEMA = s.SCHEMA_NAME '
+                'GROUP BY s.SCHEMA_NAME;'
+            ]
+        else:
+            command += ['--skip-column-names', '-e', 'SHOW DATABASES;']
         _logger.debug(f"command: {command}")
         _logger.debug(f"command (str): {(' ').join(command)}")
         return command
@@ -103,19 +185,238 @@ class MySQL(AbstractProvider):
     def backup_database(self, database):
         _logger.info(f"Starting backup for database {database}")
         filename = self.construct_backup_filename(database)
-        with TemporaryBackupFile(filename, self.backup_directory,
-                                 self.compress) as temp_file:
+        if self.dedup:
+            filename = self._backup_to_chunk_store(database, filename)
+            _logger.info("Done")
+            return filename
+        if self.dump_jobs > 1:
+            filename = self._backup_database_tables(database, filename)
+            _logger.info("Done")
+            return filename
+        backup_file = TemporaryBackupFile(
+            filename,
+            self.backup_directory,
+            self.compress,
+            temp_directory=self.temp_directory,
+            compress_workers=self.compress_workers,
+            compress_block_size=self.compress_block_size,
+            compress_level=self.compress_level,
+            compress_seekable=self.compress_seekable,
+            checksum=self.checksum,
+            storage=self.remote_storage,
+            copies=self.copies,
+            encryption=self.encryption)
+        indexer = self._get_indexer()
+        with backup_file as temp_file:
             backup_cmd = self._get_backup_command(database)
             try:
-                subprocess.run(backup_cmd, check=True, stdout=temp_file)
+                run_to_file(
+                    backup_cmd,
+                    sqlsplit.IndexingWriter(temp_file, indexer)
+                    if indexer else temp_file)
             except subprocess.CalledProcessError as e:
                 raise Exception(
                     f"Could not backup database {database}: retcode {e.returncode} - stderr {e.stderr}."
                 )
+        self._checksums[filename] = backup_file.checksum
+        self._copy_errors[filename] = backup_file.copy_errors
+        self._write_table_index(filename, indexer)
         _logger.info("Done")
         return filename
 
-    def _get_backup_command(self, database):
+    def _backup_database_tables(self, database, filename):
+        """
+        Dump the tables of the database concurrently, with dump_jobs
+        mysqldump processes each dumping its share of the tables (largest
+        first, see scheduler.schedule), in one file per table of a directory
+        backup, listed by a manifest (see tabledump).
+        The views are dumped in a file of their own, by another mysqldump.
+        The dumps are consistent with each other: a global read lock is
+        held while they start their transactions, so that they all see the
+        same snapshot.
+        Returns the name of the backup directory.
+        """
+        filename = filename[:-len(".sql")] + DIRECTORY_EXTENSION
+        directory = str(Path(self.backup_directory + "/" + filename).resolve())
+        partial_directory = directory + PARTIAL_SUFFIX
+        if os.path.exists(partial_directory):
+            shutil.rmtree(partial_directory)
+        os.mkdir(partial_directory)
+        try:
+            tables, views = self._get_tables(database)
+            plan = scheduler.schedule(tables, self.dump_jobs)
+            indexes = {table: index for index, table in enumerate(plan.order)}
+            table_files = {}
+
+            def open_table(table):
+                if table not in indexes:
+                    raise Exception(f"Unexpected table {table} in the dump")
+                table_files[table] = TemporaryBackupFile(
+                    f"{indexes[table]:06d}.sql",
+                    partial_directory,
+                    self.compress,
+                    compress_level=self.compress_level,
+                    checksum=self.checksum)
+                return table_files[table]
+
+            dumpers = [
+                tabledump.TableDumper(
+                    self._get_backup_command(database, worker.databases),
+                    open_table) for worker in plan.workers
+                if worker.databases
+            ]
+            views_file = None
+            with ExitStack() as stack:
+                if views:
+                    views_file = TemporaryBackupFile(
+                        "views.sql",
+                        partial_directory,
+                        self.compress,
+                        compress_level=self.compress_level,
+                        checksum=self.checksum)
+                    dumpers.append(
+                        tabledump.TableDumper(
+                            self._get_backup_command(database, views),
+                            output=stack.enter_context(views_file)))
+                self._start_consistent_dumps(dumpers)
+                for dumper in dumpers:
+                    dumper.join()
+                errors = [dumper.error for dumper in dumpers if dumper.error]
+                if errors:
+                    raise errors[0]
+
+            files = [
+                tabledump.TableFile("table",
+                                    Path(table_files[table].path).name,
+                                    table_files[table].checksum, table)
+                for table in plan.order
+            ]
+            if views_file:
+                # Views depend on tables, they are restored last
+                files.append(
+                    tabledump.TableFile("views",
+                                        Path(views_file.path).name,
+                                        views_file.checksum, ""))
+            tabledump.write_manifest(partial_directory, self.codec, files)
+            os.replace(partial_directory, directory)
+            return filename
+        except subprocess.CalledProcessError as e:
+            raise Exception(
+                f"Could not backup database {database}: retcode "
+                f"{e.returncode} - stderr {e.stderr}.")
+        finally:
+            if os.path.exists(partial_directory):
+                shutil.rmtree(partial_directory)
+
+    def _start_consistent_dumps(self, dumpers):
+        """
+        Start the dumpers while holding a global read lock, released as soon
+        as they have all started their transactions (see
+        tabledump.TableDumper): no transaction can commit meanwhile, so their
+        snapshots are identical.
+        """
+        session = tabledump.ClientSession(self._get_command())
+        try:
+            session.execute("FLUSH TABLES WITH READ LOCK")
+            for dumper in dumpers:
+                dumper.start()
+            for dumper in dumpers:
+                dumper.started.wait()
+            session.execute("UNLOCK TABLES")
+        except Exception:
+            for dumper in dumpers:
+                dumper.terminate()
+            for dumper in dumpers:
+                if dumper.ident:
+                    dumper.join()
+            raise
+        finally:
+            session.close()
+
+    def _get_tables(self, database):
+        """
+        Returns a dict table -> size in bytes of the tables of database,
+        and the list of its views.
+        """
+        command = self._get_command()
+        command += [
+            '--skip-column-names', '--batch', '-e',
+            'SELECT TABLE_NAME, TABLE_TYPE, '
+            'COALESCE(DATA_LENGTH + INDEX_LENGTH, 0) '
+            'FROM information_schema.TABLES '
+            f"WHERE TABLE_SCHEMA = {quote_string(database)} "
+            'ORDER BY TABLE_NAME;'
+        ]
+        _logger.debug(f"command: {command}")
+        tables = {}
+        views = []
+        for line in subprocess.check_output(command).decode(
+                'utf-8').splitlines():
+            name, table_type, size = line.split("\t")
+            name = unescape_batch(name)
+            if table_type == "VIEW":
+                views.append(name)
+            else:
+                tables[name] = int(size)
+        return tables, views
+
+    def get_change_marker(self, database):
+        """
+        The marker is a hash of the creation and update times of the tables
+        of the database. InnoDB doesn't keep the update times across restarts,
+        the tables without one are checksummed with CHECKSUM TABLE, which
+        reads them. The update times only have a 1 second resolution, a
+        change made in the same second as the marker is read would not change
+        it: the tables updated in the last second are checksummed too (which
+        changes the marker of the next backup once they aren't anymore).
+        """
+        output = subprocess.check_output(
+            self._get_tables_status_command(database)).decode('utf-8')
+        status = ""
+        unknown = []
+        for line in output.splitlines():
+            name, table_type, _, _, update_time, recent = line.split("\t")
+            if table_type == "BASE TABLE" and (update_time == "NULL"
+                                               or recent == "1"):
+                unknown.append(unescape_batch(name))
+            # The recent flag changes by itself, it is not part of the marker
+            status += line.rsplit("\t", 1)[0] + "\n"
+        if unknown:
+            status += subprocess.check_output(
+                self._get_checksum_command(database, unknown)).decode('utf-8')
+        return hashlib.sha256(status.encode('utf-8')).hexdigest()
+
+    def _get_tables_status_command(self, database):
+        command = self._get_command()
+        command += [
+            '--skip-column-names', '--batch', '-e',
+            # MySQL 8 caches the update times for a day by default
+            '/*!80000 SET SESSION information_schema_stats_expiry = 0 */; '
+            'SELECT TABLE_NAME, TABLE_TYPE, ENGINE, CREATE_TIME, UPDATE_TIME, '
+            'UPDATE_TIME >= NOW() - INTERVAL 1 SECOND '
+            'FROM information_schema.TABLES '
+            f"WHERE TABLE_SCHEMA = {quote_string(database)} "
+            'ORDER BY TABLE_NAME;'
+        ]
+        _logger.debug(f"command: {command}")
+        return command
+
+    def _get_checksum_command(self, database, tables):
+        command = self._get_command()
+        command += [
+            '--skip-column-names', '--batch', '-e',
+            'CHECKSUM TABLE ' + ', '.join(
+                f"{quote_identifier(database)}.{quote_identifier(table)}"
+                for table in tables) + ';'
+        ]
+        _logger.debug(f"command: {command}")
+        return command
+
+    def _get_backup_command(self, database, tables=None):
+        """
+        Returns the mysqldump command dumping database, or only its given
+        tables in a single transaction.
+        """
         mysqldump_bin_path = Path(self.mysql_bin_directory + '/mysqldump')
         mysqldump_bin = str(mysqldump_bin_path.resolve())
         if not mysqldump_bin_path.exists():
@@ -123,10 +424,18 @@ class MySQL(AbstractProvider):
 
         backup_cmd = [mysqldump_bin]
         backup_cmd += self._get_default_command_args()
+        # Without the date of the dump, the dumps of a database that has not
+        # changed are identical, and linked (see _link_identical_backup)
+        backup_cmd.append("--skip-dump-date")
         # --databases add the CREATE DATABASE and USE <dbname> in the output
         #backup_cmd += ["--databases", f"{database}"]
         # To be able to restore using another database, do not use --databases
+        if tables:
+            # --verbose reports when the transaction has started (see
+            # tabledump.TableDumper)
+            backup_cmd += ["--verbose", "--single-transaction"]
         backup_cmd.append(database)
+        backup_cmd += tables or []
         _logger.debug(f"command: {backup_cmd}")
         _logger.debug(f"command (str): {(' ').join(backup_cmd)}")
         return backup_cmd
@@ -142,43 +451,38 @@ class MySQL(AbstractProvider):
     def list_backups(self):
         _logger.debug("Listing backups")
         _logger.info(f"Backup directory: {self.backup_directory}")
-        backup_files = self.get_backups()
-        for backup_file in backup_files:
-            self.display_backup(backup_file)
+        entries = self.get_backup_entries()
+        identical = self.get_identical_backups(entries)
+        for entry in entries:
+            self.display_backup(entry, identical.get(entry.filename))
 
-    def display_backup(self, backup_file):
-        size = get_file_size(
-            str(Path(self.backup_directory + "/" + backup_file).resolve()))
-        print(f"{backup_file}\t{sizeof_fmt(size)}")
+    def display_backup(self, entry, identical_to=None):
+        line = f"{entry.filename}\t{sizeof_fmt(entry.size)}"
+        if identical_to:
+            line += f"\t= {identical_to}"
+        print(line)
 
     def get_backups(self):
-        backup_files = [
-            a_file for a_file in os.listdir(self.backup_directory)
-            if self.is_backup(a_file)
-        ]
-        backup_files.sort(reverse=True)
-        return backup_files
+        return [entry.filename for entry in self.get_backup_entries()]
 
     def is_backup(self, a_file):
         file_name = Path(a_file).name
         return (
             re.search(r"^\d{8}_\d{6}.*", file_name)
-            and (file_name.endswith(".sql") or file_name.endswith(".gz")) and
+            and self.get_dump_name(file_name).endswith(self.formats) and
             (self.backup_suffix in file_name if self.backup_suffix else True))
 
-    def restore_backup(self, backup_file, database, recreate=None,
-                       create=None):
+    def restore_backup(self,
+                       backup_file,
+                       database,
+                       recreate=None,
+                       create=None,
+                       jobs=DEFAULT_JOBS,
+                       table=None):
         backup_file = self.verify_backup_file(backup_file)
-        tmpdir = None
         if not self.is_backup(backup_file):
             raise Exception(f"File {backup_file} is not a valid backup.")
 
-        if backup_file.endswith(".gz"):
-            tmpdir = tempfile.mkdtemp()
-            with tarfile.open(backup_file) as tf:
-                tf.extractall(path=tmpdir)
-            backup_file = Path(tmpdir) / Path(backup_file).name[:-3]
-
         if recreate:
             try:
                 self._drop_database(database)
@@ -196,11 +500,25 @@ class MySQL(AbstractProvider):
 
         command = self._get_restore_command()
         command += ["--database", database]
-        backup_file_fd = open(backup_file)
 
+        jobs = max(int(jobs or DEFAULT_JOBS), 1)
+        if Path(backup_file).is_dir():
+            return self._restore_tables(backup_file, database, command, jobs,
+                                        table)
+        if table:
+            return self._restore_table(backup_file, database, command, table)
+        jobs = self._get_split_jobs(backup_file, jobs)
+        if jobs > 1:
+            return self._restore_split(backup_file, database, command, jobs)
+
+        # The dump is decompressed (or reassembled, or downloaded) on the fly
+        # into mysql's stdin
+        stages = []
+        started = time.monotonic()
         try:
-            completed_proc = subprocess.run(
-                command, stdin=backup_file_fd, check=True, capture_output=True)
+            with self.open_backup(backup_file, stages) as backup_file_fd:
+                completed_proc = run_from_file(command, backup_file_fd)
+            self._log_throughput(backup_file, stages, started)
             _logger.debug(
                 f"Restore process retcode {completed_proc.returncode}")
         except subprocess.CalledProcessError as e:
@@ -208,11 +526,30 @@ class MySQL(AbstractProvider):
                 f"Could not restore database {database}: {e.output}, {e.stderr}"
             )
 
-        if tmpdir:
-            try:
-                shutil.rmtree(tmpdir)
-            except Exception:
-                _logger.warn(f"Could not delete temporary directory {tmpdir}")
+    def _restore_tables(self, directory, database, command, jobs,
+                        table=None):
+        """
+        Restore a directory backup (see _backup_database_tables), loading
+        jobs tables concurrently, largest first, then the views.
+        If table is given, only this table is restored.
+        """
+        codec_name, files = tabledump.read_manifest(directory)
+        codec = compression.get_codec(codec_name) if codec_name else None
+        if table:
+            files = [
+                file for file in files
+                if file.kind == "table" and file.name == table
+            ]
+            if not files:
+                raise Exception(f"Table {table} is not in the backup.")
+        tables = [(f"table {file.name}", Path(directory, file.filename))
+                  for file in files if file.kind == "table"]
+        _logger.info(f"Restoring {len(tables)} tables with {jobs} jobs")
+        self._load_files(database, command, tables, jobs, codec)
+        self._load_files(database, command,
+                         [(file.kind, Path(directory, file.filename))
+                          for file in files if file.kind != "table"],
+                         codec=codec)
 
     def _drop_database(self, database):
         drop_command = self._get_command()
@@ -231,3 +568,20 @@ class MySQL(AbstractProvider):
     def _get_restore_command(self):
         command = self._get_command()
         return command
+
+
+def quote_identifier(identifier):
+    return "`" + identifier.replace("`", "``") + "`"
+
+
+def quote_string(value):
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def unescape_batch(value):
+    """
+    Returns a value printed by the mysql client in batch mode, which escapes
+    backslashes, tabs, newlines and NUL characters.
+    """
+    return re.sub(r"\\(.)", lambda match: BATCH_ESCAPES.get(
+        match.group(1), match.group(1)), value)
@@ -7,10 +7,15 @@ import re
 import tarfile
 import tempfile
 import shutil
+import time
 
-from dbbackup.providers import AbstractProvider
+from dbbackup import (checksums, chunkstore, compression, encryption,
+                      sqlsplit)
+from dbbackup.providers import (AbstractProvider, DEFAULT_JOBS,
+                                DIRECTORY_EXTENSION)
+from dbbackup.streaming import run_from_file, run_to_file
 from dbbackup.tempbackupfile import TemporaryBackupFile
-from dbbackup.utils import get_file_size, sizeof_fmt
+from dbbackup.utils import get_file_size, sizeof_fmt, PARTIAL_SUFFIX
 
 _logger = logging.getLogger(__name__)
 DEFAULT_PSQL_HOST = "127.0.0.1"
@@ -19,6 +24,9 @@ DEFAULT_PSQL_USER = "postgres"
 DEFAULT_PSQL_BIN_DIRECTORY = "/usr/local/bin/"
 DEFAULT_EXCLUDE_DATABASES = []
 DEFAULT_BACKUP_TYPE = "c"  # c|d|t|p (custom, directory, tar, plain text)
+DEFAULT_COMPRESS = False
+DEFAULT_DUMP_JOBS = 1
+DEFAULT_PACK_DIRECTORY = False
 
 
 class Postgres(AbstractProvider):
@@ -27,29 +35,95 @@ class Postgres(AbstractProvider):
     Postgres environment variables will be respected,
     see https://www.postgresql.org/docs/9.3/libpq-envars.html
     """
+    formats = (DIRECTORY_EXTENSION + ".tar", ".sql", ".dump", ".tar",
+               DIRECTORY_EXTENSION)
+    dialect = sqlsplit.PostgresDialect
 
     def __init__(self,
                  backup_directory,
                  psql_bin_directory=DEFAULT_PSQL_BIN_DIRECTORY,
                  exclude_databases=DEFAULT_EXCLUDE_DATABASES,
                  backup_type=DEFAULT_BACKUP_TYPE,
-                 backup_suffix=None):
-        super().__init__(backup_directory)
+                 backup_suffix=None,
+                 compress=DEFAULT_COMPRESS,
+                 temp_directory=None,
+                 compress_workers=compression.DEFAULT_COMPRESS_WORKERS,
+                 compress_block_size=compression.DEFAULT_COMPRESS_BLOCK_SIZE,
+                 compress_level=None,
+                 compress_seekable=False,
+                 checksum=checksums.DEFAULT_ALGORITHM,
+                 dump_jobs=DEFAULT_DUMP_JOBS,
+                 pack_directory=DEFAULT_PACK_DIRECTORY,
+                 dedup=False,
+                 skip_unchanged=False,
+                 table_index=False,
+                 storage=None,
+                 copies=None,
+                 encryption=None):
+        super().__init__(backup_directory,
+                         temp_directory=temp_directory,
+                         storage=storage,
+                         copies=copies)
         self.psql_bin_directory = psql_bin_directory
         self.exclude_databases = exclude_databases
         self.backup_type = backup_type
         self.backup_suffix = backup_suffix
+        self.compress = compress
+        self.compress_workers = compress_workers
+        self.compress_block_size = compress_block_size
+        self.compress_level = compress_level
+        self.codec = compression.get_codec(compress) if compress else None
+        self.compress_seekable = compress_seekable
+        if compress_seekable and self.codec and not self.codec.seekable:
+            raise Exception(
+                f"{self.codec.name} compression can't be seekable "
+                f"(compress_seekable), use "
+                f"{' or '.join(compression.SEEKABLE_CODECS)}")
+        self.checksum = checksum
+        self.dedup = dedup
+        self.skip_unchanged = skip_unchanged
+        self.table_index = table_index
+        self.encryption = encryption
+        if checksum:
+            checksums.get_hasher(checksum)
+        self.dump_jobs = dump_jobs
+        self.pack_directory = pack_directory
         self.validate_config()
 
     def validate_config(self):
         if self.backup_type not in ('c', 'd', 't', 'p'):
             raise Exception(
                 "backup_type must be c, d, t or p (see pg_dump help)")
+        if self.dump_jobs > 1 and self.backup_type != 'd':
+            raise Exception("parallel dumps (dump_jobs) require the "
+                            "directory backup_type (d)")
+        if self.codec and self.backup_type == 'd' and not self.pack_directory:
+            raise Exception("directory backups can only be compressed when "
+                            "packed (pack_directory)")
+        if self.dedup and self.backup_type == 'd':
+            raise Exception("deduplicated backups (dedup) require a single "
+                            "file backup_type (p, c or t)")
+        if self.table_index and self.backup_type != 'p':
+            raise Exception(
+                "table indexes (table_index) require the plain backup_type (p)"
+            )
+        self.validate_storage(directory_backups=self.backup_type == 'd'
+                              and not self.pack_directory)
+        self.validate_copies(directory_backups=self.backup_type == 'd'
+                             and not self.pack_directory)
+        # Packed directories are unpacked to disk to be restored
+        self.validate_encryption(directory_backups=self.backup_type == 'd')
 
     def _get_default_command_args(self):
         return []
 
-    def execute_backup(self, database=None, exclude=None):
+    def execute_backup(self,
+                       database=None,
+                       exclude=None,
+                       jobs=DEFAULT_JOBS,
+                       plan=False,
+                       throughput=None,
+                       force=False):
         databases = self.get_databases()
 
         if database:
@@ -61,27 +135,47 @@ class Postgres(AbstractProvider):
         if exclude:
             databases = [db for db in databases if db not in exclude]
 
-        _logger.debug(f"Starting backup of databases: {databases}")
-        for database in databases:
-            filename = self.backup_database(database)
+        self.run_backups(databases,
+                         jobs,
+                         plan=plan,
+                         throughput=throughput,
+                         force=force)
+
+    def _run_backup(self, database):
+        filename = self.backup_database(database)
+        if self.storage.remote:
+            size = self.storage.get_size(self.get_backup_file(filename))
+        else:
             size = get_file_size(
-                str(Path(self.backup_directory + "/" + filename).resolve()))
-            self.notify_callbacks('backup_done',
-                                  datetime.now().isoformat(), database,
-                                  filename, size)
+                str(
+                    Path(self.backup_directory + "/" +
+                         self.get_backup_file(filename)).resolve()))
+        return filename, size, self._checksums.pop(filename, None)
 
-    def get_databases(self):
-        get_db_cmd = self._get_databases_command()
+    def get_databases(self, with_sizes=False):
+        get_db_cmd = self._get_databases_command(with_sizes)
         databases = subprocess.check_output(get_db_cmd).splitlines()
         databases = [database.decode('utf-8') for database in databases]
+        if with_sizes:
+            databases = [database.split("\t") for database in databases]
+            databases = [(database, int(float(size)))
+                         for database, size in databases]
         return databases
 
-    def _get_databases_command(self):
+    def _get_databases_command(self, with_sizes=False):
         command = self._get_command()
-        command += [
-            '-At', '-c',
-            'select datname from pg_database where not datistemplate and datallowconn order by datname;'
-        ]
+        if with_sizes:
+            command += [
+                '-At', '-F', '\t', '-c',
+                'select datname, pg_database_size(datname) from pg_database '
+                'where not datistemplate and datallowconn order by datname;'
+            ]
+        else:
+            command += [
+                '-At', '-c',
+                'select datname from pg_database '
+                'where not datistemplate and datallowconn order by datname;'
+            ]
         _logger.debug(f"command: {command}")
         _logger.debug(f"command (str): {(' ').join(command)}")
         return command
@@ -95,21 +189,127 @@ class Postgres(AbstractProvider):
         command += self._get_default_command_args()
         return command
 
+    def get_change_marker(self, database):
+        """
+        The marker is made of the current WAL position and the tuples
+        inserted, updated and deleted in the database since its statistics
+        were reset (the transactions are not counted, pg_dump runs some). The
+        statistics are only sent at the end of the transactions, so they alone
+        could miss a change committed just before the marker is read; the WAL
+        position can't, but it changes whenever any database of the cluster
+        is written to, so a busy cluster rarely skips a backup. The statistics
+        of a standby don't count the replicated changes, its marker is the
+        replayed WAL position.
+        """
+        command = self._get_command()
+        command += [
+            '-d', database, '-At', '-c',
+            "select case when pg_is_in_recovery() "
+            "then pg_last_wal_replay_lsn()::text "
+            "else concat_ws(':', pg_current_wal_lsn(), tup_inserted, "
+            "tup_updated, tup_deleted, stats_reset) end "
+            "from pg_stat_database where datname = current_database();"
+        ]
+        _logger.debug(f"command: {command}")
+        marker = subprocess.check_output(command).decode('utf-8').strip()
+        return marker or None
+
     def backup_database(self, database):
         _logger.info(f"Starting backup for database {database}")
         filename = self.construct_backup_filename(database)
-        with TemporaryBackupFile(filename, self.backup_directory) as temp_file:
+        if self.dedup:
+            filename = self._backup_to_chunk_store(database, filename)
+            _logger.info("Done")
+            return filename
+        if self.backup_type == 'd':
+            filename = self._backup_database_directory(database, filename)
+            _logger.info("Done")
+            return filename
+
+        backup_file = TemporaryBackupFile(
+            filename,
+            self.backup_directory,
+            self.compress,
+            temp_directory=self.temp_directory,
+            compress_workers=self.compress_workers,
+            compress_block_size=self.compress_block_size,
+            compress_level=self.compress_level,
+            compress_seekable=self.compress_seekable,
+            checksum=self.checksum,
+            storage=self.remote_storage,
+            copies=self.copies,
+            encryption=self.encryption,
+            # pg_dump seeks in custom archives to record the offsets of the
+            # data, which pg_restore --jobs and --table use
+            direct=self.backup_type == 'c')
+        indexer = self._get_indexer()
+        with backup_file as temp_file:
             backup_cmd = self._get_backup_command(database)
             try:
-                subprocess.run(backup_cmd, check=True, stdout=temp_file)
+                run_to_file(
+                    backup_cmd,
+                    sqlsplit.IndexingWriter(temp_file, indexer)
+                    if indexer else temp_file)
             except subprocess.CalledProcessError as e:
                 raise Exception(
                     f"Could not backup database {database}: retcode {e.returncode} - stderr {e.stderr}."
                 )
+        self._checksums[filename] = backup_file.checksum
+        self._copy_errors[filename] = backup_file.copy_errors
+        self._write_table_index(filename, indexer)
         _logger.info("Done")
         return filename
 
-    def _get_backup_command(self, database):
+    def _backup_database_directory(self, database, filename):
+        """
+        Dump the database in directory format (the only one supporting
+        parallel dumps) to a partial directory, then rename it, or pack it
+        in a (compressed) tar file if pack_directory is set.
+        Returns the name of the backup.
+        """
+        directory = str(Path(self.backup_directory + "/" + filename).resolve())
+        partial_directory = directory + PARTIAL_SUFFIX
+        if os.path.exists(partial_directory):
+            shutil.rmtree(partial_directory)
+        backup_cmd = self._get_backup_command(
+            database, output=partial_directory)
+        try:
+            subprocess.run(backup_cmd, check=True, stderr=subprocess.PIPE)
+            if not self.pack_directory:
+                os.replace(partial_directory, directory)
+                return filename
+
+            filename += ".tar"
+            backup_file = TemporaryBackupFile(
+                filename,
+                self.backup_directory,
+                self.compress,
+                temp_directory=self.temp_directory,
+                compress_workers=self.compress_workers,
+                compress_block_size=self.compress_block_size,
+                compress_level=self.compress_level,
+                compress_seekable=self.compress_seekable,
+                checksum=self.checksum,
+                storage=self.remote_storage,
+                copies=self.copies,
+                encryption=self.encryption)
+            with backup_file as temp_file:
+                # Stream mode, so that the tar file is written in one pass
+                with tarfile.open(fileobj=temp_file, mode="w|") as tar:
+                    tar.add(
+                        partial_directory, arcname=Path(directory).name)
+            self._checksums[filename] = backup_file.checksum
+            self._copy_errors[filename] = backup_file.copy_errors
+            return filename
+        except subprocess.CalledProcessError as e:
+            raise Exception(
+                f"Could not backup database {database}: retcode "
+                f"{e.returncode} - stderr {e.stderr}.")
+        finally:
+            if os.path.exists(partial_directory):
+                shutil.rmtree(partial_directory)
+
+    def _get_backup_command(self, database, output=None):
         pg_dump_bin_path = Path(self.psql_bin_directory + '/pg_dump')
         pg_dump_bin = str(pg_dump_bin_path.resolve())
         if not pg_dump_bin_path.exists():
@@ -118,6 +318,10 @@ class Postgres(AbstractProvider):
         backup_cmd = [pg_dump_bin]
         backup_cmd += self._get_default_command_args()
         backup_cmd.append(f"-F{self.backup_type}")
+        if self.dump_jobs > 1:
+            backup_cmd.append(f"--jobs={self.dump_jobs}")
+        if output:
+            backup_cmd += ["-f", output]
         backup_cmd.append(database)
         _logger.debug(f"command: {backup_cmd}")
         _logger.debug(f"command (str): {(' ').join(backup_cmd)}")
@@ -139,49 +343,62 @@ class Postgres(AbstractProvider):
             return ".dump"
         if self.backup_type == 't':
             return ".tar"
+        if self.backup_type == 'd':
+            return DIRECTORY_EXTENSION
 
     def list_backups(self):
         _logger.debug("Listing backups")
         _logger.info(f"Backup directory: {self.backup_directory}")
-        backup_files = self.get_backups()
-        for backup_file in backup_files:
-            self.display_backup(backup_file)
+        entries = self.get_backup_entries()
+        identical = self.get_identical_backups(entries)
+        for entry in entries:
+            self.display_backup(entry, identical.get(entry.filename))
 
-    def display_backup(self, backup_file):
-        size = os.stat(
-            str(Path(self.backup_directory + "/" +
-                     backup_file).resolve())).st_size
-        print(f"{backup_file}\t{sizeof_fmt(size)}")
+    def display_backup(self, entry, identical_to=None):
+        line = f"{entry.filename}\t{sizeof_fmt(entry.size)}"
+        if identical_to:
+            line += f"\t= {identical_to}"
+        print(line)
 
     def get_backups(self):
-        backup_files = [
-            a_file for a_file in os.listdir(self.backup_directory)
-            if self.is_backup(a_file)
-        ]
-        backup_files.sort(reverse=True)
-        return backup_files
+        return [entry.filename for entry in self.get_backup_entries()]
 
     def is_backup(self, a_file):
         file_name = Path(a_file).name
+        dump_name = self.get_dump_name(file_name)
         return (
             re.search(r"^\d{8}_\d{6}.*", file_name)
-            and (file_name.endswith(".sql") or file_name.endswith(".tar")
-                 or file_name.endswith(".dump")) and
+            and (dump_name.endswith(".sql") or dump_name.endswith(".tar")
+                 or dump_name.endswith(".dump")
+                 or dump_name.endswith(DIRECTORY_EXTENSION)) and
             (self.backup_suffix in file_name if self.backup_suffix else True))
 
-    def restore_backup(self, backup_file, database, recreate=None,
-                       create=None):
+    def restore_backup(self,
+                       backup_file,
+                       database,
+                       recreate=None,
+                       create=None,
+                       jobs=DEFAULT_JOBS,
+                       table=None):
         backup_file = self.verify_backup_file(backup_file)
 
         tmpdir = None
         if not self.is_backup(backup_file):
             raise Exception(f"File {backup_file} is not a valid backup.")
 
-        if backup_file.endswith(".gz"):
-            tmpdir = tempfile.mkdtemp()
-            with tarfile.open(backup_file) as tf:
-                tf.extractall(path=tmpdir)
-            backup_file = Path(tmpdir) / Path(backup_file).name[:-3]
+        codec = self.get_backup_codec(backup_file)
+        dump_name = self.get_dump_name(Path(backup_file).name)
+        if dump_name.endswith(DIRECTORY_EXTENSION + ".tar"):
+            if encryption.is_encrypted(backup_file):
+                raise Exception(
+                    f"Backup {Path(backup_file).name} is an encrypted packed "
+                    "directory, it can't be restored without writing it "
+                    "decrypted to disk (pg_restore needs a directory).")
+            # pg_restore needs a directory, the archive is decompressed
+            # and extracted in a single pass
+            tmpdir = tempfile.mkdtemp(dir=self.temp_directory)
+            backup_file = self._unpack_directory(backup_file, tmpdir)
+            codec = None
 
         if recreate:
             try:
@@ -198,25 +415,95 @@ class Postgres(AbstractProvider):
                 raise Exception(
                     f"Could not create database {database}: {e.output}")
 
-        command = self._get_restore_command()
+        if dump_name.endswith(".sql"):
+            command = self._get_plain_restore_command()
+            jobs = self._get_split_jobs(backup_file, jobs)
+        else:
+            jobs = self._get_restore_jobs(backup_file, jobs)
+            command = self._get_restore_command(jobs)
+            if table:
+                # pg_restore restores the definition and data of the table
+                schema, _, name = table.rpartition(".")
+                if schema:
+                    command.append(f"--schema={schema}")
+                command.append(f"--table={name}")
         command += ["-d", database]
-        command.append(backup_file)
 
         try:
-            completed_proc = subprocess.run(
-                command, check=True, capture_output=True)
+            if dump_name.endswith(".sql") and table:
+                return self._restore_table(backup_file, database, command,
+                                           table)
+            if dump_name.endswith(".sql") and jobs > 1:
+                # psql loads a single script, the dump is split to load the
+                # data of its tables in concurrent sessions
+                return self._restore_split(backup_file, database, command,
+                                           jobs)
+            if (codec or dump_name.endswith(".sql")
+                    or chunkstore.is_manifest(backup_file)
+                    or encryption.is_encrypted(backup_file)
+                    or (self.storage.remote and not tmpdir)):
+                # Plain dumps are loaded by psql, and compressed,
+                # deduplicated, encrypted or remote archives are read by
+                # pg_restore from its stdin, as they are decoded (or
+                # downloaded)
+                stages = []
+                started = time.monotonic()
+                with self.open_backup(backup_file, stages) as backup_file_fd:
+                    completed_proc = run_from_file(command, backup_file_fd)
+                self._log_throughput(backup_file, stages, started)
+            else:
+                command.append(str(backup_file))
+                completed_proc = subprocess.run(
+                    command, check=True, capture_output=True)
             _logger.debug(
                 f"Restore process retcode {completed_proc.returncode}")
         except subprocess.CalledProcessError as e:
             raise Exception(
                 f"Could not restore database {database}: {e.output}, {e.stderr}"
             )
-
-        if tmpdir:
-            try:
-                shutil.rmtree(tmpdir)
-            except Exception:
-                _logger.warn(f"Could not delete temporary directory {tmpdir}")
+        finally:
+            if tmpdir:
+                try:
+                    shutil.rmtree(tmpdir)
+                except Exception:
+                    _logger.warn(
+                        f"Could not delete temporary directory {tmpdir}")
+
+    def _get_restore_jobs(self, backup_file, jobs):
+        """
+        pg_restore can only load data and build indexes in parallel for
+        custom and directory archives, read from an uncompressed file.
+        Returns the number of jobs to use for backup_file.
+        """
+        jobs = max(int(jobs or DEFAULT_JOBS), 1)
+        if jobs == 1:
+            return jobs
+        if self._is_parallel_restorable(backup_file):
+            return jobs
+        _logger.warning(
+            f"pg_restore can only restore custom (.dump) and directory (.dir) "
+            f"backups in parallel from uncompressed files, "
+            f"restoring {Path(backup_file).name} "
+            f"with a single job.")
+        return 1
+
+    def _is_parallel_restorable(self, backup_file):
+        backup_path = Path(backup_file)
+        if backup_path.is_dir():
+            return True
+        return (backup_path.is_file() and backup_path.name.endswith(".dump"))
+
+    def _unpack_directory(self, backup_file, directory):
+        """
+        Extract a packed directory backup, decompressing it on the fly,
+        and returns the path of the directory.
+        """
+        _logger.debug(f"Extracting directory backup {backup_file}")
+        with self.open_backup(backup_file) as f, \
+                tarfile.open(fileobj=f, mode="r|") as tf:
+            tf.extractall(path=directory)
+        dump_name = self.get_dump_name(Path(backup_file).name)
+        return Path(directory) / dump_name[:-len(".tar")]
 
     def _drop_database(self, database):
         command = self._get_command()
@@ -234,7 +521,17 @@ class Postgres(AbstractProvider):
             create_command, stderr=subprocess.STDOUT)
         _logger.debug(f"create process output {output}")
 
-    def _get_restore_command(self):
+    def _get_plain_restore_command(self):
+        """
+        Plain text dumps are SQL scripts, loaded with psql (pg_restore
+        rejects them). The restore stops at the first error, like pg_restore.
+        """
+        restore_cmd = self._get_command()
+        restore_cmd += ["--no-psqlrc", "--quiet", "-v", "ON_ERROR_STOP=1"]
+        _logger.debug(f"command: {restore_cmd}")
+        return restore_cmd
+
+    def _get_restore_command(self, jobs=DEFAULT_JOBS):
         pg_restore_bin_path = Path(self.psql_bin_directory + '/pg_restore')
         pg_restore_bin = str(pg_restore_bin_path.resolve())
         if not pg_restore_bin_path.exists():
@@ -243,6 +540,8 @@ class Postgres(AbstractProvider):
         restore_cmd = [pg_restore_bin]
         restore_cmd += self._get_default_command_args()
         restore_cmd.append("--exit-on-error")
+        if jobs > 1:
+            restore_cmd.append(f"--jobs={jobs}")
         _logger.debug(f"command: {restore_cmd}")
         _logger.debug(f"command (str): {(' ').join(restore_cmd)}")
         return restore_cmd
@@ -0,0 +1,78 @@
+import collections
+from datetime import datetime
+
+TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S"
+# Period of a backup for each tier, the most recent backup of each period
+# is kept
+TIERS = collections.OrderedDict([
+    ("hourly", lambda time: (time.year, time.month, time.day, time.hour)),
+    ("daily", lambda time: (time.year, time.month, time.day)),
+    ("weekly", lambda time: tuple(time.isocalendar()[:2])),
+    ("monthly", lambda time: (time.year, time.month)),
+    ("yearly", lambda time: time.year),
+])
+
+Decision = collections.namedtuple("Decision", ["name", "time", "tiers"])
+
+
+def parse_policy(value):
+    """
+    Parse a retention policy such as "hourly=24,daily=14,weekly=8,monthly=12"
+    (tiers can be omitted), and returns an OrderedDict tier -> count.
+    """
+    policy = collections.OrderedDict()
+    for item in str(value or "").split(","):
+        if not item.strip():
+            continue
+        tier, _, count = item.partition("=")
+        tier = tier.strip()
+        if tier not in TIERS:
+            raise Exception(f"Unknown retention tier {tier}, "
+                            f"must be one of {', '.join(TIERS)}.")
+        try:
+            policy[tier] = int(count)
+        except ValueError:
+            raise Exception(
+                f"Invalid retention count {count!r} for tier {tier}.")
+        if policy[tier] < 0:
+            raise Exception(
+                f"Invalid retention count {count!r} for tier {tier}.")
+    if not any(policy.values()):
+        raise Exception(
+            "The retention policy must keep at least one backup, "
+            "for instance hourly=24,daily=14,weekly=8,monthly=12.")
+    return policy
+
+
+def parse_timestamp(timestamp):
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+
+
+def select(backups, policy):
+    """
+    Apply a grandfather-father-son retention policy to one series of backups,
+    given as (name, datetime) tuples.
+    For each tier, the most recent backup of each of the count most recent
+    periods (hours, days...) having a backup is kept, so a single backup
+    can be kept by several tiers.
+    Returns a Decision for each backup, most recent first, with the tiers
+    keeping it (none if it should be deleted), in O(n log n).
+    """
+    ordered = sorted(backups, key=lambda backup: backup[1], reverse=True)
+    tiers = [[] for _ in ordered]
+    for tier, count in policy.items():
+        period = TIERS[tier]
+        periods = 0
+        last_period = None
+        for index, (_, time) in enumerate(ordered):
+            if periods >= count:
+                break
+            current_period = period(time)
+            if current_period != last_period:
+                tiers[index].append(tier)
+                last_period = current_period
+                periods += 1
+    return [
+        Decision(name, time, tuple(backup_tiers))
+        for (name, time), backup_tiers in zip(ordered, tiers)
+    ]
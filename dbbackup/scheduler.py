@@ -0,0 +1,33 @@
+import collections
+import heapq
+
+Plan = collections.namedtuple("Plan", ["order", "workers", "makespan"])
+WorkerPlan = collections.namedtuple("WorkerPlan", ["load", "databases"])
+
+
+def schedule(sizes, workers):
+    """
+    Plan the backup of the databases on workers, longest processing time first:
+    databases are sorted by decreasing size, and each one is given to the
+    least loaded worker.
+    This is what happens when the sorted databases are submitted to a pool
+    of workers, assuming the dump time is proportional to the database size.
+    sizes is a dict database -> size.
+    Returns a Plan, with the order in which to submit the databases,
+    the databases of each worker, and the predicted makespan (the load of
+    the most loaded worker), in O(n log n).
+    """
+    workers = max(int(workers), 1)
+    order = sorted(sizes, key=lambda database: (-sizes[database], database))
+    heap = [(0, worker) for worker in range(workers)]
+    assignments = [[] for _ in range(workers)]
+    loads = [0] * workers
+    for database in order:
+        load, worker = heapq.heappop(heap)
+        assignments[worker].append(database)
+        loads[worker] = load + sizes[database]
+        heapq.heappush(heap, (loads[worker], worker))
+    return Plan(order, [
+        WorkerPlan(loads[worker], assignments[worker])
+        for worker in range(workers)
+    ], max(loads))
@@ -0,0 +1,421 @@
+import collections
+import io
+import logging
+import os
+import re
+from pathlib import Path
+
+from dbbackup import tabledump
+from dbbackup.utils import PARTIAL_SUFFIX
+
+_logger = logging.getLogger(__name__)
+SCHEMA = "schema"
+DATA = "data"
+POST_DATA = "post-data"
+# Extension of the table index written next to a backup
+INDEX_EXTENSION = ".idx"
+INDEX_HEADER = "dbbackup-index"
+INDEX_VERSION = "1"
+SKIP_SIZE = 1024 * 1024
+
+# A section of a split dump: its phase, name (the table for data sections)
+# and the path and size of the file it was written to
+Section = collections.namedtuple("Section", ["phase", "name", "path", "size"])
+# A section of a dump in its table index: the offset where it starts in the
+# uncompressed dump, its phase and table ("" if it belongs to none)
+IndexEntry = collections.namedtuple("IndexEntry", ["offset", "phase", "table"])
+# The table index of a dump: its uncompressed size and its sections
+TableIndex = collections.namedtuple("TableIndex", ["size", "sections"])
+
+
+class MySQLDialect:
+    """
+    Finds the sections of a mysqldump output, from the comments
+    starting them. Each table's structure goes in the schema phase, its
+    data (and triggers) in its own data section, and the views (which can
+    depend on any table), routines and events in the post-data phase.
+    String values can't contain newlines (they are escaped), so a line
+    starting with one of these comments is always one.
+    The GTID_PURGED statement can only be run once, it starts a schema
+    section of its own, so that it is not part of the header.
+    """
+    # (prefix, phase, whether the quoted name is a table)
+    MARKERS = (
+        (tabledump.TABLE_HEADER, SCHEMA, True),
+        (b"-- Temporary view structure for view ", SCHEMA, False),
+        (b"-- Temporary table structure for view ", SCHEMA, False),
+        (b"-- Dumping data for table ", DATA, True),
+        (b"-- Final view structure for view ", POST_DATA, False),
+        (b"-- Dumping routines for database ", POST_DATA, False),
+        (b"-- Dumping events for database ", POST_DATA, False),
+    )
+    # The only lines classify needs to see (see SectionIndexer)
+    CANDIDATES = re.compile(
+        rb"^(?:-- |" + re.escape(tabledump.GTID_PURGED_STATEMENT) + rb")",
+        re.MULTILINE)
+
+    def classify(self, line):
+        """
+        Returns the (phase, table) of the section started by line (table
+        is "" for the sections not belonging to a table), or None if it
+        does not start one.
+        """
+        if line.startswith(tabledump.GTID_PURGED_STATEMENT):
+            return SCHEMA, ""
+        if not line.startswith(b"-- "):
+            return None
+        for prefix, phase, is_table in self.MARKERS:
+            if line.startswith(prefix):
+                if not is_table:
+                    return phase, ""
+                quoted = line[len(prefix):].rstrip(b"\r\n").decode('utf-8')
+                return phase, quoted[1:-1].replace("``", "`")
+        return None
+
+    def get_owner(self, name):
+        """
+        Returns the table a section named name by classify belongs to.
+        """
+        return name
+
+
+class PostgresDialect:
+    """
+    Finds the sections of a plain text pg_dump output, from the comment
+    preceding each object ("-- Name: x; Type: y; Schema: z; ...").
+    pg_dump writes the pre-data objects first, then the data, then the
+    post-data objects (constraints, indexes, triggers...), which can only
+    be created once the data is loaded. The data of each table is a data
+    section, the other data (sequence values, large objects) are loaded
+    together. Lines of COPY data are never taken for comments.
+    Tables are named schema.table, their constraints and column defaults
+    belong to them, and so do the sequences they own (serial and identity
+    columns): the sequences are named after themselves by classify, and
+    get_owner returns their table once their owner was found.
+    """
+    ENTRY = re.compile(
+        rb"^-- (Data for )?Name: (.*); Type: (.*); Schema: (.*); Owner")
+    DATA_TYPES = (b"TABLE DATA", b"SEQUENCE SET", b"BLOB", b"BLOBS",
+                  b"BLOB DATA", b"LARGE OBJECT")
+    TABLE_TYPES = (b"TABLE", b"TABLE DATA")
+    # Named "table constraint" or "table column"
+    TABLE_OBJECT_TYPES = (b"CONSTRAINT", b"FK CONSTRAINT", b"DEFAULT")
+    SEQUENCE_TYPES = (b"SEQUENCE", b"SEQUENCE OWNED BY", b"SEQUENCE SET")
+    NAME = rb'(?:"(?:[^"]|"")*"|[^".\s]+)'
+    QUALIFIED_NAME = NAME + rb"(?:\." + NAME + rb")*"
+    # Statements giving the owner of a sequence: serial columns, then
+    # identity columns
+    OWNED_BY = re.compile(rb"^ALTER SEQUENCE " + QUALIFIED_NAME
+                          + rb" OWNED BY (" + QUALIFIED_NAME + rb");")
+    IDENTITY = re.compile(rb"^ALTER TABLE (?:ONLY )?(" + QUALIFIED_NAME
+                          + rb") ALTER COLUMN " + NAME + rb" ADD GENERATED ")
+    COPY_END = b"\\.\n"
+    CANDIDATES = re.compile(
+        rb"^(?:-- |COPY |\\\.$|ALTER SEQUENCE |ALTER TABLE )", re.MULTILINE)
+
+    def __init__(self):
+        self._copying = False
+        self._data_seen = False
+        # Type and name of the current entry
+        self._entry = (None, "")
+        # Owner table of each sequence ("" if it has none)
+        self._sequences = {}
+
+    def classify(self, line):
+        if self._copying:
+            if line == self.COPY_END:
+                self._copying = False
+            return None
+        if line.startswith(b"COPY ") and line.rstrip().endswith(
+                b"FROM stdin;"):
+            self._copying = True
+            return None
+        match = self.ENTRY.match(line)
+        if not match:
+            self._find_owner(line)
+            return None
+        _, name, object_type, schema = match.groups()
+        qualified = f"{schema.decode('utf-8')}.{name.decode('utf-8')}"
+        self._entry = (object_type, qualified)
+        table = ""
+        if object_type in self.TABLE_TYPES:
+            table = qualified
+        elif object_type in self.TABLE_OBJECT_TYPES:
+            table = qualified.split(" ")[0]
+        elif object_type in self.SEQUENCE_TYPES:
+            self._sequences.setdefault(qualified, "")
+            table = qualified
+        if object_type in self.DATA_TYPES:
+            self._data_seen = True
+            return DATA, table
+        return (POST_DATA if self._data_seen else SCHEMA), table
+
+    def _find_owner(self, line):
+        object_type, sequence = self._entry
+        if object_type not in (b"SEQUENCE", b"SEQUENCE OWNED BY"):
+            return
+        match = self.OWNED_BY.match(line)
+        if match:
+            # schema.table.column
+            parts = _parse_name(match.group(1))[:-1]
+        else:
+            match = self.IDENTITY.match(line)
+            if not match:
+                return
+            parts = _parse_name(match.group(1))
+        if len(parts) == 1:
+            parts.insert(0, sequence.split(".")[0])
+        self._sequences[sequence] = ".".join(parts)
+
+    def get_owner(self, name):
+        """
+        Returns the table a section named name by classify belongs to: the
+        owner of a sequence ("" if it has none), or name itself.
+        """
+        return self._sequences.get(name, name)
+
+
+def _parse_name(name):
+    """
+    Returns the parts of a (possibly quoted) qualified name.
+    """
+    return [
+        part[1:-1].replace('""', '"') if part.startswith('"') else part
+        for part in (part.decode('utf-8')
+                     for part in re.findall(PostgresDialect.NAME, name))
+    ]
+
+
+def split_dump(stream, dialect, directory):
+    """
+    Split a plain SQL dump (a binary file object) in sections, in one pass:
+    the schema (all the objects to create before loading the data), one
+    data section per table, and the post-data (the objects to create once
+    all the data is loaded). dialect finds where the sections start.
+    Each section is written to a file of directory, starting with the
+    header of the dump (its session settings, before the first section),
+    so that the sections can be loaded by separate sessions, the data
+    sections concurrently.
+    Returns the lists of schema, data and post-data Sections (the schema
+    holds the whole dump if no section was found).
+    """
+    header = []
+    sections = collections.OrderedDict()
+    current = None
+    try:
+        for line in stream:
+            marker = dialect.classify(line)
+            if marker:
+                phase, name = marker
+                key = (phase, dialect.get_owner(name) if phase == DATA else "")
+                if key not in sections:
+                    path = Path(directory, f"{len(sections):06d}.sql")
+                    sections[key] = open(path, 'wb')
+                    sections[key].write(b"".join(header))
+                current = sections[key]
+            if current is None:
+                header.append(line)
+            else:
+                current.write(line)
+        if not sections:
+            path = Path(directory, "000000.sql")
+            sections[(SCHEMA, "")] = open(path, 'wb')
+            sections[(SCHEMA, "")].write(b"".join(header))
+    finally:
+        for f in sections.values():
+            f.close()
+    result = {SCHEMA: [], DATA: [], POST_DATA: []}
+    for (phase, name), f in sections.items():
+        result[phase].append(
+            Section(phase, name, f.name, Path(f.name).stat().st_size))
+    _logger.debug(f"Split the dump in {len(result[DATA])} data sections")
+    return result[SCHEMA], result[DATA], result[POST_DATA]
+
+
+class SectionIndexer:
+    """
+    Finds the sections of a dump fed to it in blocks (see feed), recording
+    the offset where each one starts, without splitting the dump in lines:
+    only the lines matching the CANDIDATES of the dialect are classified.
+    """
+    # Longest prefix of the candidate lines
+    CANDIDATE_LENGTH = 32
+
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.sections = []
+        self.size = 0
+        # Start of the last line, if it may be a candidate
+        self._pending = b""
+        # Whether the rest of the last line is not a candidate
+        self._skipping = False
+
+    def feed(self, data):
+        start = self.size - len(self._pending)
+        self.size += len(data)
+        if self._skipping:
+            newline = data.find(b"\n")
+            if newline < 0:
+                return
+            self._skipping = False
+            start += newline + 1
+            data = data[newline + 1:]
+        buffer = self._pending + bytes(data)
+        end = buffer.rfind(b"\n") + 1
+        for match in self.dialect.CANDIDATES.finditer(buffer, 0, end):
+            line_end = buffer.index(b"\n", match.start()) + 1
+            marker = self.dialect.classify(buffer[match.start():line_end])
+            if marker:
+                self.sections.append(
+                    IndexEntry(start + match.start(), *marker))
+        tail = buffer[end:]
+        if (len(tail) < self.CANDIDATE_LENGTH
+                or self.dialect.CANDIDATES.match(tail)):
+            self._pending = tail
+        else:
+            self._pending = b""
+            self._skipping = True
+
+    def index(self):
+        # The owners of the sequences are only known once they were found
+        return TableIndex(self.size, [
+            entry._replace(table=self.dialect.get_owner(entry.table))
+            for entry in self.sections
+        ])
+
+
+class IndexingWriter(io.RawIOBase):
+    """
+    Write-only file object indexing the sections of the dump written to it
+    with indexer (a SectionIndexer), before writing it to fileobj.
+    Closing it does not close fileobj.
+    """
+
+    def __init__(self, fileobj, indexer):
+        self.fileobj = fileobj
+        self.indexer = indexer
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.indexer.feed(b)
+        return self.fileobj.write(b)
+
+
+def get_index_path(backup_path):
+    """
+    Returns the path of the table index of the backup at backup_path.
+    """
+    return Path(str(backup_path) + INDEX_EXTENSION)
+
+
+def write_index(path, index):
+    """
+    Write index (a TableIndex) to path, atomically.
+    """
+    lines = [f"{INDEX_HEADER} {INDEX_VERSION} {index.size}\n"]
+    lines += [
+        f"{entry.offset}\t{entry.phase}\t{entry.table}\n"
+        for entry in index.sections
+    ]
+    partial = Path(str(path) + PARTIAL_SUFFIX)
+    partial.write_text("".join(lines))
+    os.replace(partial, path)
+
+
+def read_index(path):
+    """
+    Returns the TableIndex written to path by write_index.
+    """
+    with open(path) as f:
+        header = f.readline().split()
+        if len(header) != 3 or header[0] != INDEX_HEADER:
+            raise Exception(f"{path} is not a table index.")
+        if header[1] != INDEX_VERSION:
+            raise Exception(
+                f"Unsupported table index version {header[1]} in {path}.")
+        sections = []
+        for line in f:
+            offset, phase, table = line.rstrip("\n").split("\t", 2)
+            sections.append(IndexEntry(int(offset), phase, table))
+    return TableIndex(int(header[2]), sections)
+
+
+def get_table_ranges(index, table):
+    """
+    Returns the (start, end) byte ranges of the dump to read to restore
+    table: the header of the dump, then the sections of the table
+    (its definition, data, constraints and sequences). A schema qualified
+    table can be given without its schema if its name is unique.
+    Raises an Exception if the table is not in the index.
+    """
+    tables = {entry.table for entry in index.sections if entry.table}
+    if table not in tables:
+        matching = [
+            name for name in tables if name.partition(".")[2] == table
+        ]
+        if len(matching) != 1:
+            raise Exception(f"Table {table} is not in the backup"
+                            + (f" (found {', '.join(sorted(matching))})"
+                               if matching else "."))
+        table = matching[0]
+    sections = index.sections
+    ranges = [(0, sections[0].offset)]
+    ends = [entry.offset for entry in sections[1:]] + [index.size]
+    for entry, end in zip(sections, ends):
+        if entry.table != table:
+            continue
+        if ranges[-1][1] == entry.offset:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((entry.offset, end))
+    return ranges
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Read-only file object reading the (start, end) byte ranges of fileobj,
+    in increasing order. fileobj is read from its start: it is seeked to
+    the ranges if it is seekable, otherwise the bytes in between are read
+    and discarded.
+    """
+
+    def __init__(self, fileobj, ranges):
+        self.fileobj = fileobj
+        self._ranges = collections.deque(ranges)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._ranges:
+            start, end = self._ranges[0]
+            if self._position < start:
+                self._skip(start - self._position)
+            if self._position >= end:
+                self._ranges.popleft()
+                continue
+            data = self.fileobj.read(min(len(b), end - self._position))
+            if not data:
+                raise Exception(
+                    f"The dump ends at {self._position}, before {end}.")
+            b[:len(data)] = data
+            self._position += len(data)
+            return len(data)
+        return 0
+
+    def _skip(self, count):
+        if self.fileobj.seekable():
+            self.fileobj.seek(self._position + count)
+            self._position += count
+            return
+        while count:
+            data = self.fileobj.read(min(count, SKIP_SIZE))
+            if not data:
+                raise Exception(
+                    f"The dump ends at {self._position}, before "
+                    f"{self._position + count}.")
+            count -= len(data)
+            self._position += len(data)
@@ -0,0 +1,502 @@
+import collections
+import io
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from dbbackup.utils import get_file_size, sizeof_fmt, PARTIAL_SUFFIX
+
+try:
+    import boto3
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:
+    boto3 = None
+    BotoCoreError = ClientError = None
+
+_logger = logging.getLogger(__name__)
+# Size of the reads of local backups, which are read sequentially
+READ_SIZE = 1024 * 1024
+# S3 limits: every part but the last must be at least 5 MiB,
+# and an upload has at most 10000 parts
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_UPLOAD_WORKERS = 4
+DEFAULT_DOWNLOAD_WORKERS = 4
+NOT_FOUND_CODES = ("404", "NoSuchKey", "NotFound")
+# Errors of the requests to S3 (besides OSError)
+REMOTE_ERRORS = (BotoCoreError, ClientError) if boto3 else ()
+
+# A backup of a storage: its name, size in bytes and modification time
+StoredObject = collections.namedtuple("StoredObject",
+                                      ["name", "size", "mtime"])
+
+
+class LocalStorage:
+    """
+    Backups stored as the files (or directories) of a local directory.
+    They are written by TemporaryBackupFile, to partial files renamed
+    once complete.
+    """
+    remote = False
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __str__(self):
+        return str(self.directory)
+
+    def get_path(self, name):
+        return Path(self.directory, name)
+
+    def list(self, select=None):
+        """
+        Returns the StoredObjects of the directory, only the ones whose name
+        select returns True for if given (the others are not stat'ed).
+        """
+        stored = []
+        for name in os.listdir(self.directory):
+            if select and not select(name):
+                continue
+            path = str(self.get_path(name))
+            stored.append(
+                StoredObject(name, get_file_size(path),
+                             os.path.getmtime(path)))
+        return stored
+
+    def get_size(self, name):
+        """
+        Returns the size of the backup name, raises FileNotFoundError if
+        there is none.
+        """
+        return get_file_size(str(self.get_path(name)))
+
+    def exists(self, name):
+        return self.get_path(name).exists()
+
+    def open_reader(self, name):
+        return open(self.get_path(name), 'rb', buffering=READ_SIZE)
+
+    def open_writer(self, name):
+        """
+        Returns a LocalFileWriter writing the file name.
+        """
+        return LocalFileWriter(str(self.get_path(name)))
+
+    def delete(self, name):
+        path = self.get_path(name)
+        if path.is_dir():
+            return shutil.rmtree(path)
+        return path.unlink()
+
+
+class LocalFileWriter(io.RawIOBase):
+    """
+    Write-only file object writing to a partial file next to path, flushed
+    to disk and renamed to path once closed, removed by discard.
+    """
+    _file = None
+
+    def __init__(self, path):
+        self.path = path
+        self.name = path
+        self._file = open(path + PARTIAL_SUFFIX, 'wb')
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self._file.write(b)
+
+    def flush(self):
+        if self._file and not self._file.closed:
+            self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        super().close()
+        os.replace(self._file.name, self.path)
+
+    def discard(self):
+        if self._file:
+            self._file.close()
+            try:
+                os.unlink(self._file.name)
+            except FileNotFoundError:
+                pass
+        super().close()
+
+    def __del__(self):
+        # An unfinished file is never renamed
+        if not self.closed:
+            self.discard()
+
+
+class S3Storage:
+    """
+    Backups stored as the objects of an S3 (or S3 compatible, such as MinIO)
+    bucket, under prefix. Only available if the boto3 package is installed,
+    the credentials and region are read by boto3 (AWS_ACCESS_KEY_ID...).
+    The backups are uploaded while they are written (see open_writer), and
+    downloaded while they are read (see open_reader), nothing is written to
+    the local disk.
+    """
+    remote = True
+
+    def __init__(self,
+                 bucket,
+                 prefix="",
+                 endpoint_url=None,
+                 part_size=DEFAULT_PART_SIZE,
+                 upload_workers=DEFAULT_UPLOAD_WORKERS,
+                 download_workers=DEFAULT_DOWNLOAD_WORKERS,
+                 client=None):
+        if client is None:
+            if not boto3:
+                raise Exception("S3 storage requires the boto3 package.")
+            client = boto3.client("s3", endpoint_url=endpoint_url or None)
+        if int(part_size) < MIN_PART_SIZE:
+            raise Exception(f"S3 parts must be at least "
+                            f"{sizeof_fmt(MIN_PART_SIZE)} (part_size)")
+        self.client = client
+        self.bucket = bucket
+        prefix = (prefix or "").strip("/")
+        self.prefix = prefix + "/" if prefix else ""
+        self.part_size = int(part_size)
+        self.upload_workers = max(int(upload_workers or 1), 1)
+        self.download_workers = max(int(download_workers or 1), 1)
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.prefix}"
+
+    def get_key(self, name):
+        return self.prefix + name
+
+    def list(self, select=None):
+        """
+        Returns the StoredObjects directly under the prefix, only the ones
+        whose name select returns True for if given.
+        """
+        stored = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+                Bucket=self.bucket, Prefix=self.prefix, Delimiter="/"):
+            for item in page.get("Contents", []):
+                name = item["Key"][len(self.prefix):]
+                if not name or (select and not select(name)):
+                    continue
+                stored.append(
+                    StoredObject(name, item["Size"],
+                                 item["LastModified"].timestamp()))
+        return stored
+
+    def _head(self, name):
+        try:
+            return self.client.head_object(
+                Bucket=self.bucket, Key=self.get_key(name))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in NOT_FOUND_CODES:
+                raise FileNotFoundError(f"{self} has no object {name}")
+            raise
+
+    def get_size(self, name):
+        return self._head(name)["ContentLength"]
+
+    def exists(self, name):
+        try:
+            self.get_size(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def open_reader(self, name, stage=None):
+        """
+        Returns a file object streaming the object name. Objects larger than
+        a part are downloaded with download_workers concurrent ranged GETs
+        (see RangedObjectReader).
+        The bytes downloaded, and the time spent downloading them, are added
+        to stage if given (see streaming.Stage).
+        """
+        head = self._head(name)
+        size = head["ContentLength"]
+        if self.download_workers > 1 and size > self.part_size:
+            return RangedObjectReader(self.client, self.bucket,
+                                      self.get_key(name), size, head["ETag"],
+                                      self.part_size, self.download_workers,
+                                      stage)
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self.get_key(name),
+                IfMatch=head["ETag"])
+        except ClientError as e:
+            if e.response["Error"]["Code"] in NOT_FOUND_CODES:
+                raise FileNotFoundError(f"{self} has no object {name}")
+            raise
+        return ObjectReader(response["Body"], stage)
+
+    def open_writer(self, name):
+        """
+        Returns a MultipartUploadWriter uploading the object name.
+        """
+        return MultipartUploadWriter(self.client, self.bucket,
+                                     self.get_key(name), self.part_size,
+                                     self.upload_workers)
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.get_key(name))
+
+
+class ObjectReader(io.RawIOBase):
+    """
+    Read-only file object reading the body of an S3 object as it is
+    downloaded. The bytes read and the time spent reading them are added to
+    stage if given.
+    """
+
+    def __init__(self, body, stage=None):
+        self._body = body
+        self.stage = stage
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        start = time.monotonic()
+        data = self._body.read(len(b))
+        if self.stage:
+            self.stage.add(len(data), time.monotonic() - start)
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._body.close()
+        super().close()
+
+
+class RangedObjectReader(io.RawIOBase):
+    """
+    Read-only file object downloading an S3 object of size bytes in parts of
+    part_size bytes, with workers concurrent ranged GETs, while the previous
+    parts are read. The parts complete in any order, and wait in a reorder
+    buffer to be read in order: at most 2 * workers parts are downloaded
+    ahead, so reading slowly bounds the memory used.
+    The GETs are conditional on etag, the object changing while it is read
+    fails them. The bytes downloaded by each GET, and its duration, are added
+    to stage if given.
+    """
+
+    def __init__(self,
+                 client,
+                 bucket,
+                 key,
+                 size,
+                 etag,
+                 part_size=DEFAULT_PART_SIZE,
+                 workers=DEFAULT_DOWNLOAD_WORKERS,
+                 stage=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.name = key
+        self.size = size
+        self.etag = etag
+        self.part_size = part_size
+        self.workers = workers
+        self.stage = stage
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="download")
+        # Futures of the parts downloaded ahead, in order
+        self._parts = collections.deque()
+        self._next_offset = 0
+        self._buffer = memoryview(b"")
+        self._request_parts()
+
+    def _request_parts(self):
+        while (self._next_offset < self.size
+               and len(self._parts) < 2 * self.workers):
+            end = min(self._next_offset + self.part_size, self.size)
+            self._parts.append(
+                self._executor.submit(self._get_range, self._next_offset,
+                                      end))
+            self._next_offset = end
+
+    def _get_range(self, start, end):
+        began = time.monotonic()
+        response = self.client.get_object(Bucket=self.bucket,
+                                          Key=self.key,
+                                          Range=f"bytes={start}-{end - 1}",
+                                          IfMatch=self.etag)
+        data = response["Body"].read()
+        if len(data) != end - start:
+            raise Exception(f"Got {len(data)} bytes of {self.key} "
+                            f"at offset {start}, expected {end - start}")
+        if self.stage:
+            self.stage.add(len(data), time.monotonic() - began)
+        return data
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            if not self._parts:
+                return 0
+            self._buffer = memoryview(self._parts.popleft().result())
+            self._request_parts()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._parts:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._parts.clear()
+            self._buffer = memoryview(b"")
+        super().close()
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    Write-only file object uploading what is written to it to an S3 object,
+    in parts of part_size bytes uploaded by workers threads while the next
+    ones are written. Once workers parts are being uploaded, writes wait
+    for one of them to finish, so at most (workers + 1) * part_size bytes
+    are held in memory.
+    Objects smaller than a part are uploaded at once when closing.
+    The object only exists once the writer is closed, discard aborts the
+    upload instead.
+    """
+
+    def __init__(self,
+                 client,
+                 bucket,
+                 key,
+                 part_size=DEFAULT_PART_SIZE,
+                 workers=DEFAULT_UPLOAD_WORKERS):
+        self.client = client
+        self.bucket = bucket
+        self.name = key
+        self.part_size = part_size
+        self.size = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        # Futures of the parts, in order
+        self._parts = []
+        self._error = None
+        self._slots = threading.BoundedSemaphore(workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="upload")
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        self.size += len(b)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._upload(part)
+        return len(b)
+
+    def _upload(self, data):
+        if self._error:
+            raise self._error
+        if len(self._parts) == MAX_PARTS:
+            raise Exception(
+                f"{self.name} does not fit in {MAX_PARTS} parts of "
+                f"{sizeof_fmt(self.part_size)}, increase the part size")
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.name)["UploadId"]
+            _logger.debug(f"Started multipart upload of {self.name}")
+        self._slots.acquire()
+        future = self._executor.submit(self._upload_part,
+                                       len(self._parts) + 1, data)
+        future.add_done_callback(self._part_done)
+        self._parts.append(future)
+
+    def _upload_part(self, part_number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.name,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=data)
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+
+    def _part_done(self, future):
+        self._slots.release()
+        if not future.cancelled() and future.exception():
+            self._error = future.exception()
+
+    def close(self):
+        """
+        Upload the rest of the data, and complete the upload.
+        """
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.client.put_object(Bucket=self.bucket,
+                                       Key=self.name,
+                                       Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload(bytes(self._buffer))
+                parts = [future.result() for future in self._parts]
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.name,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": parts})
+                _logger.debug(
+                    f"Uploaded {self.name} in {len(parts)} parts")
+        except BaseException:
+            self._abort()
+            raise
+        finally:
+            self._executor.shutdown()
+            self._buffer = bytearray()
+            super().close()
+
+    def discard(self):
+        """
+        Abort the upload, the object is not created (or left unchanged).
+        """
+        if self.closed:
+            return
+        for future in self._parts:
+            future.cancel()
+        self._executor.shutdown()
+        self._abort()
+        self._buffer = bytearray()
+        super().close()
+
+    def _abort(self):
+        if self._upload_id is None:
+            return
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.name, UploadId=self._upload_id)
+        except Exception as e:
+            _logger.warning(
+                f"Could not abort the upload of {self.name}, its parts are "
+                f"kept until it is: {e}")
+
+    def __del__(self):
+        # Never complete the upload of an unfinished backup
+        if not self.closed:
+            self.discard()
@@ -0,0 +1,433 @@
+import io
+import logging
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+from dbbackup.utils import sizeof_fmt
+
+_logger = logging.getLogger(__name__)
+CHUNK_SIZE = 1024 * 1024
+# Number of chunks read ahead by ReadAheadReader
+READ_AHEAD_CHUNKS = 8
+# Number of chunks being written by a Tee
+TEE_CHUNKS = 8
+
+
+def run_to_file(command, output):
+    """
+    Run command, sending its standard output to output.
+    If output is a regular file, the process writes to it directly.
+    Otherwise (for instance a compressor), the output is read through a pipe
+    and written to output as it arrives. A Tee reads the pipe directly into
+    its buffers.
+    Raises subprocess.CalledProcessError if the process fails.
+    """
+    if isinstance(output, (io.FileIO, io.BufferedWriter, io.BufferedRandom)):
+        return subprocess.run(command, check=True, stdout=output)
+
+    _logger.debug("Streaming command output through a pipe")
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+        if isinstance(output, Tee):
+            output.write_from(process.stdout)
+        else:
+            shutil.copyfileobj(process.stdout, output, CHUNK_SIZE)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return process
+
+
+def run_from_file(command, input):
+    """
+    Run command, sending input to its standard input, and capturing its
+    output.
+    If input is a regular file, the process reads it directly.
+    Otherwise (for instance a decompressor), input is read in a separate
+    thread and written to the process through a pipe, so that the process
+    starts working on the first chunk. If reading input fails, the process
+    is killed before it gets the end of its input, so that it doesn't apply
+    a truncated restore, and the error is raised.
+    Raises subprocess.CalledProcessError if the process fails.
+    """
+    if isinstance(input, (io.FileIO, io.BufferedReader, io.BufferedRandom)):
+        return subprocess.run(
+            command, stdin=input, check=True, capture_output=True)
+
+    _logger.debug("Streaming command input through a pipe")
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    # communicate() must not close stdin while it is being written
+    stdin, process.stdin = process.stdin, None
+    feeder = _Feeder(input, stdin, process)
+    feeder.start()
+    stdout, stderr = process.communicate()
+    feeder.join()
+    if feeder.error:
+        raise feeder.error
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, command, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(command, process.returncode, stdout,
+                                       stderr)
+
+
+class _Feeder(threading.Thread):
+    """
+    Thread copying input to the stdin pipe of process, then closing it.
+    The process exiting early (broken pipe) is not an error here, its return
+    code will tell. If input can't be read, the process is killed before
+    stdin is closed, so that it never sees the end of a truncated input.
+    """
+
+    def __init__(self, input, stdin, process):
+        super().__init__(name="feeder", daemon=True)
+        self.input = input
+        self.stdin = stdin
+        self.process = process
+        self.error = None
+
+    def run(self):
+        try:
+            shutil.copyfileobj(self.input, self.stdin, CHUNK_SIZE)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            self.error = e
+            self.process.kill()
+        finally:
+            try:
+                self.stdin.close()
+            except BrokenPipeError:
+                pass
+
+
+class Stage:
+    """
+    A stage of a pipeline (download, decompression...): the bytes it
+    produced, and the time its workers threads were busy producing them,
+    not waiting for the other stages. Thread safe.
+    """
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = max(int(workers or 1), 1)
+        self.size = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, size, seconds):
+        with self._lock:
+            self.size += size
+            self.seconds += seconds
+
+    @property
+    def busy_seconds(self):
+        """
+        Wall clock time the stage was busy, its workers working in parallel.
+        """
+        return self.seconds / self.workers
+
+    def describe(self, elapsed):
+        busy = self.busy_seconds
+        rate = self.size / busy if busy else 0
+        usage = min(busy / elapsed, 1) if elapsed else 0
+        return (f"{self.name} {sizeof_fmt(self.size)} "
+                f"at {sizeof_fmt(rate)}/s (busy {usage:.0%})")
+
+
+def format_stages(stages, elapsed):
+    """
+    Returns the throughput report of the stages of a pipeline which ran for
+    elapsed seconds. The stages run concurrently, so the busiest one is the
+    bottleneck, the others waited for it.
+    """
+    if not stages:
+        return ""
+    bottleneck = max(stages, key=lambda stage: stage.busy_seconds)
+    return ", ".join(
+        stage.describe(elapsed) + (" <- bottleneck"
+                                   if stage is bottleneck else "")
+        for stage in stages)
+
+
+class MeteredReader(io.RawIOBase):
+    """
+    Read-only file object timing the reads of fileobj. The bytes read and the
+    time spent reading them are added to stage if given, less the time spent
+    reading upstream (the MeteredReader fileobj reads from, in the same
+    thread), to only count the stage's own work.
+    The time spent between reads, by the consumer of the data, is added to
+    consumer if given.
+    """
+
+    def __init__(self, fileobj, stage=None, upstream=None, consumer=None):
+        self.fileobj = fileobj
+        self.stage = stage
+        self.upstream = upstream
+        self.consumer = consumer
+        self.seconds = 0.0
+        self._last_read = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        start = time.monotonic()
+        if self.consumer and self._last_read:
+            self.consumer.add(self._last_read[0], start - self._last_read[1])
+        upstream_before = self.upstream.seconds if self.upstream else 0
+        n = self.fileobj.readinto(b)
+        end = time.monotonic()
+        self.seconds += end - start
+        if self.stage:
+            waited = (self.upstream.seconds -
+                      upstream_before if self.upstream else 0)
+            self.stage.add(n, end - start - waited)
+        self._last_read = (n, end)
+        return n
+
+
+class ReadAheadReader(io.RawIOBase):
+    """
+    Read-only file object reading fileobj in a separate thread, up to depth
+    chunks ahead, so that producing the data (for instance decompressing it)
+    and consuming it overlap.
+    Can be used as context manager (with statement), closing it stops the
+    thread.
+    """
+
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE,
+                 depth=READ_AHEAD_CHUNKS):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._chunks = queue.Queue(maxsize=depth)
+        self._buffer = memoryview(b"")
+        self._stop = threading.Event()
+        self._eof = False
+        self._thread = threading.Thread(
+            target=self._read, name="readahead", daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        try:
+            while not self._stop.is_set():
+                data = self.fileobj.read(self.chunk_size)
+                self._put(data)
+                if not data:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            if self._eof:
+                return 0
+            item = self._chunks.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._buffer = memoryview(item)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+        super().close()
+
+
+class Tee(io.RawIOBase):
+    """
+    Write-only file object writing what is written to it to several sinks
+    (file objects) concurrently, each one by its own thread, so that for
+    instance a backup is hashed, written locally and uploaded in one pass.
+    The chunks are not copied for each sink: bytes are shared as is, other
+    buffers (which their writer may reuse) are copied once in buffers of
+    chunk_size bytes, reused once all the sinks wrote them. write_from reads
+    a file directly in these buffers.
+    At most chunks chunks are being written, further writes wait for the
+    slowest sink.
+    A failing sink does not stop the others, its error is in errors (by
+    sink). The failure of one of the required sinks (all of them by
+    default) is raised by the next write, and by close.
+    Closing the tee waits for the sinks to be written, it does not close
+    them. The sinks must not keep the buffers they are given to write.
+    """
+
+    def __init__(self, sinks, required=None, chunk_size=CHUNK_SIZE,
+                 chunks=TEE_CHUNKS):
+        self.sinks = list(sinks)
+        self.required = list(self.sinks if required is None else required)
+        self.chunk_size = chunk_size
+        self.errors = {}
+        self._slots = threading.Semaphore(chunks)
+        self._buffers = []
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._writers = [_SinkWriter(self, sink) for sink in self.sinks]
+        for writer in self._writers:
+            writer.start()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._check_errors()
+        if isinstance(b, bytes):
+            self._slots.acquire()
+            self._dispatch(memoryview(b), None)
+            return len(b)
+        view = memoryview(b).cast("B")
+        for offset in range(0, len(view), self.chunk_size):
+            part = view[offset:offset + self.chunk_size]
+            buffer = self._get_buffer()
+            buffer[:len(part)] = part
+            self._dispatch(memoryview(buffer)[:len(part)], buffer)
+        return len(view)
+
+    def write_from(self, fileobj):
+        """
+        Write the content of fileobj, read in the buffers of the tee.
+        """
+        while True:
+            self._check_errors()
+            buffer = self._get_buffer()
+            n = fileobj.readinto(buffer)
+            if not n:
+                self._release(buffer)
+                return
+            self._dispatch(memoryview(buffer)[:n], buffer)
+
+    def _get_buffer(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._buffers:
+                return self._buffers.pop()
+        return bytearray(self.chunk_size)
+
+    def _release(self, buffer):
+        if buffer is not None:
+            with self._lock:
+                self._buffers.append(buffer)
+        self._slots.release()
+
+    def _dispatch(self, view, buffer):
+        chunk = _Chunk(self, view, buffer, len(self._writers))
+        for writer in self._writers:
+            writer.chunks.put(chunk)
+
+    def _check_errors(self):
+        for sink in self.required:
+            if sink in self.errors:
+                raise self.errors[sink]
+
+    def flush(self):
+        """
+        Wait for the chunks written so far to be written to the sinks.
+        """
+        if self._stopped:
+            return
+        done = [threading.Event() for _ in self._writers]
+        for writer, event in zip(self._writers, done):
+            writer.chunks.put(event)
+        for event in done:
+            event.wait()
+        self._check_errors()
+
+    def close(self):
+        if not self._stopped:
+            self._stopped = True
+            for writer in self._writers:
+                writer.chunks.put(None)
+            for writer in self._writers:
+                writer.join()
+            super().close()
+        self._check_errors()
+
+
+class _Chunk:
+    """
+    A chunk written by a Tee to its sinks, returning its buffer to the tee
+    once they all wrote it.
+    """
+    __slots__ = ("tee", "view", "buffer", "pending")
+
+    def __init__(self, tee, view, buffer, pending):
+        self.tee = tee
+        self.view = view
+        self.buffer = buffer
+        self.pending = pending
+
+    def done(self):
+        with self.tee._lock:
+            self.pending -= 1
+            if self.pending:
+                return
+        self.tee._release(self.buffer)
+
+
+class _SinkWriter(threading.Thread):
+    """
+    Thread writing the chunks of a Tee to one of its sinks, until it gets
+    None. Once the sink failed, the chunks are only released.
+    """
+
+    def __init__(self, tee, sink):
+        super().__init__(name="tee", daemon=True)
+        self.tee = tee
+        self.sink = sink
+        self.chunks = queue.SimpleQueue()
+
+    def run(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, threading.Event):
+                self._flush()
+                chunk.set()
+                continue
+            if self.sink not in self.tee.errors:
+                try:
+                    self._write(chunk.view)
+                except Exception as e:
+                    _logger.debug(f"Could not write to {self.sink}: {e}")
+                    self.tee.errors[self.sink] = e
+            chunk.done()
+
+    def _write(self, view):
+        while view:
+            # Raw file objects may write part of it
+            written = self.sink.write(view)
+            if written is None or written >= len(view):
+                return
+            view = view[written:]
+
+    def _flush(self):
+        if self.sink not in self.tee.errors:
+            try:
+                self.sink.flush()
+            except Exception as e:
+                self.tee.errors[self.sink] = e
@@ -0,0 +1,238 @@
+import collections
+import logging
+import shutil
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+
+_logger = logging.getLogger(__name__)
+MANIFEST_FILENAME = "manifest"
+MANIFEST_HEADER = "dbbackup-tables"
+MANIFEST_VERSION = "1"
+# Comment starting the section of each table in mysqldump's output
+TABLE_HEADER = b"-- Table structure for table "
+GTID_PURGED_STATEMENT = b"SET @@GLOBAL.GTID_PURGED"
+# Marker selected after each statement of a ClientSession
+DONE_MARKER = "dbbackup-done"
+# Messages of mysqldump --verbose (on its standard error), the first one
+# after TRANSACTION_STARTING is written once its transaction has started
+VERBOSE_PREFIX = b"-- "
+TRANSACTION_STARTING = b"-- Starting transaction"
+
+# A file of a table dump, kind is "table" (restored concurrently), or
+# "views" (restored once the tables are)
+TableFile = collections.namedtuple("TableFile",
+                                   ["kind", "filename", "checksum", "name"])
+
+
+def write_manifest(directory, codec, files):
+    """
+    Write the manifest of the table dump in directory, listing its files,
+    in the order they should be restored.
+    """
+    codec_name = codec.name if codec else "-"
+    lines = [f"{MANIFEST_HEADER} {MANIFEST_VERSION} {codec_name}\n"]
+    lines += [
+        f"{file.kind}\t{file.filename}\t{file.checksum or '-'}\t{file.name}\n"
+        for file in files
+    ]
+    Path(directory, MANIFEST_FILENAME).write_text("".join(lines))
+
+
+def read_manifest(directory):
+    """
+    Returns the codec name (or None) and the list of TableFile of the table
+    dump in directory.
+    """
+    path = Path(directory, MANIFEST_FILENAME)
+    with open(path) as f:
+        header = f.readline().split()
+        if len(header) != 3 or header[0] != MANIFEST_HEADER:
+            raise Exception(f"{path} is not a table dump manifest.")
+        if header[1] != MANIFEST_VERSION:
+            raise Exception(f"Unsupported table dump manifest version "
+                            f"{header[1]} in {path}.")
+        files = []
+        for line in f:
+            kind, filename, checksum, name = line.rstrip("\n").split("\t", 3)
+            files.append(
+                TableFile(kind, filename,
+                          None if checksum == "-" else checksum, name))
+    return None if header[2] == "-" else header[2], files
+
+
+def parse_table_header(line):
+    """
+    Returns the name of the table of a TABLE_HEADER line, or None.
+    """
+    if not line.startswith(TABLE_HEADER):
+        return None
+    quoted = line[len(TABLE_HEADER):].rstrip(b"\r\n").decode('utf-8')
+    return quoted[1:-1].replace("``", "`")
+
+
+def split_dump(stream, open_table, started=None):
+    """
+    Split the output of mysqldump (a binary file object) in one file per
+    table: open_table(name) returns the file object of a table, which is
+    closed at the end of its section, or discarded (see
+    TemporaryBackupFile) on error.
+    Each file starts with the header of the dump (the session settings),
+    so that the tables can be restored separately, without the GTID_PURGED
+    statement, which can only be run once.
+    started is called when the first table starts, once mysqldump has
+    started its transaction.
+    Returns the names of the tables, in order.
+    """
+    header = []
+    names = []
+    output = None
+    skipping = False
+    try:
+        for line in stream:
+            name = parse_table_header(line)
+            if name is not None:
+                if output is None and started:
+                    started()
+                if output is not None:
+                    output.close()
+                    output = None
+                output = open_table(name)
+                names.append(name)
+                output.write(b"".join(header))
+            if output is not None:
+                output.write(line)
+                continue
+            # The GTID set can span several lines
+            if line.startswith(GTID_PURGED_STATEMENT):
+                skipping = True
+            if not skipping:
+                header.append(line)
+            elif line.rstrip().endswith(b";"):
+                skipping = False
+        if output is not None:
+            output.close()
+    except BaseException:
+        if output is not None:
+            output.discard()
+        raise
+    return names
+
+
+class ClientSession:
+    """
+    Long lived session of the mysql client, to run statements in the same
+    connection, for instance to hold a lock while other connections start.
+    command is the mysql client command line.
+    """
+
+    def __init__(self, command):
+        self._stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            command + ['--batch', '--skip-column-names', '--unbuffered'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self._stderr)
+
+    def execute(self, statement):
+        """
+        Run statement, and returns its output lines once it is done.
+        """
+        self.process.stdin.write(
+            f"{statement};\nSELECT '{DONE_MARKER}';\n".encode('utf-8'))
+        self.process.stdin.flush()
+        lines = []
+        for line in self.process.stdout:
+            line = line.decode('utf-8').rstrip("\n")
+            if line == DONE_MARKER:
+                return lines
+            lines.append(line)
+        self.process.wait()
+        self._stderr.seek(0)
+        raise Exception(f"Statement {statement} failed: "
+                        f"{self._stderr.read().decode('utf-8', 'replace')}")
+
+    def close(self):
+        """
+        End the session, releasing its locks.
+        """
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self._stderr.close()
+
+
+class TableDumper(threading.Thread):
+    """
+    Thread running a mysqldump command (with --verbose) dumping a list of
+    tables in a single transaction, and splitting its output in files (see
+    split_dump), or writing it to output if given.
+    started is set as soon as mysqldump reports that its transaction has
+    started (see TRANSACTION_STARTING), or the dump failed. error is the
+    exception of a failed dump, with the errors of mysqldump.
+    """
+
+    def __init__(self, command, open_table=None, output=None):
+        super().__init__(name="table-dump")
+        self.command = command
+        self.open_table = open_table
+        self.output = output
+        self.started = threading.Event()
+        self.process = None
+        self.error = None
+        self.tables = []
+        self._errors = []
+
+    def run(self):
+        try:
+            with subprocess.Popen(self.command,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE) as process:
+                self.process = process
+                stderr_reader = threading.Thread(target=self._read_stderr,
+                                                 args=(process.stderr, ),
+                                                 name="table-dump-stderr")
+                stderr_reader.start()
+                try:
+                    if self.output is not None:
+                        shutil.copyfileobj(process.stdout, self.output)
+                    else:
+                        self.tables = split_dump(process.stdout,
+                                                 self.open_table,
+                                                 self.started.set)
+                except BaseException:
+                    # Otherwise mysqldump would block writing its output
+                    process.kill()
+                    raise
+                finally:
+                    stderr_reader.join()
+                returncode = process.wait()
+            if returncode:
+                raise subprocess.CalledProcessError(
+                    returncode, self.command, stderr=b"".join(self._errors))
+        except Exception as e:
+            self.error = e
+        finally:
+            self.started.set()
+
+    def _read_stderr(self, stderr):
+        starting = False
+        for line in stderr:
+            if not line.startswith(VERBOSE_PREFIX):
+                self._errors.append(line)
+            elif line.startswith(TRANSACTION_STARTING):
+                starting = True
+            elif starting:
+                self.started.set()
+
+    def terminate(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
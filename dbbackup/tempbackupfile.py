@@ -1,64 +1,231 @@
 import tempfile
-import tarfile
 from pathlib import Path
-import shutil
 import os
 import logging
 from io import RawIOBase, SEEK_SET
 
+from dbbackup import checksums, compression, streaming
+from dbbackup.utils import move_file, PARTIAL_SUFFIX
+
 _logger = logging.getLogger(__name__)
 
 
 class TemporaryBackupFile(RawIOBase):
     """
-    Temporary file wrapper, that uses a temporary file until closing,
-    then copies it to the final destination (and compress it if specified).
+    Backup file wrapper, that writes to a partial file until closing,
+    then atomically renames it to the final destination.
+    If compress is specified (a codec name, or True for gzip), the data is
+    compressed as it is written, and the destination gets the codec extension.
+    Compression uses compress_workers threads (see compression.Codec),
+    compress_seekable writes a seekable file (see
+    compression.SeekableBlockWriter).
+    If encryption is specified (an encryption.Encryption), the data is
+    encrypted after compression, as it is written, and the destination gets
+    the encryption extension: no plaintext is written to disk.
+    If checksum is specified (an algorithm, see checksums.get_hasher),
+    the written file is hashed as it is written, and its checksum is
+    available in the checksum attribute once closed. If direct is set, and
+    the file is neither compressed, encrypted, uploaded nor copied, it is
+    written directly (a process writing it can seek in it) and hashed once
+    closed instead.
+    By default, the partial file is created next to the final destination,
+    so that no extra copy is needed. If temp_directory is specified, the
+    partial file is created there instead, and moved to the destination when
+    closing.
+    If storage is specified (a remote storage, see storage.S3Storage), the
+    file is uploaded to it while it is written instead, as filename (with the
+    codec extension), and only created there once closed.
+    If copies are specified (storages, see storage.LocalStorage and
+    storage.S3Storage), the file is written to them too, as filename (with
+    the codec extension). The file, its hash and its copies are written
+    concurrently, from the same buffers (see streaming.Tee). A failing copy
+    does not fail the backup, it is discarded, and its error recorded in
+    copy_errors (by storage, None for the successful copies) once closed.
     Can be used as context manager (with statement).
     See https://docs.python.org/3/library/io.html#module-io
     """
 
-    def __init__(self, filename, destination, compress=None, mode='w+b'):
+    def __init__(self,
+                 filename,
+                 destination,
+                 compress=None,
+                 mode='w+b',
+                 temp_directory=None,
+                 compress_workers=compression.DEFAULT_COMPRESS_WORKERS,
+                 compress_block_size=compression.DEFAULT_COMPRESS_BLOCK_SIZE,
+                 compress_level=None,
+                 checksum=None,
+                 compress_seekable=False,
+                 storage=None,
+                 copies=None,
+                 encryption=None,
+                 direct=False):
         self.filename = filename
         self.destination = destination
         self.compress = compress
         self.mode = mode
+        self.temp_directory = temp_directory
+        self.compress_workers = compress_workers
+        self.compress_block_size = compress_block_size
+        self.compress_level = compress_level
+        self.compress_seekable = compress_seekable
+        self.storage = storage
+        self.encryption = encryption
+        self.codec = compression.get_codec(compress) if compress else None
+        self.checksum = None
+        self.copy_errors = {}
+        name = self.filename
+        if self.codec:
+            name += self.codec.extension
+        if self.encryption:
+            name += self.encryption.extension
+        if self.storage:
+            self.path = name
+        else:
+            self.path = str(Path(self.destination + "/" + name).resolve())
+
+        if self.storage:
+            self._file = self.storage.open_writer(self.path)
+            _logger.debug(f"Uploading {self.path} to {self.storage}")
+        else:
+            if self.temp_directory:
+                fd, partial_name = tempfile.mkstemp(
+                    suffix=PARTIAL_SUFFIX, dir=self.temp_directory)
+                os.close(fd)
+            else:
+                partial_name = self.path + PARTIAL_SUFFIX
+            self._file = open(partial_name, self.mode)
+            _logger.debug(f"Created partial file {self._file.name}")
+
+        # The hasher and the copies get the bytes written to the file, after
+        # compression and encryption
+        self._hasher = None
+        self._hash_after = None
+        if checksum and direct and not (self.codec or self.encryption
+                                        or self.storage or copies):
+            self._hash_after = checksum
+        elif checksum:
+            self._hasher = checksums.HashingWriter(None, checksum)
+        self._copies = {}
+        for copy in copies or []:
+            try:
+                self._copies[copy] = copy.open_writer(name)
+            except Exception as e:
+                _logger.error(f"Could not copy {name} to {copy}: {e}")
+                self.copy_errors[copy] = e
+                continue
+            _logger.debug(f"Copying {name} to {copy}")
+        self._tee = None
+        output = self._file
+        sinks = [self._file] + ([self._hasher] if self._hasher else [])
+        if len(sinks) + len(self._copies) > 1:
+            self._tee = streaming.Tee(sinks + list(self._copies.values()),
+                                      required=sinks)
+            output = self._tee
 
-        self._file = tempfile.NamedTemporaryFile(mode=self.mode, delete=False)
-        _logger.debug(f"Created temporary file {self._file.name}")
+        # The writers in front of the output, closed in order
+        self._layers = []
+        self._writer = output
+        if self.encryption:
+            self._writer = self.encryption.open_writer(self._writer)
+            self._layers.insert(0, self._writer)
+        if self.codec:
+            self._writer = self.codec.open_writer(
+                self._writer,
+                self.filename,
+                level=self.compress_level,
+                workers=self.compress_workers,
+                block_size=self.compress_block_size,
+                seekable=self.compress_seekable)
+            self._layers.insert(0, self._writer)
 
     def __enter__(self):
         _logger.debug("Entering TemporaryBackupFile")
-        return self._file
+        return self._writer
 
-    def __exit__(self, *args):
+    def __exit__(self, exc_type, exc_value, traceback):
         _logger.debug("Exiting TemporaryBackupFile")
-        self.close()
-
-    def _compress(self):
-        _logger.debug("Compressing file")
-        temp_tar = tempfile.NamedTemporaryFile(delete=False)
-        _logger.debug(f"Temporary archive {temp_tar.name}")
-        temp_tar_name = temp_tar.name
-        with tarfile.open(fileobj=temp_tar, mode="w:gz") as tar:
-            tar.add(self._file.name, arcname=self.filename)
-        temp_tar.close()
-        return temp_tar_name
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
 
     def close(self):
-        to_delete = [self._file.name]
+        """
+        Flush the partial file to disk and move it to its final destination
+        (or complete the upload to the storage).
+        """
+        if self._file.closed:
+            return
+        try:
+            for layer in self._layers:
+                layer.close()
+            if self._tee:
+                self._tee.close()
+            if self._hasher:
+                self._hasher.close()
+                self.checksum = self._hasher.checksum
+            if self.storage:
+                # Completes the upload
+                self._file.close()
+            else:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                if self._hash_after:
+                    # Read back from the page cache
+                    self.checksum = checksums.hash_file(
+                        self._file.name, self._hash_after)
+                _logger.debug(f"Moving {self._file.name} to {self.path}")
+                move_file(self._file.name, self.path)
+        except Exception:
+            self._discard_copies()
+            raise
+        self._close_copies()
+
+    def _close_copies(self):
+        for copy, writer in self._copies.items():
+            error = self._tee.errors.get(writer)
+            if not error:
+                try:
+                    writer.close()
+                except Exception as e:
+                    error = e
+            if error:
+                _logger.error(f"Could not copy {self.path} to {copy}: {error}")
+                writer.discard()
+            self.copy_errors[copy] = error
+
+    def _discard_copies(self):
+        for writer in self._copies.values():
+            writer.discard()
+
+    def discard(self):
+        """
+        Close and remove the partial file (or abort the upload), leaving the
+        destination untouched.
+        """
+        _logger.debug(f"Discarding partial file {self._file.name}")
+        try:
+            for layer in self._layers:
+                layer.close()
+            if self._tee:
+                self._tee.close()
+        except Exception as e:
+            # Writing may have failed, the file is removed anyway
+            _logger.debug(f"Could not flush {self.path}: {e}")
+        self._discard_copies()
+        if self.storage:
+            # Aborts the upload
+            self._file.discard()
+            return
+        if self._hasher:
+            self._hasher.close()
         self._file.close()
-        to_copy = self._file.name
-        destination = str(
-            Path(self.destination + "/" + self.filename).resolve())
-        if self.compress:
-            to_copy = self._compress()
-            # TODO: verify that when changing the reference, we have the 2 objs in the to_delete list
-            to_delete.append(to_copy)
-            destination += ".gz"
-        _logger.debug(f"Copying {to_copy} to {destination}")
-        shutil.copy(to_copy, destination)
-        for filename in to_delete:
-            os.unlink(filename)
+        try:
+            os.unlink(self._file.name)
+        except FileNotFoundError:
+            pass
 
     @property
     def closed(self):
@@ -72,7 +239,7 @@ class TemporaryBackupFile(RawIOBase):
         return self._file.fileno()
 
     def flush(self):
-        return self._file.flush()
+        return self._writer.flush()
 
     def isatty(self):
         return self._file.isatty()
@@ -87,7 +254,7 @@ class TemporaryBackupFile(RawIOBase):
         return self._file.readlines(hint)
 
     def write(self, b):
-        return self._file.write(b)
+        return self._writer.write(b)
 
     def read(self, n=-1):
         return self._file.read(n)
@@ -105,7 +272,7 @@ class TemporaryBackupFile(RawIOBase):
         return self._file.writable()
 
     def writelines(self, lines):
-        return self._file.writelines(lines)
+        return self._writer.writelines(lines)
 
     def readinto(self, b):
         return self._file.readinto(b)
@@ -1,7 +1,31 @@
+import errno
 import os
+import shutil
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_logger = logging.getLogger(__name__)
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+PARTIAL_SUFFIX = ".partial"
+# ioctl cloning a file (reflink) on Btrfs, XFS and other copy-on-write
+# filesystems
+FICLONE = 0x40049409
+LINK_NOT_SUPPORTED = (errno.EPERM, errno.EXDEV, errno.EMLINK, errno.ENOTSUP)
 
 
 def get_file_size(absolute_path):
+    """
+    Returns the size of the file, or the total size of the files it contains
+    if it is a directory (for instance a PostgreSQL directory backup).
+    """
+    if os.path.isdir(absolute_path):
+        return sum(
+            os.stat(os.path.join(root, name)).st_size
+            for root, _, names in os.walk(absolute_path) for name in names)
     return os.stat(absolute_path).st_size
 
 
@@ -12,3 +36,126 @@ def sizeof_fmt(num, suffix='B'):
             return "%3.1f%s%s" % (num, unit, suffix)
         num /= 1024.0
     return "%.1f%s%s" % (num, 'Yi', suffix)
+
+
+def move_file(source, destination):
+    """
+    Atomically move source to destination.
+    When both are on the same filesystem, this is a simple rename.
+    Otherwise, the content is copied in the kernel to a partial file next to
+    the destination, which is then renamed into place.
+    """
+    try:
+        os.replace(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    _logger.debug(f"{source} and {destination} are on different filesystems")
+    partial = destination + PARTIAL_SUFFIX
+    with open(source, 'rb') as src, open(partial, 'wb') as dst:
+        copy_file(src, dst)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(partial, destination)
+    os.unlink(source)
+
+
+def link_file(source, destination):
+    """
+    Make destination a hard link to source, or a copy-on-write clone
+    (reflink) or copy of it on filesystems not supporting hard links.
+    The modification time of source, which a hard link shares, is left
+    unchanged: the catalog records when each backup was made.
+    """
+    source = str(source)
+    destination = str(destination)
+    if not _link_or_clone(source, destination):
+        partial = destination + PARTIAL_SUFFIX
+        with open(source, 'rb') as src, open(partial, 'wb') as dst:
+            copy_file(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(partial, destination)
+
+
+def replace_with_link(source, destination):
+    """
+    Atomically replace destination, a file identical to source, by a hard
+    link to source (or a reflink), to store their content once.
+    The modification time of source, which a hard link shares, is left
+    unchanged: the catalog records when each backup was made.
+    Returns False if the filesystem supports neither, destination is then
+    left unchanged.
+    """
+    source = str(source)
+    partial = str(destination) + PARTIAL_SUFFIX
+    if not _link_or_clone(source, partial):
+        return False
+    os.replace(partial, destination)
+    return True
+
+
+def _link_or_clone(source, destination):
+    """
+    Hard link source to destination, or clone it if hard links are not
+    supported, and returns True, or False if neither is supported.
+    """
+    try:
+        os.link(source, destination)
+        return True
+    except OSError as e:
+        if e.errno not in LINK_NOT_SUPPORTED:
+            raise
+        _logger.debug(f"Could not link {source} to {destination}: {e}")
+    if not fcntl:
+        return False
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError as e:
+            _logger.debug(f"Could not clone {source} to {destination}: {e}")
+    os.unlink(destination)
+    return False
+
+
+def copy_file(src, dst):
+    """
+    Copy the content of the src file object to the dst file object,
+    using copy_file_range or sendfile when available to avoid copying the data
+    through user space.
+    """
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    size = os.fstat(src_fd).st_size
+    for method in (_copy_file_range, _sendfile):
+        try:
+            method(src_fd, dst_fd, size)
+            return
+        except (AttributeError, OSError) as e:
+            _logger.debug(f"{method.__name__} not usable: {e}")
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+    shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(src_fd, dst_fd,
+                                    min(COPY_CHUNK_SIZE, size - offset))
+        if copied == 0:
+            break
+        offset += copied
+
+
+def _sendfile(src_fd, dst_fd, size):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dst_fd, src_fd, offset,
+                           min(COPY_CHUNK_SIZE, size - offset))
+        if sent == 0:
+            break
+        offset += sent
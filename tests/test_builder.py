@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 from pytest import raises
 
 from dbbackup import builders
@@ -23,3 +24,22 @@ class TestBuilder(unittest.TestCase):
         with raises(Exception) as e:
             builders.get('woops')
         assert 'Could not find' in e.value.args[0]
+
+    def test_get_provider_copies(self):
+        with mock.patch.object(builders.config, "COPY_DIRECTORIES",
+                               "/mnt/a,/mnt/b"):
+            provider = builders.get('mysql')
+        assert [str(copy) for copy in provider.copies] == ["/mnt/a", "/mnt/b"]
+
+    def test_get_provider_prometheus(self):
+        with mock.patch.object(builders.config, "PROMETHEUS_PUSHGATEWAY_URL",
+                               False):
+            assert builders.get('mysql').callbacks == []
+        with mock.patch.object(builders.config, "PROMETHEUS_PUSHGATEWAY_URL",
+                               "pushgateway:9091"), \
+                mock.patch.object(builders.config, "BACKUP_SUFFIX", "-daily"):
+            provider = builders.get('mysql')
+        [callback] = provider.callbacks
+        assert callback.address == "pushgateway:9091"
+        assert callback.suffix == "-daily"
+        assert builders.AbstractProvider.callbacks == []
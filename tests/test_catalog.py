@@ -0,0 +1,130 @@
+import threading
+import unittest
+from tempfile import TemporaryDirectory
+
+from dbbackup import catalog
+
+
+def entry(filename, database="test", mtime=0, **kwargs):
+    values = dict(
+        filename=filename,
+        database=database,
+        timestamp=filename[:15],
+        suffix="",
+        format=".sql",
+        codec=None,
+        size=10,
+        checksum=None,
+        duration=None,
+        mtime=mtime)
+    values.update(kwargs)
+    return catalog.BackupEntry(**values)
+
+
+class TestCatalog(unittest.TestCase):
+    def test_created(self):
+        with TemporaryDirectory() as tmpdir:
+            first = catalog.Catalog(tmpdir)
+            assert first.created
+            first.close()
+            second = catalog.Catalog(tmpdir)
+            assert not second.created
+            second.close()
+
+    def test_add_get_remove(self):
+        with TemporaryDirectory() as tmpdir:
+            backups = catalog.Catalog(tmpdir)
+            backup = entry("20190101_000000-test.sql.gz", codec="gzip")
+            backups.add(backup)
+            assert backups.get(backup.filename) == backup
+            # Adding the same backup again replaces it
+            backups.add(backup._replace(size=20))
+            assert backups.get(backup.filename).size == 20
+            backups.remove(backup.filename)
+            assert backups.get(backup.filename) is None
+            backups.close()
+
+    def test_persistent(self):
+        with TemporaryDirectory() as tmpdir:
+            backups = catalog.Catalog(tmpdir)
+            backups.add(entry("20190101_000000-test.sql"))
+            backups.close()
+            backups = catalog.Catalog(tmpdir)
+            assert backups.get("20190101_000000-test.sql")
+            backups.close()
+
+    def test_find(self):
+        with TemporaryDirectory() as tmpdir:
+            backups = catalog.Catalog(tmpdir)
+            backups.add(entry("20190101_000000-test.sql", mtime=1))
+            backups.add(entry("20190102_000000-test.sql", mtime=2))
+            backups.add(
+                entry("20190103_000000-other-daily.dump",
+                      database="other",
+                      suffix="-daily",
+                      format=".dump",
+                      mtime=3))
+            assert [backup.filename for backup in backups.find()] == [
+                "20190103_000000-other-daily.dump",
+                "20190102_000000-test.sql",
+                "20190101_000000-test.sql",
+            ]
+            assert [
+                backup.filename for backup in backups.find(formats=(".sql", ))
+            ] == ["20190102_000000-test.sql", "20190101_000000-test.sql"]
+            assert [
+                backup.filename for backup in backups.find(suffix="-daily")
+            ] == ["20190103_000000-other-daily.dump"]
+            assert [
+                backup.filename for backup in backups.find(database="other")
+            ] == ["20190103_000000-other-daily.dump"]
+            assert [
+                backup.filename
+                for backup in backups.find(modified_before=2)
+            ] == ["20190102_000000-test.sql", "20190101_000000-test.sql"]
+            backups.close()
+
+    def test_replace(self):
+        with TemporaryDirectory() as tmpdir:
+            backups = catalog.Catalog(tmpdir)
+            backups.add(
+                entry("20190101_000000-test.sql",
+                      checksum="abc",
+                      duration=2,
+                      marker="def",
+                      mtime=1))
+            backups.add(entry("20190102_000000-test.sql"))
+            backups.add(entry("20190103_000000-test.dump", format=".dump"))
+            backups.replace([
+                entry("20190101_000000-test.sql", size=30),
+                entry("20190104_000000-test.sql")
+            ],
+                            formats=(".sql", ))
+            assert [backup.filename for backup in backups.find()] == [
+                "20190104_000000-test.sql",
+                "20190103_000000-test.dump",
+                "20190101_000000-test.sql",
+            ]
+            replaced = backups.get("20190101_000000-test.sql")
+            assert replaced.size == 30
+            assert replaced.checksum == "abc"
+            assert replaced.duration == 2
+            assert replaced.marker == "def"
+            assert replaced.mtime == 1
+            backups.close()
+
+    def test_threads(self):
+        with TemporaryDirectory() as tmpdir:
+            backups = catalog.Catalog(tmpdir)
+            threads = [
+                threading.Thread(
+                    target=backups.add,
+                    args=(entry(f"20190101_00000{i}-test.sql"), ))
+                for i in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert len(backups.find()) == 8
+            backups.close()
@@ -0,0 +1,79 @@
+import hashlib
+import io
+import time
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pytest import raises
+
+from dbbackup import checksums
+
+
+class TestChecksums(unittest.TestCase):
+    def test_get_hasher(self):
+        assert checksums.get_hasher("sha256").name == "sha256"
+        assert checksums.get_hasher("blake2b").name == "blake2b"
+
+    def test_get_hasher_unknown(self):
+        with raises(Exception) as e:
+            checksums.get_hasher("md4")
+        assert "Unknown checksum algorithm md4" in str(e.value)
+
+    def test_get_hasher_xxhash(self):
+        if checksums.xxhash:
+            assert checksums.get_hasher("xxh64")
+        else:
+            with raises(Exception) as e:
+                checksums.get_hasher("xxh64")
+            assert "require the xxhash package" in str(e.value)
+
+    def test_parse_checksum(self):
+        checksum = checksums.format_checksum("sha256", "abc")
+        assert checksum == "sha256:abc"
+        assert checksums.parse_checksum(checksum) == ("sha256", "abc")
+
+    def test_hashing_writer(self):
+        output = io.BytesIO()
+        writer = checksums.HashingWriter(output, "blake2b")
+        writer.write(b"hello ")
+        writer.write(b"world")
+        writer.close()
+        assert not output.closed
+        assert output.getvalue() == b"hello world"
+        assert writer.checksum == "blake2b:" + hashlib.blake2b(
+            b"hello world").hexdigest()
+
+    def test_hash_and_verify_file(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "backup"
+            path.write_bytes(b"hello world")
+            checksum = checksums.hash_file(path)
+            assert checksum == "sha256:" + hashlib.sha256(
+                b"hello world").hexdigest()
+            assert checksums.verify_file(path, checksum)
+            path.write_bytes(b"hello w0rld")
+            assert not checksums.verify_file(path, checksum)
+
+    def test_hash_empty_file(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "backup"
+            path.write_bytes(b"")
+            assert checksums.hash_file(path) == "sha256:" + hashlib.sha256(
+                b"").hexdigest()
+
+    def test_hashing_reader(self):
+        data = b"hello world" * 1000
+        reader = checksums.HashingReader(io.BytesIO(data))
+        assert reader.read(5) == b"hello"
+        reader.drain()
+        assert reader.checksum == "sha256:" + hashlib.sha256(
+            data).hexdigest()
+
+    def test_rate_limiter(self):
+        limiter = checksums.RateLimiter(10000)
+        start = time.monotonic()
+        # The first second is a burst
+        limiter.consume(10000)
+        limiter.consume(1000)
+        assert time.monotonic() - start >= 0.09
@@ -0,0 +1,182 @@
+import io
+import random
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pytest import raises
+
+from dbbackup import chunkstore, compression
+
+
+def dump_lines(count, seed=0):
+    rng = random.Random(seed)
+    return b"".join(
+        f"INSERT INTO t VALUES ({i}, '{rng.getrandbits(64):x}');\n".encode()
+        for i in range(count))
+
+
+def small_chunker():
+    return chunkstore.Chunker(min_size=1024, average_size=4096,
+                              max_size=16384)
+
+
+def chunk(data, chunker=None, write_size=1000):
+    chunker = chunker or small_chunker()
+    chunks = []
+    for offset in range(0, len(data), write_size):
+        chunks += chunker.feed(data[offset:offset + write_size])
+    return chunks + chunker.finish()
+
+
+def write_backup(store, path, data, codec=None):
+    with open(path, 'wb') as manifest:
+        writer = store.open_writer(manifest, codec, chunker=small_chunker())
+        writer.write(data)
+        writer.close()
+
+
+class TestChunker(unittest.TestCase):
+    def test_chunks(self):
+        data = dump_lines(5000)
+        chunks = chunk(data)
+        assert b"".join(chunks) == data
+        assert len(chunks) > 10
+        for chunk_data in chunks[:-1]:
+            assert 1024 <= len(chunk_data) <= 16384
+            if len(chunk_data) < 16384:
+                assert chunk_data.endswith(b"\n")
+
+    def test_deterministic(self):
+        data = dump_lines(5000)
+        assert chunk(data, write_size=1000) == chunk(data, write_size=77777)
+
+    def test_resynchronizes(self):
+        data = dump_lines(5000)
+        lines = data.splitlines(keepends=True)
+        modified = b"".join(lines[:2500] + [b"-- inserted\n"] + lines[2500:])
+        original = chunk(data)
+        changed = [c for c in chunk(modified) if c not in set(original)]
+        # Only the chunk around the insertion differs
+        assert len(changed) <= 2
+
+    def test_no_line_ends(self):
+        data = bytes(40000)
+        chunks = chunk(data)
+        assert b"".join(chunks) == data
+        assert [len(c) for c in chunks] == [16384, 16384, 7232]
+
+
+class TestChunkStore(unittest.TestCase):
+    def test_put_get(self):
+        codec = compression.get_codec("gzip")
+        with TemporaryDirectory() as tmpdir:
+            store = chunkstore.ChunkStore(tmpdir)
+            chunk_hash = store.put(b"select 1;\n" * 100, codec)
+            assert store.put(b"select 1;\n" * 100, codec) == chunk_hash
+            assert store.chunk_path(chunk_hash, codec).stat().st_size < 1000
+            assert store.get(chunk_hash, codec) == b"select 1;\n" * 100
+            store.close()
+
+    def test_codec_change(self):
+        data = dump_lines(5000)
+        with TemporaryDirectory() as tmpdir:
+            store = chunkstore.ChunkStore(tmpdir)
+            manifests = []
+            for day, codec in enumerate((compression.get_codec("gzip"), None,
+                                         compression.get_codec("bz2"))):
+                manifest = Path(
+                    tmpdir, f"2019010{day + 1}_000000-test.sql.chunks")
+                write_backup(store, manifest, data, codec)
+                manifests.append(manifest)
+            # Each codec has its own copy of the chunks
+            first_hashes = chunkstore.read_manifest(manifests[0])[1]
+            assert len(list(store.directory.glob("*/*"))) == 3 * len(
+                set(first_hashes))
+            for manifest in manifests:
+                with store.open_reader(manifest) as reader:
+                    assert io.BufferedReader(reader).read() == data
+
+            store.release(manifests[0])
+            manifests[0].unlink()
+            store.collect_garbage(grace_period=0)
+            assert not list(store.directory.glob("*/*.gz"))
+            for manifest in manifests[1:]:
+                with store.open_reader(manifest) as reader:
+                    assert io.BufferedReader(reader).read() == data
+            store.close()
+
+    def test_corrupted_chunk(self):
+        with TemporaryDirectory() as tmpdir:
+            store = chunkstore.ChunkStore(tmpdir)
+            chunk_hash = store.put(b"select 1;\n")
+            store.chunk_path(chunk_hash).write_bytes(b"select 2;\n")
+            with raises(Exception) as e:
+                store.get(chunk_hash)
+            assert "is corrupted" in str(e.value)
+            store.close()
+
+    def test_write_read(self):
+        codec = compression.get_codec("bz2")
+        data = dump_lines(5000)
+        with TemporaryDirectory() as tmpdir:
+            store = chunkstore.ChunkStore(tmpdir)
+            manifest = Path(tmpdir) / "20190101_000000-test.sql.chunks"
+            write_backup(store, manifest, data, codec)
+            assert chunkstore.is_manifest(manifest)
+            codec_name, hashes = chunkstore.read_manifest(manifest)
+            assert codec_name == "bz2"
+            assert sum(size for _, size in hashes) == len(data)
+            with store.open_reader(manifest) as reader:
+                assert io.BufferedReader(reader).read() == data
+            store.close()
+
+    def test_invalid_manifest(self):
+        with TemporaryDirectory() as tmpdir:
+            manifest = Path(tmpdir) / "20190101_000000-test.sql.chunks"
+            manifest.write_bytes(b"select 1;\n")
+            with raises(Exception) as e:
+                chunkstore.read_manifest(manifest)
+            assert "is not a chunk manifest" in str(e.value)
+
+    def test_collect_garbage(self):
+        data = dump_lines(5000)
+        with TemporaryDirectory() as tmpdir:
+            store = chunkstore.ChunkStore(tmpdir)
+            first = Path(tmpdir) / "20190101_000000-test.sql.chunks"
+            second = Path(tmpdir) / "20190102_000000-test.sql.chunks"
+            write_backup(store, first, data)
+            write_backup(store, second, data + b"-- appended\n")
+            first_hashes = {h for h, _ in chunkstore.read_manifest(first)[1]}
+            second_hashes = {h for h, _ in chunkstore.read_manifest(second)[1]}
+            assert len(first_hashes - second_hashes) == 1
+
+            store.release(first)
+            first.unlink()
+            # Recently used chunks are kept during the grace period
+            assert store.collect_garbage() == (0, 0)
+            deleted, size = store.collect_garbage(grace_period=0)
+            assert deleted == 1 and size > 0
+            with store.open_reader(second) as reader:
+                assert io.BufferedReader(reader).read().startswith(data)
+
+            store.release(second)
+            second.unlink()
+            assert store.collect_garbage(grace_period=0)[0] == len(
+                second_hashes)
+            assert not list(store.directory.glob("*/*"))
+            store.close()
+
+    def test_recount(self):
+        data = dump_lines(5000)
+        with TemporaryDirectory() as tmpdir:
+            store = chunkstore.ChunkStore(tmpdir)
+            manifest = Path(tmpdir) / "20190101_000000-test.sql.chunks"
+            write_backup(store, manifest, data)
+            # Written without a manifest, as after a crash
+            store.add_references([store.put(b"leaked\n")])
+            store.recount([manifest])
+            assert store.collect_garbage(grace_period=0)[0] == 1
+            with store.open_reader(manifest) as reader:
+                assert io.BufferedReader(reader).read() == data
+            store.close()
@@ -0,0 +1,163 @@
+import gzip
+import io
+import subprocess
+import tarfile
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pytest import raises
+
+from dbbackup import compression
+
+
+class TestCompression(unittest.TestCase):
+    def test_open_decompressed_legacy_tar_file(self):
+        with TemporaryDirectory() as tmpdir:
+            dump = Path(tmpdir) / "20190101_000000-test.sql"
+            dump.write_bytes(b"select 1;")
+            compressed = Path(tmpdir) / "20190101_000000-test.sql.gz"
+            with tarfile.open(compressed, mode="w:gz") as tar:
+                tar.add(dump, arcname=dump.name)
+            with compression.open_decompressed(str(compressed)) as f:
+                assert f.read() == b"select 1;"
+
+    def test_parallel_writer_gunzip(self):
+        data = b"select 1;\n" * 10000
+        with TemporaryDirectory() as tmpdir:
+            compressed = Path(tmpdir) / "test.sql.gz"
+            with open(compressed, 'wb') as f:
+                with compression.get_codec("gzip").open_writer(
+                        f, "test.sql", workers=3, block_size=1000) as writer:
+                    writer.write(data)
+            output = subprocess.run(["gunzip", "-c", str(compressed)],
+                                    check=True,
+                                    stdout=subprocess.PIPE).stdout
+            assert output == data
+
+    def test_codecs_roundtrip(self):
+        data = b"insert into users values (1, 'supertestuser');\n" * 1000
+        for codec in compression.CODECS.values():
+            for workers in (1, 3):
+                buf = io.BytesIO()
+                with codec.open_writer(
+                        buf, "test.sql", workers=workers,
+                        block_size=4096) as writer:
+                    writer.write(data)
+                buf.seek(0)
+                with codec.open_reader(buf) as reader:
+                    assert reader.read() == data, (codec, workers)
+
+    def test_parallel_writer_empty(self):
+        for codec in compression.CODECS.values():
+            buf = io.BytesIO()
+            codec.open_writer(buf, "test.sql", workers=2).close()
+            assert not buf.closed
+            buf.seek(0)
+            with codec.open_reader(buf) as reader:
+                assert reader.read() == b"", codec
+
+    def test_seekable_roundtrip(self):
+        data = b"".join(b"%d insert into users values (1);\n" % i
+                        for i in range(10000))
+        codecs = [
+            codec for codec in compression.CODECS.values() if codec.seekable
+        ]
+        with TemporaryDirectory() as tmpdir:
+            for codec in codecs:
+                for workers in (1, 3):
+                    path = Path(tmpdir) / f"test.sql{codec.extension}"
+                    with open(path, 'wb') as f:
+                        with codec.open_writer(
+                                f, "test.sql", workers=workers,
+                                block_size=4096, seekable=True) as writer:
+                            writer.write(data)
+                    # Still read by the usual readers
+                    with open(path, 'rb') as f, \
+                            codec.open_reader(f) as reader:
+                        assert reader.read() == data, (codec, workers)
+                    with open(path, 'rb') as f:
+                        blocks = codec.read_block_index(f)
+                        assert f.tell() == 0
+                    assert len(blocks) == len(data) // 4096 + 1
+                    with compression.open_decompressed(
+                            path, workers=2) as reader:
+                        assert isinstance(reader,
+                                          compression.SeekableBlockReader)
+                        assert reader.read() == data
+                        for offset in (50000, 3, 4096, len(data) - 10):
+                            reader.seek(offset)
+                            assert reader.read(100) == data[offset:offset
+                                                            + 100]
+                        reader.seek(-10, io.SEEK_END)
+                        assert reader.read() == data[-10:]
+
+    def test_seekable_gunzip(self):
+        data = b"select 1;\n" * 10000
+        with TemporaryDirectory() as tmpdir:
+            compressed = Path(tmpdir) / "test.sql.gz"
+            with open(compressed, 'wb') as f:
+                with compression.get_codec("gzip").open_writer(
+                        f, "test.sql", workers=2, block_size=1000,
+                        seekable=True) as writer:
+                    writer.write(data)
+            output = subprocess.run(["gunzip", "-c", str(compressed)],
+                                    check=True,
+                                    stdout=subprocess.PIPE).stdout
+            assert output == data
+
+    def test_not_seekable(self):
+        codec = compression.get_codec("gzip")
+        assert codec.read_block_index(
+            io.BytesIO(gzip.compress(b"select 1;"))) is None
+        buf = io.BytesIO()
+        with codec.open_writer(buf, "test.sql", seekable=True) as writer:
+            writer.write(b"select 1;\n" * 10)
+        # Truncated file
+        assert codec.read_block_index(io.BytesIO(
+            buf.getvalue()[10:])) is None
+        with raises(Exception) as e:
+            compression.get_codec("lzma").open_writer(
+                io.BytesIO(), "test.sql", seekable=True)
+        assert "lzma compression can't be seekable" in str(e.value)
+
+    def test_codec_level(self):
+
+        data = b"select 1;\n" * 1000
+        codec = compression.get_codec("lzma")
+        fast, best = io.BytesIO(), io.BytesIO()
+        with codec.open_writer(fast, "test.sql", level=0) as writer:
+            writer.write(data)
+        with codec.open_writer(best, "test.sql", level=9) as writer:
+            writer.write(data)
+        assert len(best.getvalue()) <= len(fast.getvalue())
+
+    def test_get_codec(self):
+        assert compression.get_codec(True).name == "gzip"
+        assert compression.get_codec("bz2").extension == ".bz2"
+        with raises(Exception) as e:
+            compression.get_codec("rar")
+        assert "Unknown compression rar" in str(e.value)
+
+    @unittest.skipIf(compression.zstandard, "zstandard is installed")
+    def test_get_codec_zstd_not_installed(self):
+        with raises(Exception) as e:
+            compression.get_codec("zstd")
+        assert "requires the zstandard package" in str(e.value)
+
+    def test_codec_from_filename(self):
+        assert compression.codec_from_filename("a.sql.gz").name == "gzip"
+        assert compression.codec_from_filename("a.sql.bz2").name == "bz2"
+        assert compression.codec_from_filename("a.sql.xz").name == "lzma"
+        assert compression.codec_from_filename("a.sql") is None
+        assert compression.strip_extension("a.sql.xz") == "a.sql"
+        assert compression.strip_extension("a.dump") == "a.dump"
+
+    def test_codec_from_magic(self):
+        with TemporaryDirectory() as tmpdir:
+            for codec in compression.CODECS.values():
+                path = Path(tmpdir) / "backup"
+                path.write_bytes(codec.compress_block(b"select 1;", 1))
+                assert compression.detect_codec(str(path)) is codec
+            path.write_bytes(b"PGDMP")
+            assert compression.detect_codec(str(path)) is None
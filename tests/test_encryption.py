@@ -0,0 +1,111 @@
+import base64
+import io
+import os
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pytest import raises
+
+from dbbackup import encryption
+
+KEY = bytes(range(32))
+
+
+def encrypt(data, **kwargs):
+    output = io.BytesIO()
+    with encryption.Encryption(KEY, **kwargs).open_writer(output) as writer:
+        writer.write(data)
+    return output.getvalue()
+
+
+def decrypt(data, key=KEY, **kwargs):
+    with encryption.Encryption(key, **kwargs).open_reader(
+            io.BytesIO(data)) as reader:
+        return reader.read()
+
+
+@unittest.skipIf(not encryption.AESGCM, "requires cryptography")
+class TestEncryption(unittest.TestCase):
+    def test_round_trip(self):
+        for cipher in encryption.CIPHERS:
+            for size in (0, 1, 1024, 4096, 10000):
+                data = os.urandom(size)
+                encrypted = encrypt(data,
+                                    cipher=cipher,
+                                    workers=3,
+                                    chunk_size=1024)
+                assert encrypted.startswith(encryption.MAGIC)
+                # One tag per chunk, and an empty last chunk at most
+                chunks = max((size + 1023) // 1024, 1)
+                assert len(encrypted) == (encryption.HEADER_SIZE + size +
+                                          chunks * encryption.TAG_SIZE)
+                assert decrypt(encrypted, workers=2) == data
+
+    def test_random_salt(self):
+        assert encrypt(b"select 1;") != encrypt(b"select 1;")
+
+    def test_corrupted(self):
+        encrypted = bytearray(encrypt(os.urandom(5000), chunk_size=1024))
+        encrypted[2000] ^= 1
+        with raises(Exception) as e:
+            decrypt(bytes(encrypted))
+        assert "Chunk 1 of the encrypted backup can't be decrypted" in str(
+            e.value)
+
+    def test_truncated(self):
+        encrypted = encrypt(os.urandom(5000), chunk_size=1024)
+        # Ends at the end of a chunk, which is not the last one
+        truncated = encrypted[:encryption.HEADER_SIZE +
+                              2 * (1024 + encryption.TAG_SIZE)]
+        with raises(Exception) as e:
+            decrypt(truncated)
+        assert "Chunk 1 of" in str(e.value)
+        with raises(Exception) as e:
+            decrypt(encrypted + encrypted[-100:])
+        assert "can't be decrypted" in str(e.value)
+
+    def test_wrong_key(self):
+        with raises(Exception) as e:
+            decrypt(encrypt(b"select 1;"), key=bytes(32))
+        assert "the key is wrong" in str(e.value)
+
+    def test_not_encrypted(self):
+        with raises(Exception) as e:
+            decrypt(b"select 1;")
+        assert "Not an encrypted backup" in str(e.value)
+
+    def test_config(self):
+        with raises(Exception) as e:
+            encryption.Encryption(KEY, cipher="rot13")
+        assert "Unknown cipher rot13" in str(e.value)
+        with raises(Exception) as e:
+            encryption.Encryption(KEY[:16])
+        assert "must be 32 bytes" in str(e.value)
+        assert "key" not in repr(encryption.Encryption(KEY))
+
+
+class TestKeys(unittest.TestCase):
+    def test_load_key(self):
+        assert encryption.load_key(base64.b64encode(KEY).decode()) == KEY
+        with TemporaryDirectory() as tmpdir:
+            raw = Path(tmpdir) / "raw.key"
+            raw.write_bytes(KEY)
+            assert encryption.load_key(key_file=raw) == KEY
+            encoded = Path(tmpdir) / "base64.key"
+            encoded.write_bytes(base64.b64encode(KEY) + b"\n")
+            assert encryption.load_key(key_file=encoded) == KEY
+
+    def test_invalid_key(self):
+        with raises(Exception) as e:
+            encryption.load_key("not base64!")
+        assert "must be base64 encoded" in str(e.value)
+        with raises(Exception) as e:
+            encryption.load_key(base64.b64encode(b"short").decode())
+        assert "must be 32 bytes, not 5" in str(e.value)
+
+    def test_extension(self):
+        assert encryption.is_encrypted("20190101_000000-test.sql.gz.enc")
+        assert encryption.strip_extension(
+            "20190101_000000-test.sql.gz.enc") == "20190101_000000-test.sql.gz"
+        assert encryption.strip_extension("a.sql") == "a.sql"
@@ -0,0 +1,95 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from prometheus_client import generate_latest
+
+from dbbackup.callbacks import prometheus
+from dbbackup.providers import BackupResult
+
+
+def get_metrics(call):
+    return generate_latest(call[1]["registry"]).decode()
+
+
+@mock.patch('dbbackup.callbacks.prometheus.RETRY_DELAY', 0)
+@mock.patch('dbbackup.callbacks.prometheus.pushadd_to_gateway')
+class TestPrometheusPushGatewayCallback(unittest.TestCase):
+    def test_push_per_database(self, push):
+        callback = prometheus.PrometheusPushGatewayCallback("gateway:9091",
+                                                            suffix="-daily")
+        callback.backup_done("2019-01-01T00:00:00", "test", "a.sql", 10)
+        callback.backup_done("2019-01-01T00:00:00", "other", "b.sql", 20)
+        push.assert_not_called()
+        callback.backups_done([
+            BackupResult("test", "a.sql", 10, 1, None),
+            BackupResult("other", "b.sql", 20, 1, None),
+            BackupResult("failed", None, None, None, Exception("failed"))
+        ])
+        callback.wait()
+        assert push.call_count == 3
+        test, other, failed = push.call_args_list
+        assert test[0] == ("gateway:9091", )
+        assert test[1]["job"] == "dbbackup"
+        assert test[1]["grouping_key"] == {
+            "instance": callback.get_hostname(),
+            "database": "test",
+            "suffix": "-daily"
+        }
+        assert test[1]["timeout"] == prometheus.DEFAULT_TIMEOUT
+        assert other[1]["grouping_key"]["database"] == "other"
+        metrics = get_metrics(other)
+        assert "dbbackup_last_backup_success 1.0" in metrics
+        assert "dbbackup_last_backup_file_size 20.0" in metrics
+        assert "dbbackup_last_success_timestamp" in metrics
+        # The last successful backup of a failed database is kept
+        metrics = get_metrics(failed)
+        assert "dbbackup_last_backup_success 0.0" in metrics
+        assert "dbbackup_last_success_timestamp" not in metrics
+        assert "dbbackup_last_backup_file_size" not in metrics
+
+    def test_retry(self, push):
+        push.side_effect = [OSError("refused"), OSError("refused"), None]
+        callback = prometheus.PrometheusPushGatewayCallback("gateway:9091")
+        callback.backups_done([BackupResult("test", "a.sql", 10, 1, None)])
+        callback.wait()
+        assert push.call_count == 3
+        assert "suffix" not in push.call_args[1]["grouping_key"]
+
+        push.reset_mock()
+        push.side_effect = OSError("refused")
+        callback = prometheus.PrometheusPushGatewayCallback("gateway:9091",
+                                                            retries=1)
+        with self.assertLogs(prometheus._logger, "WARNING") as logs:
+            callback.backups_done(
+                [BackupResult("test", "a.sql", 10, 1, None)])
+            callback.wait()
+        assert push.call_count == 2
+        assert "Could not push the metrics of test to gateway:9091: " \
+            "refused" in logs.output[0]
+
+    def test_slow_gateway(self, push):
+        unblock = threading.Event()
+        push.side_effect = lambda *args, **kwargs: unblock.wait()
+        callback = prometheus.PrometheusPushGatewayCallback("gateway:9091")
+        # Does not wait for the push
+        callback.backups_done([BackupResult("test", "a.sql", 10, 1, None)])
+        push_thread = callback._thread
+        assert push_thread.is_alive()
+        with self.assertLogs(prometheus._logger, "WARNING") as logs:
+            callback.wait(timeout=0.01)
+        assert "Gave up waiting" in logs.output[0]
+        unblock.set()
+        push_thread.join()
+
+    def test_wait_for_every_push(self, push):
+        push.side_effect = lambda *args, **kwargs: time.sleep(0.05)
+        callback = prometheus.PrometheusPushGatewayCallback(
+            "gateway:9091", timeout=0.1, retries=0)
+        callback.backups_done([
+            BackupResult(f"test{i}", "a.sql", 10, 1, None) for i in range(4)
+        ])
+        # Longer than a single push can take, but not than all of them
+        callback.wait()
+        assert push.call_count == 4
@@ -1,11 +1,86 @@
+import bz2
+import gzip
+import hashlib
 import unittest
 import os
+import sys
 from unittest import mock
 from pathlib import Path
 import time
 from datetime import datetime, timedelta
+from dbbackup import catalog, encryption, sqlsplit, storage, tabledump
 from dbbackup.providers import mysql
-from tempfile import TemporaryDirectory, _TemporaryFileWrapper
+from tests.test_storage import s3_test
+from tempfile import TemporaryDirectory
+from pytest import raises
+
+
+FAKE_MYSQL = """
+import os, sys
+directory = os.path.dirname(os.path.abspath(__file__))
+args = sys.argv[1:]
+if "-e" in args:
+    print("big\\tBASE TABLE\\t3000\\nsmall\\tBASE TABLE\\t10\\nv\\tVIEW\\t0")
+elif "--unbuffered" in args:
+    for line in sys.stdin:
+        with open(os.path.join(directory, "session.log"), "a") as log:
+            log.write(line)
+        if line.startswith("SELECT 'dbbackup-done'"):
+            print("dbbackup-done", flush=True)
+else:
+    with open(os.path.join(directory, f"restored-{os.getpid()}"), "wb") as f:
+        f.write(sys.stdin.buffer.read())
+"""
+
+FAKE_MYSQLDUMP = """
+import os
+import sys
+import time
+args = sys.argv[1:]
+tables = args[args.index("--single-transaction") + 2:]
+if "--verbose" in args:
+    sys.stderr.write("-- Connecting to localhost...\\n")
+    sys.stderr.write("-- Starting transaction...\\n")
+    sys.stderr.write("-- Setting savepoint...\\n")
+    sys.stderr.flush()
+# The global read lock is released before anything is dumped
+session = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "session.log")
+deadline = time.monotonic() + 10
+while not os.path.exists(session) or \\
+        "UNLOCK TABLES" not in open(session).read():
+    if time.monotonic() > deadline:
+        sys.stderr.write("mysqldump: the lock was not released\\n")
+        sys.exit(2)
+    time.sleep(0.01)
+if "fail" in tables:
+    sys.stderr.write("mysqldump: Couldn't find table: \\"fail\\"\\n")
+    sys.exit(6)
+out = sys.stdout
+out.write("-- MySQL dump\\n/*!40101 SET NAMES utf8 */;\\n")
+out.write("SET @@GLOBAL.GTID_PURGED='a:1-2,\\nb:1-3';\\n--\\n")
+for table in tables:
+    if table == "v":
+        out.write("-- Temporary view structure for view `v`\\n")
+        out.write("CREATE VIEW `v` AS SELECT 1;\\n")
+        continue
+    out.write(f"-- Table structure for table `{table}`\\n--\\n")
+    out.write(f"CREATE TABLE `{table}` (id int);\\n")
+    out.write(f"INSERT INTO `{table}` VALUES (1);\\n--\\n")
+out.write("-- Dump completed\\n")
+"""
+
+
+def fake_bin_directory(directory):
+    """
+    Write fake mysql and mysqldump executables in directory.
+    """
+    for name, script in (("mysql", FAKE_MYSQL),
+                         ("mysqldump", FAKE_MYSQLDUMP)):
+        path = Path(directory) / name
+        path.write_text(f"#!{sys.executable}\n{script}")
+        path.chmod(0o755)
+    return str(directory)
 
 
 def Any(cls):
@@ -75,7 +150,11 @@ class TestMysqlProvider(unittest.TestCase):
         provider.register_callback(callback)
         provider.execute_backup()
         callback.backup_done.assert_called_with(
-            Any(str), 'test', '20190101_000000-test-daily.sql', '1024')
+            Any(str),
+            'test',
+            '20190101_000000-test-daily.sql',
+            '1024',
+            checksum=None)
 
     @mock.patch('dbbackup.providers.mysql.TemporaryBackupFile.close')
     @mock.patch('dbbackup.providers.mysql.subprocess.run')
@@ -84,23 +163,23 @@ class TestMysqlProvider(unittest.TestCase):
                                     mock_close):
         _get_backup_command.return_value = "cmd"
         mock_close.return_value = True
-        provider = mysql.MySQL('/tmp')
+        # Without checksum, the dump is written directly to the file
+        provider = mysql.MySQL('/tmp', checksum=None)
         provider.backup_database('test_database')
         assert mock_run.call_args[0][0] == 'cmd'
-        assert isinstance(mock_run.call_args[1]['stdout'],
-                          _TemporaryFileWrapper)
+        assert mock_run.call_args[1]['stdout'].name.endswith('.partial')
 
-    @mock.patch('dbbackup.providers.mysql.MySQL._is_older_than')
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_catalog')
     @mock.patch('dbbackup.providers.mysql.MySQL._remove')
-    @mock.patch('dbbackup.providers.mysql.MySQL.get_backups')
-    def test_cleanup_called(self, mock_get_backups, mock_remove,
-                            mock_is_older_than):
-        mock_get_backups.return_value = ["backup_one"]
-        mock_is_older_than.return_value = True
+    def test_cleanup_called(self, mock_remove, mock_get_catalog):
+        mock_get_catalog.return_value.find.return_value = [
+            mock.Mock(filename="backup_one")
+        ]
         mock_remove.return_value = True
         provider = mysql.MySQL('/tmp')
         provider.cleanup(0)
         assert mock_remove.called
+        mock_get_catalog.return_value.remove.assert_called_with("backup_one")
 
     def test_cleanup_zero_days(self):
         with TemporaryDirectory() as tmpdir:
@@ -150,3 +229,797 @@ class TestMysqlProvider(unittest.TestCase):
         provider = mysql.MySQL('/tmp', backup_suffix="-daily")
         backup_filename = provider.construct_backup_filename("test")
         assert backup_filename == "20190101_000000-test-daily.sql"
+
+    def test_is_backup_compressed(self):
+        provider = mysql.MySQL('/tmp')
+        assert provider.is_backup("20190101_000000-test-daily.sql")
+        assert provider.is_backup("20190101_000000-test-daily.sql.gz")
+        assert provider.is_backup("20190101_000000-test-daily.sql.bz2")
+        assert provider.is_backup("20190101_000000-test-daily.sql.xz")
+        assert not provider.is_backup("20190101_000000-test-daily.sql.partial")
+        assert not provider.is_backup("20190101_000000-test-daily.txt.gz")
+
+    def test_backup_compressed_with_codec(self):
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()), compress="bz2")
+            with mock.patch.object(provider, '_get_backup_command') as cmd:
+                cmd.return_value = ["echo", "select 1;"]
+                filename = provider.backup_database("test")
+            assert os.listdir(tmpdir) == [filename + ".bz2"]
+            assert bz2.decompress(
+                (Path(tmpdir) /
+                 (filename + ".bz2")).read_bytes()) == b"select 1;\n"
+
+    def test_restore_compressed_streaming(self):
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(str(Path(tmpdir).resolve()))
+            backup = Path(tmpdir) / "20190101_000000-test.sql.bz2"
+            backup.write_bytes(bz2.compress(b"select 1;\n"))
+            restored = Path(tmpdir) / "restored.sql"
+            with mock.patch.object(provider, '_get_restore_command') as cmd:
+                # Fake mysql client, copying its stdin to restored
+                cmd.return_value = [
+                    sys.executable, "-c",
+                    "import shutil, sys; shutil.copyfileobj("
+                    f"sys.stdin.buffer, open({str(restored)!r}, 'wb'))"
+                ]
+                provider.restore_backup(backup.name, "test")
+            assert restored.read_bytes() == b"select 1;\n"
+            assert sorted(os.listdir(tmpdir)) == sorted(
+                [catalog.CATALOG_FILENAME, backup.name, restored.name])
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_backup_recorded_in_catalog(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()),
+                backup_suffix="-daily",
+                compress="gzip")
+            with mock.patch.object(provider, '_get_backup_command') as cmd:
+                cmd.return_value = ["echo", "select 1;"]
+                provider.execute_backup()
+            backup_file = provider.get_backups()[0]
+            entry = provider.get_catalog().get(backup_file)
+            assert entry.database == "test"
+            assert entry.suffix == "-daily"
+            assert entry.format == ".sql"
+            assert entry.codec == "gzip"
+            assert entry.size == (Path(tmpdir) / backup_file).stat().st_size
+            assert entry.duration is not None
+
+    def test_list_reads_catalog(self):
+        with TemporaryDirectory() as tmpdir:
+            backup = Path(tmpdir) / "20190101_000000-test.sql"
+            backup.write_bytes(b"backup content")
+            provider = mysql.MySQL(str(Path(tmpdir).resolve()))
+            # The catalog is created from the directory the first time
+            assert provider.get_backups() == [backup.name]
+            added = Path(tmpdir) / "20190102_000000-test.sql"
+            added.write_bytes(b"backup content")
+            backup.unlink()
+            assert provider.get_backups() == [backup.name]
+            provider.reindex()
+            assert provider.get_backups() == [added.name]
+            assert provider.get_catalog().get(added.name).size == 14
+
+    def test_prune(self):
+        with TemporaryDirectory() as tmpdir:
+            names = [
+                "20190101_100000-test.sql", "20190101_110000-test.sql",
+                "20190102_100000-test.sql", "20190102_110000-test.sql",
+                "20190102_110000-other.sql"
+            ]
+            for name in names:
+                (Path(tmpdir) / name).write_bytes(b"backup content")
+            provider = mysql.MySQL(str(Path(tmpdir).resolve()))
+            provider.prune("daily=2", dry_run=True)
+            assert len(provider.get_backups()) == 5
+            provider.prune("daily=2")
+            assert provider.get_backups() == [
+                "20190102_110000-test.sql", "20190102_110000-other.sql",
+                "20190101_110000-test.sql"
+            ]
+            assert sorted(os.listdir(tmpdir)) == sorted(
+                [catalog.CATALOG_FILENAME] + provider.get_backups())
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_backup_checksum(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(str(Path(tmpdir).resolve()))
+            callback = mock.Mock()
+            provider.callbacks = [callback]
+            with mock.patch.object(provider, '_get_backup_command') as cmd:
+                cmd.return_value = ["echo", "select 1;"]
+                provider.execute_backup()
+            backup_file = provider.get_backups()[0]
+            checksum = "sha256:" + hashlib.sha256(b"select 1;\n").hexdigest()
+            assert provider.get_catalog().get(
+                backup_file).checksum == checksum
+            assert callback.backup_done.call_args[1] == {"checksum": checksum}
+            [results] = callback.backups_done.call_args[0]
+            assert [result.filename for result in results] == [backup_file]
+            provider.verify_backup(backup_file)
+
+            (Path(tmpdir) / backup_file).write_bytes(b"select 2;\n")
+            with raises(Exception) as e:
+                provider.verify_backup(backup_file)
+            assert "is corrupted" in str(e.value)
+
+    def test_verify_without_checksum(self):
+        with TemporaryDirectory() as tmpdir:
+            backup = Path(tmpdir) / "20190101_000000-test.sql"
+            backup.write_bytes(b"backup content")
+            provider = mysql.MySQL(str(Path(tmpdir).resolve()))
+            with raises(Exception) as e:
+                provider.verify_backup(backup.name)
+            assert "No checksum recorded" in str(e.value)
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_scrub(self, mock_get_databases):
+        mock_get_databases.return_value = [
+            'ok', 'flipped', 'truncated', 'gone'
+        ]
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()), compress="gzip")
+            with mock.patch.object(provider, '_get_backup_command') as cmd:
+                cmd.return_value = ["seq", "100000"]
+                provider.execute_backup()
+            plain = Path(tmpdir) / "20190101_000000-plain.sql"
+            plain.write_bytes(b"select 1;")
+            provider.reindex()
+            backups = {
+                provider.get_catalog().get(name).database: Path(tmpdir) / name
+                for name in provider.get_backups()
+            }
+            content = bytearray(backups['flipped'].read_bytes())
+            content[len(content) // 2] ^= 0xff
+            backups['flipped'].write_bytes(bytes(content))
+            content = backups['truncated'].read_bytes()
+            backups['truncated'].write_bytes(content[:-100])
+            backups['gone'].unlink()
+
+            with mock.patch('builtins.print') as mock_print, \
+                    raises(Exception) as e:
+                provider.scrub(jobs=2)
+            assert "3 of 5 backup(s) are corrupted or missing" in str(e.value)
+            lines = {
+                call[0][0].split("\t")[1]: call[0][0].split("\t")
+                for call in mock_print.call_args_list
+            }
+            assert lines[backups['ok'].name][0] == "OK"
+            assert lines[backups['flipped'].name][0] == "CORRUPTED"
+            assert lines[backups['truncated'].name][0] == "CORRUPTED"
+            assert lines[backups['gone'].name][0] == "MISSING"
+            assert lines[plain.name][0] == "UNVERIFIED"
+
+            # Only the checksum can tell, the gzip stream is still valid
+            backups['ok'].write_bytes(gzip.compress(b"select 2;"))
+            entry = provider.get_catalog().get(backups['ok'].name)
+            provider.get_catalog().replace([
+                entry._replace(size=backups['ok'].stat().st_size)
+            ])
+            with mock.patch('builtins.print') as mock_print, \
+                    raises(Exception):
+                provider.scrub(rate_limit=100)
+            status, _, detail = mock_print.call_args[0][0].split("\t")
+            assert status == "CORRUPTED"
+            assert detail.startswith("checksum sha256:")
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_scrub_read_errors(self, mock_get_databases):
+        mock_get_databases.return_value = ['size', 'read', 'ok']
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()), compress="gzip")
+            with mock.patch.object(provider, '_get_backup_command') as cmd, \
+                    mock.patch('builtins.print'):
+                cmd.return_value = ["seq", "1000"]
+                provider.execute_backup()
+            names = {
+                provider.get_catalog().get(name).database: name
+                for name in provider.get_backups()
+            }
+            get_size = provider.storage.get_size
+            open_reader = provider.storage.open_reader
+
+            def failing_get_size(name):
+                if name == names['size']:
+                    raise OSError(5, "Input/output error")
+                return get_size(name)
+
+            def failing_open_reader(name, *args, **kwargs):
+                if name == names['read']:
+                    raise OSError(5, "Input/output error")
+                return open_reader(name, *args, **kwargs)
+
+            # Read errors are reported, and the other backups still scrubbed
+            with mock.patch('builtins.print') as mock_print, \
+                    mock.patch.object(provider.storage, 'get_size',
+                                      side_effect=failing_get_size), \
+                    mock.patch.object(provider.storage, 'open_reader',
+                                      side_effect=failing_open_reader), \
+                    raises(Exception) as e:
+                provider.scrub(jobs=2)
+            assert "2 of 3 backup(s) are corrupted" in str(e.value)
+            lines = {
+                call[0][0].split("\t")[1]: call[0][0].split("\t")
+                for call in mock_print.call_args_list
+            }
+            for database in ('size', 'read'):
+                assert lines[names[database]] == [
+                    "CORRUPTED", names[database],
+                    "read error: [Errno 5] Input/output error"
+                ]
+            assert lines[names['ok']][0] == "OK"
+
+            # Other errors are not mistaken for corruption
+            with mock.patch('builtins.print'), \
+                    mock.patch.object(provider.storage, 'get_size',
+                                      side_effect=TypeError("bug")), \
+                    raises(TypeError):
+                provider.scrub()
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_dedup_backup(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()), compress="gzip", dedup=True)
+            with mock.patch.object(provider, '_get_backup_command') as cmd:
+                cmd.return_value = ["seq", "1000000"]
+                provider.execute_backup()
+            backup_file = provider.get_backups()[0]
+            assert backup_file.endswith("-test.sql.chunks")
+            assert provider.is_backup(backup_file)
+            entry = provider.get_catalog().get(backup_file)
+            assert entry.format == ".sql"
+            assert entry.size == (Path(tmpdir) / backup_file).stat().st_size
+            chunks = list(Path(tmpdir, ".chunks").glob("*/*"))
+            assert len(chunks) > 1
+
+            restored = Path(tmpdir) / "restored.sql"
+            with mock.patch.object(provider, '_get_restore_command') as cmd:
+                cmd.return_value = [
+                    sys.executable, "-c",
+                    "import shutil, sys; shutil.copyfileobj("
+                    f"sys.stdin.buffer, open({str(restored)!r}, 'wb'))"
+                ]
+                provider.restore_backup(backup_file, "test")
+            expected = "".join(f"{i}\n" for i in range(1, 1000001)).encode()
+            assert restored.read_bytes() == expected
+
+            with mock.patch('builtins.print') as mock_print:
+                provider.scrub()
+            assert mock_print.call_args_list[0][0][0].startswith("OK\t")
+
+            provider.cleanup(0)
+            assert not provider.get_backups()
+            # The chunks are kept during the grace period
+            stored = list(Path(tmpdir, ".chunks").glob("*/*"))
+            assert len(stored) == len(chunks)
+            provider.get_chunk_store().collect_garbage(grace_period=0)
+            assert not list(Path(tmpdir, ".chunks").glob("*/*"))
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_dedup_backup_codec_change(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        with TemporaryDirectory() as tmpdir:
+            backups = []
+            # The same content compressed differently, or not at all
+            for timestamp, compress in (("20190101_000000", "gzip"),
+                                        ("20190102_000000", None)):
+                provider = mysql.MySQL(
+                    str(Path(tmpdir).resolve()), compress=compress,
+                    dedup=True)
+                with mock.patch.object(provider,
+                                       '_get_backup_command') as cmd, \
+                        mock.patch.object(
+                            provider,
+                            '_get_formatted_current_datetime') as now, \
+                        mock.patch('builtins.print'):
+                    cmd.return_value = ["seq", "100000"]
+                    now.return_value = timestamp
+                    provider.execute_backup()
+                backups.append(f"{timestamp}-test.sql.chunks")
+            assert sorted(provider.get_backups()) == backups
+
+            expected = "".join(f"{i}\n" for i in range(1, 100001)).encode()
+            restored = Path(tmpdir) / "restored.sql"
+            for backup_file in backups:
+                with mock.patch.object(provider,
+                                       '_get_restore_command') as cmd:
+                    cmd.return_value = [
+                        sys.executable, "-c",
+                        "import shutil, sys; shutil.copyfileobj("
+                        f"sys.stdin.buffer, open({str(restored)!r}, 'wb'))"
+                    ]
+                    provider.restore_backup(backup_file, "test")
+                assert restored.read_bytes() == expected
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_skip_unchanged(self, mock_get_databases):
+        mock_get_databases.return_value = ['test', 'changed']
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()),
+                compress="gzip",
+                skip_unchanged=True)
+            markers = {'test': "a", 'changed': "b"}
+
+            def backup(timestamp, force=False):
+                with mock.patch.object(provider,
+                                       '_get_backup_command') as cmd, \
+                        mock.patch.object(provider,
+                                          'get_change_marker') as marker, \
+                        mock.patch.object(
+                            provider,
+                            '_get_formatted_current_datetime') as now, \
+                        mock.patch('builtins.print'):
+                    cmd.return_value = ["echo", "select 1;"]
+                    marker.side_effect = markers.get
+                    now.return_value = timestamp
+                    provider.execute_backup(force=force)
+                    return cmd.call_count
+
+            assert backup("20190101_000000") == 2
+            markers['changed'] = "c"
+            assert backup("20190102_000000") == 1
+            previous = Path(tmpdir) / "20190101_000000-test.sql.gz"
+            linked = Path(tmpdir) / "20190102_000000-test.sql.gz"
+            assert linked.read_bytes() == previous.read_bytes()
+            assert os.path.samefile(previous, linked)
+            entry = provider.get_catalog().get(linked.name)
+            assert entry.marker == "a"
+            assert entry.checksum == provider.get_catalog().get(
+                previous.name).checksum
+            assert (Path(tmpdir) / "20190102_000000-changed.sql.gz").exists()
+            # Restoring the reused backup does not depend on the previous one
+            previous.unlink()
+            assert gzip.decompress(linked.read_bytes()) == b"select 1;\n"
+
+            assert backup("20190103_000000", force=True) == 2
+            # Changing the compression does not reuse the backups
+            provider.compress = False
+            provider.codec = None
+            assert backup("20190104_000000") == 2
+
+    def test_tables_status_command(self):
+        provider = mysql.MySQL('/tmp', mysql_bin_directory='/bin')
+        with mock.patch('pathlib.Path.exists', return_value=True):
+            command = provider._get_tables_status_command("it's")
+            assert "TABLE_SCHEMA = 'it\\'s'" in command[-1]
+            command = provider._get_checksum_command("db", ["a`b", "c"])
+            assert command[-1] == "CHECKSUM TABLE `db`.`a``b`, `db`.`c`;"
+
+    @mock.patch('subprocess.check_output')
+    def test_change_marker(self, mock_check_output):
+        provider = mysql.MySQL('/tmp', mysql_bin_directory='/bin')
+        status = ("a\tBASE TABLE\tInnoDB\t2019-01-01 00:00:00\tNULL\tNULL\n"
+                  "b\tBASE TABLE\tMyISAM\t2019-01-01 00:00:00\t"
+                  "2019-01-02 00:00:00\t0\n"
+                  "v\tVIEW\tNULL\tNULL\tNULL\tNULL\n").encode()
+        mock_check_output.side_effect = [status, b"db.a\t1234\n"]
+        with mock.patch('pathlib.Path.exists', return_value=True):
+            marker = provider.get_change_marker("db")
+        # Only the table without update time is checksummed
+        assert mock_check_output.call_args[0][0][-1] == \
+            "CHECKSUM TABLE `db`.`a`;"
+        mock_check_output.side_effect = [status, b"db.a\t5678\n"]
+        with mock.patch('pathlib.Path.exists', return_value=True):
+            assert provider.get_change_marker("db") != marker
+
+    @mock.patch('subprocess.check_output')
+    def test_change_marker_recent_update(self, mock_check_output):
+        provider = mysql.MySQL('/tmp', mysql_bin_directory='/bin')
+        status = ("b\tBASE TABLE\tInnoDB\t2019-01-01 00:00:00\t"
+                  "2019-01-02 00:00:00\t{}\n")
+        mock_check_output.side_effect = [
+            status.format(1).encode(), b"db.b\t1234\n"
+        ]
+        with mock.patch('pathlib.Path.exists', return_value=True):
+            marker = provider.get_change_marker("db")
+        # The table updated in the last second is checksummed, as a change in
+        # the same second would not change its update time
+        assert mock_check_output.call_args[0][0][-1] == \
+            "CHECKSUM TABLE `db`.`b`;"
+        mock_check_output.side_effect = [
+            status.format(1).encode(), b"db.b\t5678\n"
+        ]
+        with mock.patch('pathlib.Path.exists', return_value=True):
+            assert provider.get_change_marker("db") != marker
+        # Once it is not recent anymore, it is not read, and the marker
+        # doesn't depend on the recent flag
+        mock_check_output.side_effect = [status.format(0).encode()]
+        with mock.patch('pathlib.Path.exists', return_value=True):
+            marker = provider.get_change_marker("db")
+        mock_check_output.side_effect = [status.format(0).encode()]
+        with mock.patch('pathlib.Path.exists', return_value=True):
+            assert provider.get_change_marker("db") == marker
+        assert mock_check_output.call_count == 6
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_identical_backups_linked(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(str(Path(tmpdir).resolve()))
+            for timestamp, content in (("20190101_000000", "select 1;"),
+                                       ("20190102_000000", "select 1;"),
+                                       ("20190103_000000", "select 2;")):
+                with mock.patch.object(provider,
+                                       '_get_backup_command') as cmd, \
+                        mock.patch.object(
+                            provider,
+                            '_get_formatted_current_datetime') as now, \
+                        mock.patch('builtins.print'):
+                    cmd.return_value = ["echo", content]
+                    now.return_value = timestamp
+                    provider.execute_backup()
+            first, second, third = (
+                Path(tmpdir) / f"2019010{day}_000000-test.sql"
+                for day in (1, 2, 3))
+            assert os.path.samefile(first, second)
+            assert not os.path.samefile(second, third)
+            assert not list(Path(tmpdir).glob("*.partial"))
+
+            with mock.patch('builtins.print') as mock_print:
+                provider.list_backups()
+            assert [call[0][0] for call in mock_print.call_args_list] == [
+                f"{third.name}\t10.0B",
+                f"{second.name}\t10.0B\t= {first.name}",
+                f"{first.name}\t10.0B",
+            ]
+
+            # Reindexing keeps the time the linked backups were made,
+            # whatever the modification time of their file
+            made = provider.get_catalog().get(second.name).mtime
+            os.utime(first, (0, 0))
+            provider.reindex()
+            assert provider.get_catalog().get(second.name).mtime == made
+            provider.get_catalog().close()
+            os.unlink(Path(tmpdir) / catalog.CATALOG_FILENAME)
+            provider._catalog = None
+            provider.reindex()
+            assert provider.get_catalog().get(second.name).mtime == (
+                datetime(2019, 1, 2).timestamp())
+
+            # Removing the first backup keeps the content of the second one
+            provider._remove_backup(provider.get_catalog().get(first.name))
+            assert second.read_bytes() == b"select 1;\n"
+            assert second.stat().st_nlink == 1
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_identical_compressed_backups_linked(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(str(Path(tmpdir).resolve()),
+                                   compress="gzip")
+            for timestamp in ("20190101_000000", "20190102_000000"):
+                with mock.patch.object(provider,
+                                       '_get_backup_command') as cmd, \
+                        mock.patch.object(
+                            provider,
+                            '_get_formatted_current_datetime') as now, \
+                        mock.patch('builtins.print'):
+                    cmd.return_value = ["echo", "select 1;"]
+                    now.return_value = timestamp
+                    provider.execute_backup()
+            first, second = (Path(tmpdir) / f"2019010{day}_000000-test.sql.gz"
+                             for day in (1, 2))
+            assert os.path.samefile(first, second)
+            assert gzip.decompress(second.read_bytes()) == b"select 1;\n"
+
+    def test_backup_command_without_dump_date(self):
+        with TemporaryDirectory() as tmpdir, TemporaryDirectory() as bindir:
+            fake_bin_directory(bindir)
+            provider = mysql.MySQL(tmpdir, mysql_bin_directory=bindir)
+            assert "--skip-dump-date" in provider._get_backup_command("test")
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_parallel_table_backup(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        with TemporaryDirectory() as tmpdir, TemporaryDirectory() as bindir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()),
+                mysql_bin_directory=fake_bin_directory(bindir),
+                compress="gzip",
+                dump_jobs=2)
+            with mock.patch('builtins.print'):
+                provider.execute_backup()
+            backup_file = provider.get_backups()[0]
+            assert backup_file.endswith("-test.dir")
+            entry = provider.get_catalog().get(backup_file)
+            assert entry.format == ".dir" and entry.codec is None
+
+            directory = Path(tmpdir) / backup_file
+            codec, files = tabledump.read_manifest(directory)
+            assert codec == "gzip"
+            assert [(file.kind, file.name) for file in files] == [
+                ("table", "big"), ("table", "small"), ("views", "")]
+            contents = {
+                file.name: gzip.decompress(
+                    (directory / file.filename).read_bytes())
+                for file in files
+            }
+            assert contents["big"].startswith(
+                b"-- MySQL dump\n/*!40101 SET NAMES utf8 */;\n--\n"
+                b"-- Table structure for table `big`")
+            assert b"`small`" not in contents["big"]
+            assert b"GTID_PURGED" not in contents["small"]
+            assert b"CREATE VIEW" in contents[""]
+            assert all(file.checksum.startswith("sha256:") for file in files)
+
+            session = (Path(bindir) / "session.log").read_text()
+            assert session.index("FLUSH TABLES WITH READ LOCK") < \
+                session.index("UNLOCK TABLES")
+
+            provider.restore_backup(backup_file, "copy", jobs=2)
+            restored = sorted(
+                path.read_bytes() for path in Path(bindir).glob("restored-*"))
+            assert restored == sorted(contents.values())
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_parallel_table_backup_error(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        with TemporaryDirectory() as tmpdir, TemporaryDirectory() as bindir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()),
+                mysql_bin_directory=fake_bin_directory(bindir),
+                dump_jobs=2)
+            with mock.patch.object(provider, '_get_tables') as get_tables, \
+                    mock.patch('builtins.print'), raises(Exception) as e:
+                get_tables.return_value = ({"fail": 2, "ok": 1}, ["v"])
+                provider.execute_backup()
+            assert "retcode 6" in str(e.value)
+            assert 'find table: "fail"' in str(e.value)
+            assert "Starting transaction" not in str(e.value)
+            assert provider.get_backups() == []
+
+    def test_parallel_plain_restore(self):
+        dump = (b"-- MySQL dump\n/*!40014 SET FOREIGN_KEY_CHECKS=0 */;\n"
+                b"SET @@GLOBAL.GTID_PURGED='a:1-2';\n"
+                b"-- Table structure for table `a`\n"
+                b"CREATE TABLE `a` (id int);\n"
+                b"-- Dumping data for table `a`\n"
+                b"INSERT INTO `a` VALUES (1);\n"
+                b"-- Table structure for table `b`\n"
+                b"CREATE TABLE `b` (id int);\n"
+                b"-- Dumping data for table `b`\n"
+                b"INSERT INTO `b` VALUES (1);\n")
+        with TemporaryDirectory() as tmpdir, TemporaryDirectory() as bindir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()),
+                mysql_bin_directory=fake_bin_directory(bindir))
+            backup = Path(tmpdir) / "20190101_000000-test.sql.gz"
+            backup.write_bytes(gzip.compress(dump))
+            provider.restore_backup(backup.name, "test", jobs=2)
+            restored = [
+                path.read_bytes() for path in Path(bindir).glob("restored-*")
+            ]
+            assert sorted(os.listdir(tmpdir)) == sorted(
+                [catalog.CATALOG_FILENAME, backup.name])
+        assert len(restored) == 3
+        assert all(
+            content.startswith(b"-- MySQL dump\n/*!40014 SET") for content in
+            restored)
+        assert sum(b"GTID_PURGED" in content for content in restored) == 1
+        assert sorted(
+            content.count(b"INSERT INTO") for content in restored) == [0, 1, 1]
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_table_index(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        dump = (b"-- MySQL dump\n/*!40014 SET FOREIGN_KEY_CHECKS=0 */;\n"
+                b"-- Table structure for table `a`\n"
+                b"CREATE TABLE `a` (id int);\n"
+                b"-- Dumping data for table `a`\n"
+                b"INSERT INTO `a` VALUES (1);\n"
+                b"-- Table structure for table `b`\n"
+                b"CREATE TABLE `b` (id int);\n"
+                b"-- Dumping data for table `b`\n"
+                b"INSERT INTO `b` VALUES (1);\n")
+        with TemporaryDirectory() as tmpdir, TemporaryDirectory() as bindir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()),
+                mysql_bin_directory=fake_bin_directory(bindir),
+                compress="gzip",
+                compress_seekable=True,
+                table_index=True)
+            with mock.patch.object(provider, '_get_backup_command') as cmd, \
+                    mock.patch('builtins.print'):
+                cmd.return_value = [
+                    sys.executable, "-c",
+                    f"import sys; sys.stdout.buffer.write({dump!r})"
+                ]
+                provider.execute_backup()
+            backup_file = provider.get_backups()[0]
+            index_path = Path(tmpdir) / (backup_file + ".idx")
+            index = sqlsplit.read_index(index_path)
+            assert index.size == len(dump)
+            assert [entry.table for entry in index.sections] == [
+                "a", "a", "b", "b"
+            ]
+
+            provider.restore_backup(backup_file, "copy", table="b")
+            restored = [
+                path.read_bytes() for path in Path(bindir).glob("restored-*")
+            ]
+            assert restored == [
+                b"-- MySQL dump\n/*!40014 SET FOREIGN_KEY_CHECKS=0 */;\n"
+                + dump[dump.index(b"-- Table structure for table `b`"):]
+            ]
+            with raises(Exception) as e:
+                provider.restore_backup(backup_file, "copy", table="c")
+            assert "Table c is not in the backup" in str(e.value)
+
+            provider._remove_backup(provider.get_catalog().get(backup_file))
+            assert not index_path.exists()
+
+    def test_parallel_dump_config(self):
+        with raises(Exception) as e:
+            mysql.MySQL('/tmp', dump_jobs=2, dedup=True)
+        assert "can't be dumped in parallel" in str(e.value)
+
+    def test_seekable_compression_config(self):
+        with raises(Exception) as e:
+            mysql.MySQL('/tmp', compress="bz2", compress_seekable=True)
+        assert "bz2 compression can't be seekable" in str(e.value)
+
+    def test_remote_storage_config(self):
+        s3 = storage.S3Storage("backups", client=object())
+        with raises(Exception) as e:
+            mysql.MySQL('/tmp', dump_jobs=2, storage=s3)
+        assert ("directory backups require the backups to be stored "
+                "locally, not in s3://backups/") in str(e.value)
+
+    @unittest.skipIf(not encryption.AESGCM, "requires cryptography")
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_encryption(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        key = encryption.Encryption(bytes(32), workers=2, chunk_size=4096)
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(str(Path(tmpdir).resolve()),
+                                   compress="gzip",
+                                   encryption=key)
+            with mock.patch.object(provider, '_get_backup_command') as cmd:
+                cmd.return_value = ["seq", "100000"]
+                provider.execute_backup()
+            backup_file = provider.get_backups()[0]
+            assert backup_file.endswith(".sql.gz.enc")
+            assert provider.get_catalog().get(backup_file).codec == "gzip"
+            content = (Path(tmpdir) / backup_file).read_bytes()
+            assert content.startswith(encryption.MAGIC)
+
+            restored = Path(tmpdir) / "restored.sql"
+            with mock.patch.object(provider, '_get_restore_command') as cmd:
+                cmd.return_value = [
+                    sys.executable, "-c",
+                    "import shutil, sys; shutil.copyfileobj("
+                    f"sys.stdin.buffer, open({str(restored)!r}, 'wb'))"
+                ]
+                provider.restore_backup(backup_file, "test")
+            expected = "".join(f"{i}\n" for i in range(1, 100001)).encode()
+            assert restored.read_bytes() == expected
+            # Not split on disk with several jobs, which would write it
+            # decrypted
+            restored.unlink()
+            with mock.patch.object(provider, '_get_restore_command') as cmd, \
+                    mock.patch('dbbackup.sqlsplit.split_dump') as split, \
+                    self.assertLogs('dbbackup.providers', 'WARNING') as logs:
+                cmd.return_value = [
+                    sys.executable, "-c",
+                    "import shutil, sys; shutil.copyfileobj("
+                    f"sys.stdin.buffer, open({str(restored)!r}, 'wb'))"
+                ]
+                provider.restore_backup(backup_file, "test", jobs=4)
+            split.assert_not_called()
+            assert "restoring it with a single session" in logs.output[0]
+            assert restored.read_bytes() == expected
+            with mock.patch('builtins.print') as mock_print:
+                provider.scrub()
+            assert mock_print.call_args_list[0][0][0].startswith("OK\t")
+
+            # The key is needed to restore
+            provider.encryption = None
+            with mock.patch.object(provider, '_get_restore_command',
+                                   return_value=["cat"]), \
+                    raises(Exception) as e:
+                provider.restore_backup(backup_file, "test")
+            assert "is encrypted, its key is needed" in str(e.value)
+
+    def test_encryption_config(self):
+        with raises(Exception) as e:
+            mysql.MySQL('/tmp', dump_jobs=2, encryption=object())
+        assert "directory backups can't be encrypted" in str(e.value)
+
+    def test_copies_config(self):
+        with raises(Exception) as e:
+            mysql.MySQL('/tmp', dedup=True,
+                        copies=[storage.LocalStorage('/tmp')])
+        assert ("deduplicated backups (dedup) can't be copied (copies)"
+                in str(e.value))
+
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_copies(self, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        with TemporaryDirectory() as tmpdir, \
+                TemporaryDirectory() as copy_dir:
+            missing = str(Path(copy_dir) / "missing")
+            provider = mysql.MySQL(str(Path(tmpdir).resolve()),
+                                   compress="gzip",
+                                   copies=[
+                                       storage.LocalStorage(copy_dir),
+                                       storage.LocalStorage(missing)
+                                   ])
+            with mock.patch.object(provider, '_get_backup_command') as cmd, \
+                    mock.patch('builtins.print') as mock_print:
+                cmd.return_value = ["seq", "100000"]
+                with raises(Exception) as e:
+                    provider.execute_backup()
+            # The failing copy is reported, the backup and the other copy
+            # are done
+            assert str(e.value).startswith("Could not copy 1 backup(s): ")
+            backup_file = provider.get_backups()[0]
+            assert (Path(copy_dir) / backup_file).read_bytes() == (
+                Path(tmpdir) / backup_file).read_bytes()
+            printed = [call[0][0] for call in mock_print.call_args_list]
+            assert f"COPIED\ttest\t{copy_dir}" in printed
+            assert [line for line in printed
+                    if line.startswith(f"COPY FAILED\ttest\t{missing}\t")]
+            provider.cleanup(0)
+            assert os.listdir(copy_dir) == []
+
+    @s3_test
+    @mock.patch('dbbackup.providers.mysql.MySQL.get_databases', autospec=True)
+    def test_s3_storage(self, client, mock_get_databases):
+        mock_get_databases.return_value = ['test']
+        s3 = storage.S3Storage("backups", prefix="mysql", client=client)
+        with TemporaryDirectory() as tmpdir:
+            provider = mysql.MySQL(
+                str(Path(tmpdir).resolve()), compress="gzip", storage=s3)
+            with mock.patch.object(provider, '_get_backup_command') as cmd:
+                cmd.return_value = ["seq", "100000"]
+                provider.execute_backup()
+            # Only the catalog is local
+            assert os.listdir(tmpdir) == [catalog.CATALOG_FILENAME]
+            backup_file = provider.get_backups()[0]
+            assert s3.get_size(backup_file) == provider.get_catalog().get(
+                backup_file).size
+            expected = "".join(f"{i}\n" for i in range(1, 100001)).encode()
+            with s3.open_reader(backup_file) as f:
+                assert gzip.decompress(f.read()) == expected
+
+            restored = Path(tmpdir) / "restored.sql"
+            with mock.patch.object(provider, '_get_restore_command') as cmd:
+                cmd.return_value = [
+                    sys.executable, "-c",
+                    "import shutil, sys; shutil.copyfileobj("
+                    f"sys.stdin.buffer, open({str(restored)!r}, 'wb'))"
+                ]
+                with self.assertLogs('dbbackup.providers',
+                                     level='INFO') as logs:
+                    provider.restore_backup(backup_file, "test")
+            assert restored.read_bytes() == expected
+            # The throughput of each stage of the restore is reported
+            assert any("download" in line and "decompress" in line
+                       and "restore" in line and "bottleneck" in line
+                       for line in logs.output)
+            with raises(Exception) as e:
+                provider.restore_backup("20190101_000000-test.sql", "test")
+            assert "does not exist" in str(e.value)
+
+            provider.verify_backup(backup_file)
+            with mock.patch('builtins.print') as mock_print:
+                provider.scrub()
+            assert mock_print.call_args_list[0][0][0].startswith("OK\t")
+            provider.reindex()
+            assert provider.get_backups() == [backup_file]
+            provider.cleanup(0)
+            assert not provider.get_backups()
+            assert not s3.list()
+
+    def test_unescape_batch(self):
+        assert mysql.unescape_batch("a\\tb\\\\c\\nd") == "a\tb\\c\nd"
@@ -1,11 +1,18 @@
 import unittest
+import gzip
 import os
+import subprocess
+import tarfile
+import threading
 from unittest import mock
 from pathlib import Path
 import time
 from datetime import datetime, timedelta
+from dbbackup import catalog, encryption, storage
 from dbbackup.providers import postgres
-from tempfile import TemporaryDirectory, _TemporaryFileWrapper
+from tests.test_storage import s3_test
+from tempfile import TemporaryDirectory
+from pytest import raises
 
 
 def Any(cls):
@@ -16,6 +23,38 @@ def Any(cls):
     return Any()
 
 
+def record_restore(restored):
+    """
+    run_from_file side effect, recording the command and the restored content.
+    """
+
+    def run_from_file(command, input):
+        restored.append((command, input.read()))
+        return mock.MagicMock(returncode=0)
+
+    return run_from_file
+
+
+def fake_directory_dump_command(database, output=None):
+    return ["pg_dump", "-Fd", "-f", output, database]
+
+
+def fake_directory_dump(command, check=True, stderr=None):
+    output = Path(command[command.index("-f") + 1])
+    output.mkdir()
+    (output / "toc.dat").write_bytes(b"toc")
+    (output / "3000.dat.gz").write_bytes(b"x" * 17)
+
+
+def get_databases(**sizes):
+    def _get_databases(provider, with_sizes=False):
+        if with_sizes:
+            return list(sizes.items())
+        return list(sizes)
+
+    return _get_databases
+
+
 class TestPostgresProvider(unittest.TestCase):
     @mock.patch(
         'dbbackup.providers.postgres.Postgres.backup_database', autospec=True)
@@ -51,7 +90,110 @@ class TestPostgresProvider(unittest.TestCase):
         provider.register_callback(callback)
         provider.execute_backup()
         callback.backup_done.assert_called_with(
-            Any(str), 'test', '20190101_000000-test-daily.dump', '1024')
+            Any(str),
+            'test',
+            '20190101_000000-test-daily.dump',
+            '1024',
+            checksum=None)
+
+    @mock.patch(
+        'dbbackup.providers.postgres.Postgres.backup_database', autospec=True)
+    @mock.patch(
+        'dbbackup.providers.postgres.Postgres.get_databases', autospec=True)
+    @mock.patch('dbbackup.providers.postgres.get_file_size', autospec=True)
+    def test_execute_backup_jobs_errors(self, mock_get_file_size,
+                                        mock_get_databases,
+                                        mock_backup_database):
+        def backup_database(provider, database):
+            if database == 'broken':
+                raise Exception(f"Could not backup database {database}")
+            return f'20190101_000000-{database}.dump'
+
+        mock_get_file_size.return_value = 1024
+        mock_backup_database.side_effect = backup_database
+        mock_get_databases.side_effect = get_databases(
+            test=1, broken=2, test2=3)
+        provider = postgres.Postgres('/tmp')
+        callback = mock.Mock()
+        provider.callbacks = [callback]
+        with raises(Exception) as e:
+            provider.execute_backup(jobs=2)
+        assert "Could not backup 1 of 3 database(s)" in str(e.value)
+        assert "Could not backup database broken" in str(e.value)
+        assert mock_backup_database.call_count == 3
+        assert callback.backup_done.call_count == 2
+        callback.backup_done.assert_any_call(
+            Any(str), 'test', '20190101_000000-test.dump', 1024, checksum=None)
+        callback.backup_done.assert_any_call(
+            Any(str),
+            'test2',
+            '20190101_000000-test2.dump',
+            1024,
+            checksum=None)
+
+    @mock.patch(
+        'dbbackup.providers.postgres.Postgres.backup_database', autospec=True)
+    @mock.patch(
+        'dbbackup.providers.postgres.Postgres.get_databases', autospec=True)
+    @mock.patch('dbbackup.providers.postgres.get_file_size', autospec=True)
+    def test_execute_backup_jobs_concurrent(self, mock_get_file_size,
+                                            mock_get_databases,
+                                            mock_backup_database):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def backup_database(provider, database):
+            # Both backups must be running at the same time to pass the barrier
+            barrier.wait()
+            return f'20190101_000000-{database}.dump'
+
+        mock_get_file_size.return_value = 1024
+        mock_backup_database.side_effect = backup_database
+        mock_get_databases.side_effect = get_databases(test=1, test2=1)
+        provider = postgres.Postgres('/tmp')
+        results = provider.run_backups(['test', 'test2'], jobs=2)
+        assert [result.database for result in results] == ['test', 'test2']
+        assert not any(result.error for result in results)
+
+    @mock.patch(
+        'dbbackup.providers.postgres.Postgres.backup_database', autospec=True)
+    @mock.patch(
+        'dbbackup.providers.postgres.Postgres.get_databases', autospec=True)
+    @mock.patch('dbbackup.providers.postgres.get_file_size', autospec=True)
+    def test_execute_backup_jobs_largest_first(
+            self, mock_get_file_size, mock_get_databases,
+            mock_backup_database):
+        mock_get_file_size.return_value = 1024
+        mock_backup_database.return_value = '20190101_000000-test.dump'
+        mock_get_databases.side_effect = get_databases(
+            small=1, big=100, medium=10)
+        provider = postgres.Postgres('/tmp')
+        provider.execute_backup(jobs=1)
+        mock_backup_database.assert_has_calls([
+            mock.call(provider, 'small'),
+            mock.call(provider, 'big'),
+            mock.call(provider, 'medium')
+        ])
+        mock_backup_database.reset_mock()
+        provider.execute_backup(jobs=2)
+        assert mock_backup_database.call_args_list[0] == mock.call(
+            provider, 'big')
+
+    @mock.patch('builtins.print')
+    @mock.patch(
+        'dbbackup.providers.postgres.Postgres.backup_database', autospec=True)
+    @mock.patch(
+        'dbbackup.providers.postgres.Postgres.get_databases', autospec=True)
+    def test_execute_backup_plan(self, mock_get_databases,
+                                 mock_backup_database, mock_print):
+        mock_get_databases.side_effect = get_databases(
+            a=1024, b=3072, c=2048)
+        provider = postgres.Postgres('/tmp')
+        provider.execute_backup(jobs=2, plan=True, throughput=1)
+        assert not mock_backup_database.called
+        mock_print.assert_any_call("Worker 1\t3.0KiB\tb")
+        mock_print.assert_any_call("Worker 2\t3.0KiB\tc, a")
+        mock_print.assert_any_call(
+            "Predicted makespan: 3.0KiB (0:00:00 at 1MiB/s)")
 
     @mock.patch('dbbackup.providers.postgres.TemporaryBackupFile.close')
     @mock.patch('dbbackup.providers.postgres.subprocess.run')
@@ -60,23 +202,23 @@ class TestPostgresProvider(unittest.TestCase):
                                     mock_close):
         _get_backup_command.return_value = "cmd"
         mock_close.return_value = True
-        provider = postgres.Postgres('/tmp')
+        # Without checksum, the dump is written directly to the file
+        provider = postgres.Postgres('/tmp', checksum=None)
         provider.backup_database('test_database')
         assert mock_run.call_args[0][0] == 'cmd'
-        assert isinstance(mock_run.call_args[1]['stdout'],
-                          _TemporaryFileWrapper)
+        assert mock_run.call_args[1]['stdout'].name.endswith('.partial')
 
-    @mock.patch('dbbackup.providers.postgres.Postgres._is_older_than')
+    @mock.patch('dbbackup.providers.postgres.Postgres.get_catalog')
     @mock.patch('dbbackup.providers.postgres.Postgres._remove')
-    @mock.patch('dbbackup.providers.postgres.Postgres.get_backups')
-    def test_cleanup_called(self, mock_get_backups, mock_remove,
-                            mock_is_older_than):
-        mock_get_backups.return_value = ["backup_one"]
-        mock_is_older_than.return_value = True
+    def test_cleanup_called(self, mock_remove, mock_get_catalog):
+        mock_get_catalog.return_value.find.return_value = [
+            mock.Mock(filename="backup_one")
+        ]
         mock_remove.return_value = True
         provider = postgres.Postgres('/tmp')
         provider.cleanup(0)
         assert mock_remove.called
+        mock_get_catalog.return_value.remove.assert_called_with("backup_one")
 
     def test_cleanup_zero_days(self):
         with TemporaryDirectory() as tmpdir:
@@ -126,3 +268,326 @@ class TestPostgresProvider(unittest.TestCase):
         provider = postgres.Postgres('/tmp', backup_suffix="-daily")
         backup_filename = provider.construct_backup_filename("test")
         assert backup_filename == "20190101_000000-test-daily.dump"
+
+    def test_is_backup_compressed(self):
+        provider = postgres.Postgres('/tmp')
+        assert provider.is_backup("20190101_000000-test-daily.dump")
+        assert provider.is_backup("20190101_000000-test-daily.sql.gz")
+        assert provider.is_backup("20190101_000000-test-daily.tar.xz")
+        assert provider.is_backup("20190101_000000-test-daily.sql.bz2")
+        assert not provider.is_backup("20190101_000000-test-daily.txt.gz")
+
+    def test_directory_backup_filename(self):
+        provider = postgres.Postgres('/tmp', backup_type='d')
+        with mock.patch.object(provider, '_get_formatted_current_datetime'
+                               ) as mock_datetime:
+            mock_datetime.return_value = "20190101_000000"
+            assert provider.construct_backup_filename(
+                "test") == "20190101_000000-test.dir"
+        assert provider.is_backup("20190101_000000-test.dir")
+        assert provider.is_backup("20190101_000000-test.dir.tar.gz")
+
+    @mock.patch('subprocess.check_output')
+    def test_change_marker(self, mock_check_output):
+        mock_check_output.return_value = (
+            b"0/1A2B3C4:10:2:1:2019-01-01 00:00:00+00\n")
+        provider = postgres.Postgres('/tmp', psql_bin_directory='/bin')
+        with mock.patch('pathlib.Path.exists', return_value=True):
+            assert provider.get_change_marker(
+                "test") == "0/1A2B3C4:10:2:1:2019-01-01 00:00:00+00"
+        command = mock_check_output.call_args[0][0]
+        assert command[command.index('-d') + 1] == "test"
+        assert "pg_stat_database" in command[-1]
+        assert "pg_current_wal_lsn()" in command[-1]
+
+    def test_directory_backup_config(self):
+        with raises(Exception) as e:
+            postgres.Postgres('/tmp', dump_jobs=4)
+        assert "require the directory backup_type" in str(e.value)
+        with raises(Exception) as e:
+            postgres.Postgres('/tmp', backup_type='d', compress=True)
+        assert "only be compressed when packed" in str(e.value)
+        with raises(Exception) as e:
+            postgres.Postgres('/tmp', backup_type='d', dedup=True)
+        assert "require a single file backup_type" in str(e.value)
+        with raises(Exception) as e:
+            postgres.Postgres('/tmp', backup_type='c', table_index=True)
+        assert "require the plain backup_type" in str(e.value)
+
+    @mock.patch('dbbackup.providers.postgres.subprocess.run')
+    @mock.patch('dbbackup.providers.postgres.Postgres._get_backup_command')
+    def test_directory_backup(self, mock_get_backup_command, mock_run):
+        mock_run.side_effect = fake_directory_dump
+        mock_get_backup_command.side_effect = fake_directory_dump_command
+        with TemporaryDirectory() as tmpdir:
+            provider = postgres.Postgres(
+                str(Path(tmpdir).resolve()), backup_type='d', dump_jobs=4)
+            filename = provider.backup_database("test")
+            output = mock_get_backup_command.call_args[1]['output']
+            assert output.endswith(".dir.partial")
+            assert os.listdir(tmpdir) == [filename]
+            assert sorted(os.listdir(Path(tmpdir) / filename)) == [
+                "3000.dat.gz", "toc.dat"
+            ]
+            assert provider.get_backups() == [filename]
+            assert provider.get_catalog().get(filename).format == ".dir"
+            assert postgres.get_file_size(str(Path(tmpdir) / filename)) == 20
+            provider.cleanup(0)
+            assert os.listdir(tmpdir) == [catalog.CATALOG_FILENAME]
+
+    @mock.patch('dbbackup.providers.postgres.subprocess.run')
+    @mock.patch('dbbackup.providers.postgres.Postgres._get_backup_command')
+    def test_directory_backup_packed(self, mock_get_backup_command,
+                                     mock_run):
+        mock_run.side_effect = fake_directory_dump
+        mock_get_backup_command.side_effect = fake_directory_dump_command
+        with TemporaryDirectory() as tmpdir:
+            provider = postgres.Postgres(
+                str(Path(tmpdir).resolve()),
+                backup_type='d',
+                pack_directory=True,
+                compress="gzip")
+            filename = provider.backup_database("test")
+            assert filename.endswith(".dir.tar")
+            assert os.listdir(tmpdir) == [filename + ".gz"]
+            with tarfile.open(Path(tmpdir) / (filename + ".gz")) as tar:
+                assert sorted(tar.getnames()) == [
+                    filename[:-4], filename[:-4] + "/3000.dat.gz",
+                    filename[:-4] + "/toc.dat"
+                ]
+            unpacked = provider._unpack_directory(
+                str(Path(tmpdir) / (filename + ".gz")), tmpdir)
+            assert (unpacked / "toc.dat").read_bytes() == b"toc"
+
+    @mock.patch('dbbackup.providers.postgres.subprocess.run')
+    @mock.patch('dbbackup.providers.postgres.Postgres._get_backup_command')
+    def test_restore_directory_packed(self, mock_get_backup_command,
+                                      mock_run):
+        mock_run.side_effect = fake_directory_dump
+        mock_get_backup_command.side_effect = fake_directory_dump_command
+        with TemporaryDirectory() as tmpdir, \
+                TemporaryDirectory() as temp_directory:
+            provider = postgres.Postgres(str(Path(tmpdir).resolve()),
+                                         backup_type='d',
+                                         pack_directory=True,
+                                         temp_directory=temp_directory)
+            filename = provider.backup_database("test")
+            mock_run.side_effect = None
+            with mock.patch.object(provider, '_get_restore_command',
+                                   return_value=["pg_restore"]), \
+                    mock.patch('dbbackup.providers.postgres.tempfile.mkdtemp',
+                               wraps=postgres.tempfile.mkdtemp) as mkdtemp:
+                provider.restore_backup(filename, "test")
+            # The directory is extracted in the temporary directory
+            assert mkdtemp.call_args[1] == {"dir": temp_directory}
+            command = mock_run.call_args[0][0]
+            assert command[-1].startswith(temp_directory)
+            assert os.listdir(temp_directory) == []
+
+    def test_encryption_config(self):
+        with raises(Exception) as e:
+            postgres.Postgres('/tmp',
+                              backup_type='d',
+                              pack_directory=True,
+                              encryption=object())
+        assert "directory backups can't be encrypted" in str(e.value)
+
+    @unittest.skipIf(not encryption.AESGCM, "requires cryptography")
+    def test_restore_encrypted_directory_packed(self):
+        with TemporaryDirectory() as tmpdir:
+            provider = postgres.Postgres(
+                str(Path(tmpdir).resolve()),
+                encryption=encryption.Encryption(bytes(32)))
+            packed = Path(tmpdir) / "20190101_000000-test.dir.tar.enc"
+            packed.write_bytes(b"")
+            with raises(Exception) as e:
+                provider.restore_backup(packed.name, "test")
+            assert "can't be restored without writing it decrypted" in str(
+                e.value)
+
+    @mock.patch('dbbackup.providers.postgres.subprocess.run')
+    @mock.patch('dbbackup.providers.postgres.Postgres._get_backup_command')
+    def test_directory_backup_failure(self, mock_get_backup_command,
+                                      mock_run):
+        mock_run.side_effect = subprocess.CalledProcessError(
+            1, "pg_dump", stderr=b"pg_dump: error: connection failed")
+        with TemporaryDirectory() as tmpdir:
+            provider = postgres.Postgres(
+                str(Path(tmpdir).resolve()), backup_type='d')
+            with raises(Exception) as e:
+                provider.backup_database("test")
+            assert "Could not backup database test" in str(e.value)
+            assert "connection failed" in str(e.value)
+            assert mock_run.call_args[1]['stderr'] == subprocess.PIPE
+            assert os.listdir(tmpdir) == []
+
+    def test_directory_backup_command(self):
+        provider = postgres.Postgres('/tmp', backup_type='d', dump_jobs=4)
+        with mock.patch('dbbackup.providers.postgres.Path.exists') as exists:
+            exists.return_value = True
+            command = provider._get_backup_command(
+                "test", output="/tmp/test.dir")
+        assert command[1:] == [
+            "-Fd", "--jobs=4", "-f", "/tmp/test.dir", "test"
+        ]
+
+    def test_restore_jobs(self):
+        provider = postgres.Postgres('/tmp')
+        with TemporaryDirectory() as tmpdir:
+            custom = Path(tmpdir) / "20190101_000000-test.dump"
+            custom.write_bytes(b"PGDMP")
+            tar = Path(tmpdir) / "20190101_000000-test.tar"
+            tar.write_bytes(b"")
+            directory = Path(tmpdir) / "20190101_000000-test.dir"
+            directory.mkdir()
+            assert provider._get_restore_jobs(str(custom), 4) == 4
+            assert provider._get_restore_jobs(str(directory), 4) == 4
+            with self.assertLogs('dbbackup.providers.postgres',
+                                 level='WARNING') as logs:
+                assert provider._get_restore_jobs(str(tar), 4) == 1
+            assert ("can only restore custom (.dump) and directory (.dir)"
+                    in logs.output[0])
+            assert provider._get_restore_jobs(str(tar), 1) == 1
+
+    @mock.patch('dbbackup.providers.postgres.subprocess.run')
+    @mock.patch('dbbackup.providers.postgres.Path.exists')
+    def test_restore_parallel_command(self, mock_exists, mock_run):
+        mock_exists.return_value = True
+        with TemporaryDirectory() as tmpdir:
+            provider = postgres.Postgres(str(Path(tmpdir).resolve()))
+            custom = Path(tmpdir) / "20190101_000000-test.dump"
+            custom.write_bytes(b"PGDMP")
+            provider.restore_backup(custom.name, "test", jobs=4)
+            command = mock_run.call_args[0][0]
+            assert "--jobs=4" in command
+            assert command[-1] == str(custom.resolve())
+
+    @mock.patch('dbbackup.providers.postgres.subprocess.run')
+    @mock.patch('dbbackup.providers.postgres.Path.exists')
+    def test_restore_archive_table(self, mock_exists, mock_run):
+        mock_exists.return_value = True
+        with TemporaryDirectory() as tmpdir:
+            provider = postgres.Postgres(str(Path(tmpdir).resolve()))
+            custom = Path(tmpdir) / "20190101_000000-test.dump"
+            custom.write_bytes(b"PGDMP")
+            provider.restore_backup(custom.name, "test", table="public.t")
+            command = mock_run.call_args[0][0]
+            assert "--schema=public" in command
+            assert "--table=t" in command
+
+    @mock.patch('dbbackup.providers.postgres.run_from_file')
+    @mock.patch('dbbackup.providers.postgres.Path.exists')
+    def test_restore_plain_streaming(self, mock_exists, mock_run_from_file):
+        mock_exists.return_value = True
+        restored = []
+        mock_run_from_file.side_effect = record_restore(restored)
+        with TemporaryDirectory() as tmpdir:
+            provider = postgres.Postgres(str(Path(tmpdir).resolve()))
+            plain = Path(tmpdir) / "20190101_000000-test.sql.gz"
+            plain.write_bytes(gzip.compress(b"select 1;"))
+            provider.restore_backup(plain.name, "test")
+            assert sorted(os.listdir(tmpdir)) == [
+                catalog.CATALOG_FILENAME, plain.name
+            ]
+        command, content = restored[0]
+        assert command[0].endswith("psql")
+        assert "ON_ERROR_STOP=1" in command
+        assert command[-2:] == ["-d", "test"]
+        assert content == b"select 1;"
+
+    @mock.patch('dbbackup.providers.run_from_file')
+    @mock.patch('dbbackup.providers.postgres.Path.exists')
+    def test_restore_plain_parallel(self, mock_exists, mock_run_from_file):
+        mock_exists.return_value = True
+        restored = []
+        mock_run_from_file.side_effect = record_restore(restored)
+        dump = (b"SET client_encoding = 'UTF8';\n"
+                b"-- Name: t; Type: TABLE; Schema: public; Owner: o\n"
+                b"CREATE TABLE public.t (id int);\n"
+                b"-- Data for Name: t; Type: TABLE DATA; Schema: public; "
+                b"Owner: o\n"
+                b"COPY public.t (id) FROM stdin;\n1\n\\.\n"
+                b"-- Name: t t_pkey; Type: CONSTRAINT; Schema: public; "
+                b"Owner: o\n"
+                b"ALTER TABLE ONLY public.t ADD CONSTRAINT t_pkey "
+                b"PRIMARY KEY (id);\n")
+        with TemporaryDirectory() as tmpdir:
+            provider = postgres.Postgres(str(Path(tmpdir).resolve()))
+            plain = Path(tmpdir) / "20190101_000000-test.sql.gz"
+            plain.write_bytes(gzip.compress(dump))
+            provider.restore_backup(plain.name, "test", jobs=4)
+            assert sorted(os.listdir(tmpdir)) == [
+                catalog.CATALOG_FILENAME, plain.name
+            ]
+        assert all(command[-2:] == ["-d", "test"] for command, _ in restored)
+        # The constraints are added once the data is loaded
+        assert [content.count(b"\n") for _, content in restored] == [3, 5, 3]
+        assert b"CREATE TABLE" in restored[0][1]
+        assert b"COPY" in restored[1][1]
+        assert b"PRIMARY KEY" in restored[2][1]
+
+    @mock.patch('dbbackup.providers.postgres.run_from_file')
+    @mock.patch('dbbackup.providers.postgres.Path.exists')
+    def test_restore_compressed_custom_streaming(self, mock_exists,
+                                                 mock_run_from_file):
+        mock_exists.return_value = True
+        restored = []
+        mock_run_from_file.side_effect = record_restore(restored)
+        with TemporaryDirectory() as tmpdir:
+            provider = postgres.Postgres(str(Path(tmpdir).resolve()))
+            custom = Path(tmpdir) / "20190101_000000-test.dump.gz"
+            custom.write_bytes(gzip.compress(b"PGDMP"))
+            with self.assertLogs('dbbackup.providers.postgres',
+                                 level='WARNING'):
+                provider.restore_backup(custom.name, "test", jobs=4)
+        command, content = restored[0]
+        assert command[0].endswith("pg_restore")
+        assert "--jobs=4" not in command
+        assert command[-2:] == ["-d", "test"]
+        assert content == b"PGDMP"
+
+    @unittest.skipIf(not encryption.AESGCM, "requires cryptography")
+    @mock.patch('dbbackup.providers.postgres.run_from_file')
+    @mock.patch('dbbackup.providers.postgres.Path.exists')
+    def test_restore_encrypted_custom_streaming(self, mock_exists,
+                                                mock_run_from_file):
+        mock_exists.return_value = True
+        restored = []
+        mock_run_from_file.side_effect = record_restore(restored)
+        key = encryption.Encryption(bytes(32))
+        with TemporaryDirectory() as tmpdir:
+            provider = postgres.Postgres(str(Path(tmpdir).resolve()),
+                                         encryption=key)
+            custom = Path(tmpdir) / "20190101_000000-test.dump.enc"
+            with open(custom, "wb") as f, key.open_writer(f) as writer:
+                writer.write(b"PGDMP")
+            with self.assertLogs('dbbackup.providers.postgres',
+                                 level='WARNING'):
+                provider.restore_backup(custom.name, "test", jobs=4)
+        # pg_restore reads the archive from its stdin, as it is decrypted
+        command, content = restored[0]
+        assert command[-2:] == ["-d", "test"]
+        assert content == b"PGDMP"
+
+    @s3_test
+    @mock.patch('dbbackup.providers.postgres.run_from_file')
+    def test_restore_remote_custom_streaming(self, client,
+                                             mock_run_from_file):
+        restored = []
+        mock_run_from_file.side_effect = record_restore(restored)
+        client.put_object(
+            Bucket="backups", Key="20190101_000000-test.dump", Body=b"PGDMP")
+        s3 = storage.S3Storage("backups", client=client)
+        with TemporaryDirectory() as tmpdir, \
+                mock.patch.object(postgres.Postgres, "_get_restore_command",
+                                  return_value=["pg_restore"]):
+            provider = postgres.Postgres(
+                str(Path(tmpdir).resolve()), storage=s3)
+            with self.assertLogs('dbbackup.providers.postgres',
+                                 level='WARNING'):
+                provider.restore_backup("20190101_000000-test.dump",
+                                        "test", jobs=4)
+        # pg_restore reads the archive from its stdin, as it is downloaded
+        command, content = restored[0]
+        assert command == ["pg_restore", "-d", "test"]
+        assert content == b"PGDMP"
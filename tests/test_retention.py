@@ -0,0 +1,81 @@
+import unittest
+from datetime import datetime, timedelta
+
+from pytest import raises
+
+from dbbackup import retention
+
+
+def hourly_backups(hours, end=datetime(2019, 12, 31, 23)):
+    return [(f"backup-{hour}", end - timedelta(hours=hour))
+            for hour in range(hours)]
+
+
+def kept(decisions):
+    return [decision.name for decision in decisions if decision.tiers]
+
+
+class TestRetention(unittest.TestCase):
+    def test_parse_policy(self):
+        policy = retention.parse_policy("hourly=24, daily=14,weekly=8")
+        assert list(policy.items()) == [("hourly", 24), ("daily", 14),
+                                        ("weekly", 8)]
+
+    def test_parse_policy_errors(self):
+        with raises(Exception) as e:
+            retention.parse_policy("fortnightly=2")
+        assert "Unknown retention tier fortnightly" in str(e.value)
+        with raises(Exception) as e:
+            retention.parse_policy("daily=many")
+        assert "Invalid retention count" in str(e.value)
+        with raises(Exception) as e:
+            retention.parse_policy("daily=0")
+        assert "must keep at least one backup" in str(e.value)
+        with raises(Exception):
+            retention.parse_policy(False)
+
+    def test_parse_timestamp(self):
+        assert retention.parse_timestamp("20190102_030405") == datetime(
+            2019, 1, 2, 3, 4, 5)
+
+    def test_select_hourly(self):
+        decisions = retention.select(
+            hourly_backups(48), retention.parse_policy("hourly=24"))
+        assert kept(decisions) == [f"backup-{hour}" for hour in range(24)]
+        assert len(decisions) == 48
+
+    def test_select_daily_keeps_most_recent_of_each_day(self):
+        decisions = retention.select(
+            hourly_backups(24 * 5), retention.parse_policy("daily=3"))
+        # 23:00 is the most recent backup of each day
+        assert kept(decisions) == ["backup-0", "backup-24", "backup-48"]
+
+    def test_select_tiers(self):
+        backups = hourly_backups(24 * 400)
+        decisions = retention.select(
+            backups,
+            retention.parse_policy("hourly=24,daily=14,weekly=8,monthly=12"))
+        assert decisions[0].tiers == ("hourly", "daily", "weekly", "monthly")
+        # Overlapping tiers: 24 hours, 13 other days, weeks and months
+        kept_decisions = [decision for decision in decisions if decision.tiers]
+        assert len([d for d in kept_decisions if "hourly" in d.tiers]) == 24
+        assert len([d for d in kept_decisions if "daily" in d.tiers]) == 14
+        assert len([d for d in kept_decisions if "weekly" in d.tiers]) == 8
+        assert len([d for d in kept_decisions if "monthly" in d.tiers]) == 12
+        assert len(kept_decisions) < 24 + 14 + 8 + 12
+
+    def test_select_unordered(self):
+        backups = hourly_backups(10)
+        decisions = retention.select(
+            list(reversed(backups)), retention.parse_policy("hourly=2"))
+        assert [decision.name for decision in decisions
+                ] == [name for name, _ in backups]
+        assert kept(decisions) == ["backup-0", "backup-1"]
+
+    def test_select_gaps(self):
+        # Days without backups do not count
+        backups = [("a", datetime(2019, 1, 10)), ("b", datetime(2019, 1, 5)),
+                   ("c", datetime(2019, 1, 1))]
+        decisions = retention.select(backups,
+                                     retention.parse_policy("daily=2"))
+        assert kept(decisions) == ["a", "b"]
@@ -0,0 +1,32 @@
+import unittest
+
+from dbbackup import scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    def test_schedule_largest_first(self):
+        plan = scheduler.schedule({"a": 1, "b": 400, "c": 50, "d": 50}, 2)
+        assert plan.order == ["b", "c", "d", "a"]
+        assert plan.workers[0].databases == ["b"]
+        assert plan.workers[1].databases == ["c", "d", "a"]
+        assert plan.makespan == 400
+
+    def test_schedule_balanced(self):
+        plan = scheduler.schedule({"a": 7, "b": 5, "c": 4, "d": 3, "e": 1}, 2)
+        assert sorted(worker.load for worker in plan.workers) == [10, 10]
+        assert plan.makespan == 10
+
+    def test_schedule_single_worker(self):
+        plan = scheduler.schedule({"a": 1, "b": 2}, 1)
+        assert plan.workers[0].databases == ["b", "a"]
+        assert plan.makespan == 3
+
+    def test_schedule_more_workers_than_databases(self):
+        plan = scheduler.schedule({"a": 1}, 4)
+        assert len(plan.workers) == 4
+        assert plan.makespan == 1
+
+    def test_schedule_empty(self):
+        plan = scheduler.schedule({}, 2)
+        assert plan.order == []
+        assert plan.makespan == 0
@@ -0,0 +1,301 @@
+import io
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pytest import raises
+
+from dbbackup import sqlsplit
+
+MYSQL_DUMP = (b"-- MySQL dump\n"
+              b"/*!40014 SET FOREIGN_KEY_CHECKS=0 */;\n"
+              b"SET @@GLOBAL.GTID_PURGED=/*!80000 '+'*/ 'a:1-2,\n"
+              b"b:1-3';\n"
+              b"--\n"
+              b"-- Table structure for table `a`\n"
+              b"CREATE TABLE `a` (id int);\n"
+              b"-- Dumping data for table `a`\n"
+              b"INSERT INTO `a` VALUES (1),(2);\n"
+              b"-- Temporary view structure for view `v`\n"
+              b"CREATE TABLE `v` (id int);\n"
+              b"-- Table structure for table `b``c`\n"
+              b"CREATE TABLE `b``c` (id int);\n"
+              b"-- Dumping data for table `b``c`\n"
+              b"INSERT INTO `b``c` VALUES (1);\n"
+              b"-- Final view structure for view `v`\n"
+              b"CREATE VIEW `v` AS SELECT * FROM `a`;\n"
+              b"-- Dump completed\n")
+
+POSTGRES_DUMP = (b"-- PostgreSQL database dump\n"
+                 b"SET client_encoding = 'UTF8';\n"
+                 b"-- Name: t; Type: TABLE; Schema: public; Owner: o\n"
+                 b"CREATE TABLE public.t (id int, v text);\n"
+                 b"-- Name: t_id_seq; Type: SEQUENCE; Schema: public; "
+                 b"Owner: o\n"
+                 b"CREATE SEQUENCE public.t_id_seq;\n"
+                 b"-- Data for Name: t; Type: TABLE DATA; Schema: public; "
+                 b"Owner: o\n"
+                 b"COPY public.t (id, v) FROM stdin;\n"
+                 b"1\tfirst\n"
+                 b"-- Name: x; Type: INDEX; Schema: public; Owner: o\n"
+                 b"\\.\n"
+                 b"-- Data for Name: u; Type: TABLE DATA; Schema: public; "
+                 b"Owner: o\n"
+                 b"COPY public.u (id) FROM stdin;\n"
+                 b"1\n"
+                 b"\\.\n"
+                 b"-- Name: t_id_seq; Type: SEQUENCE SET; Schema: public; "
+                 b"Owner: o\n"
+                 b"SELECT pg_catalog.setval('public.t_id_seq', 1, true);\n"
+                 b"-- Name: t t_pkey; Type: CONSTRAINT; Schema: public; "
+                 b"Owner: o\n"
+                 b"ALTER TABLE ONLY public.t ADD CONSTRAINT t_pkey "
+                 b"PRIMARY KEY (id);\n"
+                 b"-- Name: u u_t; Type: FK CONSTRAINT; Schema: public; "
+                 b"Owner: o\n"
+                 b"ALTER TABLE ONLY public.u ADD CONSTRAINT u_t "
+                 b"FOREIGN KEY (id) REFERENCES public.t(id);\n")
+
+SERIAL_DUMP = (b"-- PostgreSQL database dump\n"
+               b"-- Name: users; Type: TABLE; Schema: public; Owner: o\n"
+               b"CREATE TABLE public.users (id integer NOT NULL);\n"
+               b"-- Name: users_id_seq; Type: SEQUENCE; Schema: public; "
+               b"Owner: o\n"
+               b"CREATE SEQUENCE public.users_id_seq AS integer;\n"
+               b"ALTER TABLE public.users_id_seq OWNER TO o;\n"
+               b"-- Name: users_id_seq; Type: SEQUENCE OWNED BY; "
+               b"Schema: public; Owner: o\n"
+               b"ALTER SEQUENCE public.users_id_seq "
+               b"OWNED BY public.users.id;\n"
+               b"-- Name: Items; Type: TABLE; Schema: public; Owner: o\n"
+               b"CREATE TABLE public.\"Items\" (id integer NOT NULL);\n"
+               b"-- Name: Items_id_seq; Type: SEQUENCE; Schema: public; "
+               b"Owner: o\n"
+               b"ALTER TABLE public.\"Items\" ALTER COLUMN id "
+               b"ADD GENERATED ALWAYS AS IDENTITY (\n"
+               b"    SEQUENCE NAME public.\"Items_id_seq\"\n"
+               b");\n"
+               b"-- Name: other_seq; Type: SEQUENCE; Schema: public; "
+               b"Owner: o\n"
+               b"CREATE SEQUENCE public.other_seq;\n"
+               b"-- Name: users id; Type: DEFAULT; Schema: public; Owner: o\n"
+               b"ALTER TABLE ONLY public.users ALTER COLUMN id SET DEFAULT "
+               b"nextval('public.users_id_seq'::regclass);\n"
+               b"-- Data for Name: Items; Type: TABLE DATA; Schema: public; "
+               b"Owner: o\n"
+               b"COPY public.\"Items\" (id) FROM stdin;\n"
+               b"1\n"
+               b"\\.\n"
+               b"-- Data for Name: users; Type: TABLE DATA; Schema: public; "
+               b"Owner: o\n"
+               b"COPY public.users (id) FROM stdin;\n"
+               b"1\n"
+               b"\\.\n"
+               b"-- Name: Items_id_seq; Type: SEQUENCE SET; Schema: public; "
+               b"Owner: o\n"
+               b"SELECT pg_catalog.setval('public.\"Items_id_seq\"', 1, "
+               b"true);\n"
+               b"-- Name: other_seq; Type: SEQUENCE SET; Schema: public; "
+               b"Owner: o\n"
+               b"SELECT pg_catalog.setval('public.other_seq', 5, true);\n"
+               b"-- Name: users_id_seq; Type: SEQUENCE SET; Schema: public; "
+               b"Owner: o\n"
+               b"SELECT pg_catalog.setval('public.users_id_seq', 1, true);\n"
+               b"-- Name: users users_pkey; Type: CONSTRAINT; "
+               b"Schema: public; Owner: o\n"
+               b"ALTER TABLE ONLY public.users ADD CONSTRAINT users_pkey "
+               b"PRIMARY KEY (id);\n")
+
+
+def read(section):
+    return Path(section.path).read_bytes()
+
+
+class TestSqlSplit(unittest.TestCase):
+    def test_split_mysql_dump(self):
+        with TemporaryDirectory() as tmpdir:
+            schema, data, post_data = sqlsplit.split_dump(
+                io.BytesIO(MYSQL_DUMP), sqlsplit.MySQLDialect(), tmpdir)
+            assert [s.name for s in data] == ["a", "b`c"]
+            # The GTID set is only restored by the first section
+            header = (b"-- MySQL dump\n"
+                      b"/*!40014 SET FOREIGN_KEY_CHECKS=0 */;\n")
+            assert read(schema[0]).startswith(MYSQL_DUMP[:MYSQL_DUMP.index(
+                b"-- Table structure")])
+            assert read(schema[0]).endswith(b"CREATE TABLE `v` (id int);\n"
+                                            b"-- Table structure for table "
+                                            b"`b``c`\n"
+                                            b"CREATE TABLE `b``c` (id int);\n")
+            assert read(data[0]) == (header
+                                     + b"-- Dumping data for table `a`\n"
+                                     b"INSERT INTO `a` VALUES (1),(2);\n")
+            assert data[0].size == len(read(data[0]))
+            assert read(post_data[0]) == (
+                header + b"-- Final view structure for view `v`\n"
+                b"CREATE VIEW `v` AS SELECT * FROM `a`;\n"
+                b"-- Dump completed\n")
+
+    def test_split_postgres_dump(self):
+        header = (b"-- PostgreSQL database dump\n"
+                  b"SET client_encoding = 'UTF8';\n")
+        with TemporaryDirectory() as tmpdir:
+            schema, data, post_data = sqlsplit.split_dump(
+                io.BytesIO(POSTGRES_DUMP), sqlsplit.PostgresDialect(), tmpdir)
+            assert [s.name for s in data] == ["public.t", "public.u", ""]
+            assert read(schema[0]).startswith(header)
+            assert b"CREATE SEQUENCE" in read(schema[0])
+            # The COPY data is never taken for a section
+            assert read(data[0]).endswith(
+                b"1\tfirst\n"
+                b"-- Name: x; Type: INDEX; Schema: public; Owner: o\n"
+                b"\\.\n")
+            assert read(data[2]).endswith(
+                b"SELECT pg_catalog.setval('public.t_id_seq', 1, true);\n")
+            assert len(post_data) == 1
+            assert read(post_data[0]).startswith(header)
+            assert b"PRIMARY KEY" in read(post_data[0])
+            assert read(post_data[0]).endswith(b"REFERENCES public.t(id);\n")
+
+    def test_split_without_sections(self):
+        with TemporaryDirectory() as tmpdir:
+            schema, data, post_data = sqlsplit.split_dump(
+                io.BytesIO(b"select 1;\n"), sqlsplit.PostgresDialect(),
+                tmpdir)
+            assert read(schema[0]) == b"select 1;\n"
+            assert data == post_data == []
+
+    def test_index(self):
+        indexer = sqlsplit.SectionIndexer(sqlsplit.MySQLDialect())
+        # Lines are cut across blocks
+        for offset in range(0, len(MYSQL_DUMP), 7):
+            indexer.feed(MYSQL_DUMP[offset:offset + 7])
+        index = indexer.index()
+        assert index.size == len(MYSQL_DUMP)
+        assert [(entry.phase, entry.table) for entry in index.sections] == [
+            ("schema", ""), ("schema", "a"), ("data", "a"), ("schema", ""),
+            ("schema", "b`c"), ("data", "b`c"), ("post-data", "")
+        ]
+        assert MYSQL_DUMP[index.sections[1].offset:].startswith(
+            b"-- Table structure for table `a`\n")
+
+        whole = sqlsplit.SectionIndexer(sqlsplit.MySQLDialect())
+        whole.feed(MYSQL_DUMP)
+        assert whole.index() == index
+
+    def test_index_copy_data(self):
+        indexer = sqlsplit.SectionIndexer(sqlsplit.PostgresDialect())
+        indexer.feed(POSTGRES_DUMP)
+        sections = indexer.index().sections
+        assert [entry.table for entry in sections] == [
+            "public.t", "", "public.t", "public.u", "", "public.t", "public.u"
+        ]
+
+    def test_index_long_lines(self):
+        dump = (b"-- Table structure for table `a`\n"
+                + b"INSERT INTO `a` VALUES " + b"(1)," * 100 + b"(1);\n"
+                b"-- Dumping data for table `a`\n")
+        indexer = sqlsplit.SectionIndexer(sqlsplit.MySQLDialect())
+        for offset in range(0, len(dump), 40):
+            indexer.feed(dump[offset:offset + 40])
+        assert [entry.offset for entry in indexer.index().sections] == [
+            0, dump.index(b"-- Dumping")
+        ]
+
+    def test_read_write_index(self):
+        indexer = sqlsplit.SectionIndexer(sqlsplit.MySQLDialect())
+        indexer.feed(MYSQL_DUMP)
+        with TemporaryDirectory() as tmpdir:
+            path = sqlsplit.get_index_path(Path(tmpdir) / "test.sql.gz")
+            assert path.name == "test.sql.gz.idx"
+            sqlsplit.write_index(path, indexer.index())
+            assert sqlsplit.read_index(path) == indexer.index()
+
+    def test_table_ranges(self):
+        indexer = sqlsplit.SectionIndexer(sqlsplit.MySQLDialect())
+        indexer.feed(MYSQL_DUMP)
+        ranges = sqlsplit.get_table_ranges(indexer.index(), "a")
+        # The header, without the GTID_PURGED statement, then the table
+        assert b"".join(MYSQL_DUMP[start:end] for start, end in ranges) == (
+            b"-- MySQL dump\n"
+            b"/*!40014 SET FOREIGN_KEY_CHECKS=0 */;\n"
+            b"-- Table structure for table `a`\n"
+            b"CREATE TABLE `a` (id int);\n"
+            b"-- Dumping data for table `a`\n"
+            b"INSERT INTO `a` VALUES (1),(2);\n")
+        with raises(Exception) as e:
+            sqlsplit.get_table_ranges(indexer.index(), "b")
+        assert "is not in the backup" in str(e.value)
+
+    def test_postgres_table_ranges(self):
+        indexer = sqlsplit.SectionIndexer(sqlsplit.PostgresDialect())
+        indexer.feed(POSTGRES_DUMP)
+        ranges = sqlsplit.get_table_ranges(indexer.index(), "t")
+        content = b"".join(POSTGRES_DUMP[start:end] for start, end in ranges)
+        assert b"CREATE TABLE public.t" in content
+        assert b"1\tfirst\n" in content
+        assert b"PRIMARY KEY" in content
+        assert b"CREATE SEQUENCE" not in content
+        assert b"public.u" not in content
+        assert ranges == sqlsplit.get_table_ranges(indexer.index(),
+                                                   "public.t")
+
+    def test_postgres_serial_table_ranges(self):
+        indexer = sqlsplit.SectionIndexer(sqlsplit.PostgresDialect())
+        for offset in range(0, len(SERIAL_DUMP), 7):
+            indexer.feed(SERIAL_DUMP[offset:offset + 7])
+        index = indexer.index()
+        ranges = sqlsplit.get_table_ranges(index, "users")
+        content = b"".join(SERIAL_DUMP[start:end] for start, end in ranges)
+        # The sequence of the serial column, its default and its value
+        assert b"CREATE SEQUENCE public.users_id_seq" in content
+        assert b"OWNED BY public.users.id;\n" in content
+        assert b"SET DEFAULT nextval('public.users_id_seq'" in content
+        assert b"setval('public.users_id_seq', 1, true)" in content
+        assert b"PRIMARY KEY" in content
+        assert b"Items" not in content
+        assert b"other_seq" not in content
+
+        ranges = sqlsplit.get_table_ranges(index, "public.Items")
+        content = b"".join(SERIAL_DUMP[start:end] for start, end in ranges)
+        # The sequence of the identity column
+        assert b"ADD GENERATED ALWAYS AS IDENTITY" in content
+        assert b"setval('public.\"Items_id_seq\"', 1, true)" in content
+        assert b"users" not in content
+
+        # The sequences owned by no table are not part of any
+        assert "public.other_seq" not in {
+            entry.table for entry in index.sections
+        }
+
+    def test_split_postgres_serial_dump(self):
+        with TemporaryDirectory() as tmpdir:
+            schema, data, post_data = sqlsplit.split_dump(
+                io.BytesIO(SERIAL_DUMP), sqlsplit.PostgresDialect(), tmpdir)
+            # The sequence values are loaded with the data of their table
+            assert [s.name for s in data] == ["public.Items", "public.users",
+                                              ""]
+            assert read(data[1]).endswith(
+                b"SELECT pg_catalog.setval('public.users_id_seq', 1, "
+                b"true);\n")
+            assert read(data[2]).endswith(
+                b"SELECT pg_catalog.setval('public.other_seq', 5, true);\n")
+
+    def test_range_reader(self):
+        data = bytes(range(100))
+        ranges = [(0, 10), (50, 60), (90, 100)]
+        expected = data[0:10] + data[50:60] + data[90:100]
+        reader = sqlsplit.RangeReader(io.BytesIO(data), ranges)
+        assert io.BufferedReader(reader, 4).read() == expected
+
+        class Stream(io.RawIOBase):
+            def __init__(self):
+                self.data = io.BytesIO(data)
+
+            def readinto(self, b):
+                return self.data.readinto(b)
+
+        reader = sqlsplit.RangeReader(Stream(), ranges)
+        assert reader.read() == expected
+        with raises(Exception) as e:
+            sqlsplit.RangeReader(io.BytesIO(data), [(90, 110)]).read()
+        assert "The dump ends at 100" in str(e.value)
@@ -0,0 +1,152 @@
+import os
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pytest import raises
+
+from dbbackup import storage, streaming
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+
+def s3_test(test):
+    """
+    Run test against an S3 bucket emulated by moto, as test(self, client).
+    """
+    def run(self):
+        with mock_aws():
+            client = storage.boto3.client("s3", region_name="us-east-1")
+            client.create_bucket(Bucket="backups")
+            test(self, client)
+
+    run.__name__ = test.__name__
+    return unittest.skipIf(not (storage.boto3 and mock_aws),
+                           "requires boto3 and moto")(run)
+
+
+class TestStorage(unittest.TestCase):
+    def test_local_storage(self):
+        with TemporaryDirectory() as tmpdir:
+            (Path(tmpdir) / "a.sql").write_bytes(b"select 1;")
+            (Path(tmpdir) / "b.dir").mkdir()
+            (Path(tmpdir) / "b.dir" / "toc.dat").write_bytes(b"toc")
+            (Path(tmpdir) / "other").write_bytes(b"")
+            local = storage.LocalStorage(tmpdir)
+            stored = sorted(
+                local.list(lambda name: name != "other"),
+                key=lambda stored: stored.name)
+            assert [(s.name, s.size) for s in stored] == [("a.sql", 9),
+                                                          ("b.dir", 3)]
+            with local.open_reader("a.sql") as f:
+                assert f.read() == b"select 1;"
+            local.delete("a.sql")
+            local.delete("b.dir")
+            assert os.listdir(tmpdir) == ["other"]
+            assert not local.exists("a.sql")
+            with raises(FileNotFoundError):
+                local.get_size("a.sql")
+
+    def test_part_size(self):
+        with raises(Exception) as e:
+            storage.S3Storage("backups", part_size=1024, client=object())
+        assert "S3 parts must be at least 5.0MiB" in str(e.value)
+
+    @s3_test
+    def test_s3_upload(self, client):
+        s3 = storage.S3Storage(
+            "backups",
+            prefix="/daily/",
+            part_size=storage.MIN_PART_SIZE,
+            upload_workers=2,
+            client=client)
+        assert str(s3) == "s3://backups/daily/"
+        data = os.urandom(storage.MIN_PART_SIZE * 3 + 1000)
+        writer = s3.open_writer("big.sql")
+        for offset in range(0, len(data), 1000000):
+            writer.write(data[offset:offset + 1000000])
+        # Nothing is visible before the upload is complete
+        assert not s3.exists("big.sql")
+        writer.close()
+        assert len(writer._parts) == 4
+        with s3.open_writer("small.sql") as writer:
+            writer.write(b"select 1;")
+        client.put_object(Bucket="backups", Key="daily/nested/x.sql", Body=b"")
+        client.put_object(Bucket="backups", Key="other.sql", Body=b"")
+
+        stored = sorted(s3.list(), key=lambda stored: stored.name)
+        assert [(s.name, s.size) for s in stored] == [("big.sql", len(data)),
+                                                      ("small.sql", 9)]
+        assert s3.list(lambda name: name.startswith("s"))[0].name == (
+            "small.sql")
+        with s3.open_reader("big.sql") as f:
+            assert f.read() == data
+        assert s3.get_size("small.sql") == 9
+        s3.delete("big.sql")
+        assert not s3.exists("big.sql")
+        with raises(FileNotFoundError):
+            s3.open_reader("big.sql")
+
+    @s3_test
+    def test_s3_discard(self, client):
+        s3 = storage.S3Storage(
+            "backups", part_size=storage.MIN_PART_SIZE, client=client)
+        writer = s3.open_writer("big.sql")
+        writer.write(os.urandom(storage.MIN_PART_SIZE + 1))
+        writer.discard()
+        assert not s3.exists("big.sql")
+        assert "Uploads" not in client.list_multipart_uploads(Bucket="backups")
+
+    @s3_test
+    def test_s3_upload_error(self, client):
+        s3 = storage.S3Storage(
+            "missing", part_size=storage.MIN_PART_SIZE, client=client)
+        writer = s3.open_writer("big.sql")
+        with raises(storage.ClientError):
+            writer.write(os.urandom(storage.MIN_PART_SIZE * 2))
+        writer.discard()
+        assert writer.closed
+
+    @s3_test
+    def test_s3_ranged_download(self, client):
+        s3 = storage.S3Storage("backups",
+                               part_size=storage.MIN_PART_SIZE,
+                               download_workers=2,
+                               client=client)
+        data = os.urandom(storage.MIN_PART_SIZE * 5 + 1000)
+        client.put_object(Bucket="backups", Key="big.sql", Body=data)
+        stage = streaming.Stage("download", workers=2)
+        with s3.open_reader("big.sql", stage) as f:
+            assert isinstance(f, storage.RangedObjectReader)
+            # The parts downloaded ahead are bounded
+            assert len(f._parts) == 4
+            assert f.read(10) == data[:10]
+            assert len(f._parts) == 4
+            assert f.read() == data[10:]
+        assert stage.size == len(data)
+        assert stage.seconds > 0
+
+        # Small objects are downloaded by a single GET
+        client.put_object(Bucket="backups", Key="small.sql", Body=b"select 1;")
+        with s3.open_reader("small.sql") as f:
+            assert isinstance(f, storage.ObjectReader)
+            assert f.read() == b"select 1;"
+
+    @s3_test
+    def test_s3_ranged_download_changed(self, client):
+        s3 = storage.S3Storage("backups",
+                               part_size=storage.MIN_PART_SIZE,
+                               download_workers=2,
+                               client=client)
+        size = storage.MIN_PART_SIZE * 6
+        client.put_object(Bucket="backups", Key="big.sql", Body=bytes(size))
+        with s3.open_reader("big.sql") as f:
+            f.read(storage.MIN_PART_SIZE)
+            client.put_object(Bucket="backups", Key="big.sql",
+                              Body=b"1" * size)
+            # The parts requested once the object changed fail
+            with raises(storage.ClientError):
+                f.read()
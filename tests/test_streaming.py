@@ -0,0 +1,191 @@
+import gzip
+import io
+import subprocess
+import sys
+import threading
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory, TemporaryFile
+
+from pytest import raises
+
+from dbbackup import streaming
+
+
+class TestStreaming(unittest.TestCase):
+    def test_run_to_regular_file(self):
+        with TemporaryFile() as output:
+            streaming.run_to_file(
+                [sys.executable, "-c", "print('hello')"], output)
+            output.seek(0)
+            assert output.read() == b"hello\n"
+
+    def test_run_to_file_object(self):
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as output:
+            streaming.run_to_file(
+                [sys.executable, "-c", "print('hello')"], output)
+        assert gzip.decompress(buf.getvalue()) == b"hello\n"
+
+    def test_run_to_file_object_failure(self):
+        with raises(subprocess.CalledProcessError) as e:
+            streaming.run_to_file(
+                [sys.executable, "-c", "import sys; sys.exit(2)"],
+                io.BytesIO())
+        assert e.value.returncode == 2
+
+    def test_run_from_regular_file(self):
+        with TemporaryFile() as input:
+            input.write(b"hello")
+            input.seek(0)
+            completed = streaming.run_from_file(
+                [sys.executable, "-c", COUNT_STDIN], input)
+        assert completed.stdout == b"5"
+
+    def test_run_from_file_object(self):
+        data = b"hello\n" * 1024 * 1024
+        with gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(data))) as input:
+            completed = streaming.run_from_file(
+                [sys.executable, "-c", COUNT_STDIN], input)
+        assert completed.stdout == str(len(data)).encode()
+
+    def test_run_from_file_object_failure(self):
+        # The process exits without reading its input
+        with raises(subprocess.CalledProcessError) as e:
+            streaming.run_from_file([
+                sys.executable, "-c",
+                "import sys; sys.stderr.write('boom'); sys.exit(2)"
+            ], io.BytesIO(b"x" * 1024 * 1024))
+        assert e.value.returncode == 2
+        assert e.value.stderr == b"boom"
+
+    def test_run_from_corrupted_file_object(self):
+        with raises(OSError):
+            with gzip.GzipFile(fileobj=io.BytesIO(b"not gzip")) as input:
+                streaming.run_from_file(
+                    [sys.executable, "-c", COUNT_STDIN], input)
+
+    def test_run_from_truncated_file_object(self):
+        class Truncated(io.RawIOBase):
+            def __init__(self):
+                self.chunks = [b"insert 1;\n" * 1000]
+
+            def readable(self):
+                return True
+
+            def readinto(self, b):
+                if not self.chunks:
+                    raise OSError("read error")
+                chunk = self.chunks.pop()
+                b[:len(chunk)] = chunk
+                return len(chunk)
+
+        with TemporaryDirectory() as tmpdir:
+            applied = Path(tmpdir) / "applied"
+            # The process only applies its input once it has all of it
+            with raises(OSError) as e:
+                streaming.run_from_file([
+                    sys.executable, "-c",
+                    "import sys; sys.stdin.buffer.read(); "
+                    f"open({str(applied)!r}, 'w').close()"
+                ], Truncated())
+            assert str(e.value) == "read error"
+            assert not applied.exists()
+
+    def test_read_ahead_pipeline(self):
+        data = b"hello\n" * 1024 * 1024
+        download = streaming.Stage("download")
+        decompress = streaming.Stage("decompress")
+        restore = streaming.Stage("restore")
+        downloaded = streaming.MeteredReader(
+            io.BytesIO(gzip.compress(data)), download)
+        with gzip.GzipFile(fileobj=downloaded) as decompressed, \
+                streaming.ReadAheadReader(
+                    streaming.MeteredReader(decompressed, decompress,
+                                            upstream=downloaded),
+                    depth=2) as reader:
+            completed = streaming.run_from_file(
+                [sys.executable, "-c", COUNT_STDIN],
+                streaming.MeteredReader(reader, consumer=restore))
+        assert completed.stdout == str(len(data)).encode()
+        assert download.size == len(gzip.compress(data))
+        assert decompress.size == restore.size == len(data)
+        report = streaming.format_stages([download, decompress, restore], 1)
+        assert report.startswith("download ")
+        assert report.count("<- bottleneck") == 1
+
+    def test_read_ahead_error(self):
+        with streaming.ReadAheadReader(
+                gzip.GzipFile(fileobj=io.BytesIO(b"not gzip"))) as reader:
+            with raises(OSError):
+                reader.read()
+            assert reader.read() == b""
+
+    def test_format_stages(self):
+        download = streaming.Stage("download", workers=4)
+        download.add(8 * 1024 * 1024, 8)
+        restore = streaming.Stage("restore")
+        restore.add(32 * 1024 * 1024, 3)
+        assert streaming.format_stages([download, restore], 4) == (
+            "download 8.0MiB at 4.0MiB/s (busy 50%), "
+            "restore 32.0MiB at 10.7MiB/s (busy 75%) <- bottleneck")
+
+    def test_tee(self):
+        sinks = [io.BytesIO(), io.BytesIO()]
+        tee = streaming.Tee(sinks, chunk_size=4, chunks=2)
+        tee.write(b"hello ")
+        tee.write(bytearray(b"world, "))
+        tee.write_from(io.BytesIO(b"once"))
+        tee.close()
+        assert [sink.getvalue()
+                for sink in sinks] == [b"hello world, once"] * 2
+
+    def test_tee_backpressure(self):
+        release = threading.Event()
+
+        class SlowSink(io.BytesIO):
+            def write(self, b):
+                release.wait()
+                return super().write(b)
+
+        tee = streaming.Tee([io.BytesIO(), SlowSink()], chunks=2)
+        writer = threading.Thread(
+            target=lambda: [tee.write(b"x") for _ in range(3)])
+        writer.start()
+        writer.join(0.2)
+        # The third write waits for the slow sink
+        assert writer.is_alive()
+        release.set()
+        writer.join()
+        tee.close()
+        assert tee.sinks[1].getvalue() == b"xxx"
+
+    def test_tee_failing_sink(self):
+        class FailingSink(io.BytesIO):
+            def write(self, b):
+                raise OSError("disk full")
+
+        sink, failing = io.BytesIO(), FailingSink()
+        tee = streaming.Tee([sink, failing], required=[sink])
+        tee.write(b"hello")
+        tee.flush()
+        tee.write(b" world")
+        tee.close()
+        # The other sinks are written anyway
+        assert sink.getvalue() == b"hello world"
+        assert str(tee.errors[failing]) == "disk full"
+
+        tee = streaming.Tee([io.BytesIO(), FailingSink()])
+        tee.write(b"hello")
+        with raises(OSError):
+            tee.close()
+
+    def test_run_to_tee(self):
+        sinks = [io.BytesIO(), io.BytesIO()]
+        with streaming.Tee(sinks) as tee:
+            streaming.run_to_file(
+                [sys.executable, "-c", "print('hello')"], tee)
+        assert [sink.getvalue() for sink in sinks] == [b"hello\n"] * 2
+
+
+COUNT_STDIN = "import sys; sys.stdout.write(str(len(sys.stdin.buffer.read())))"
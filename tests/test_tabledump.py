@@ -0,0 +1,78 @@
+import io
+import unittest
+from unittest import mock
+from tempfile import TemporaryDirectory
+
+from pytest import raises
+
+from dbbackup import compression, tabledump
+
+
+class FakeTableFile(io.BytesIO):
+    def __init__(self, files, name):
+        super().__init__()
+        self.files = files
+        self.name = name
+        self.discarded = False
+
+    def close(self):
+        self.files[self.name] = self.getvalue()
+        super().close()
+
+    def discard(self):
+        self.discarded = True
+
+
+DUMP = (b"-- MySQL dump\n"
+        b"SET @@GLOBAL.GTID_PURGED=/*!80000 '+'*/ 'a:1-2,\n"
+        b"b:1-3';\n"
+        b"/*!40101 SET NAMES utf8 */;\n"
+        b"--\n"
+        b"-- Table structure for table `a`\n"
+        b"CREATE TABLE `a` (id int);\n"
+        b"-- Table structure for table `b``c`\n"
+        b"CREATE TABLE `b``c` (id int);\n")
+
+
+class TestTableDump(unittest.TestCase):
+    def test_split_dump(self):
+        files = {}
+        started = []
+        names = tabledump.split_dump(
+            io.BytesIO(DUMP), lambda name: FakeTableFile(files, name),
+            lambda: started.append(True))
+        assert names == ["a", "b`c"]
+        assert started == [True]
+        header = b"-- MySQL dump\n/*!40101 SET NAMES utf8 */;\n--\n"
+        assert files["a"] == (header + b"-- Table structure for table `a`\n"
+                              b"CREATE TABLE `a` (id int);\n")
+        assert files["b`c"].startswith(header)
+        assert files["b`c"].endswith(b"CREATE TABLE `b``c` (id int);\n")
+
+    def test_split_dump_error(self):
+        files = {}
+        opened = []
+
+        def open_table(name):
+            opened.append(FakeTableFile(files, name))
+            if len(opened) == 2:
+                opened[-1].write = mock.Mock(
+                    side_effect=OSError("No space left on device"))
+            return opened[-1]
+
+        with raises(OSError):
+            tabledump.split_dump(io.BytesIO(DUMP), open_table)
+        assert list(files) == ["a"]
+        assert not opened[0].discarded
+        assert opened[1].discarded
+
+    def test_manifest(self):
+        files = [
+            tabledump.TableFile("table", "000000.sql.gz", "sha256:abc",
+                                "a\tb"),
+            tabledump.TableFile("views", "views.sql.gz", None, ""),
+        ]
+        with TemporaryDirectory() as tmpdir:
+            tabledump.write_manifest(tmpdir, compression.get_codec("gzip"),
+                                     files)
+            assert tabledump.read_manifest(tmpdir) == ("gzip", files)
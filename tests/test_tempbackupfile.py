@@ -1,8 +1,15 @@
+import gzip
+import hashlib
+import io
+import os
+import sys
 import unittest
 from pathlib import Path
+from pytest import raises
 from tempfile import TemporaryDirectory
 
-from dbbackup import tempbackupfile
+from dbbackup import (compression, encryption, storage, streaming,
+                      tempbackupfile)
 
 
 class TestTempbackupfile(unittest.TestCase):
@@ -165,3 +172,161 @@ class TestTempbackupfile(unittest.TestCase):
             b = bytearray(10)
             bytes_read = tempfile.readinto(b)
             assert bytes_read == 10
+
+    def test_partial_file_in_destination(self):
+        with TemporaryDirectory() as tmpdir:
+            tempfile = tempbackupfile.TemporaryBackupFile("tmpname", tmpdir)
+            tempfile.write(b"This is my file")
+            assert (Path(tmpdir) / "tmpname.partial").exists()
+            assert not (Path(tmpdir) / "tmpname").exists()
+            tempfile.close()
+            assert not (Path(tmpdir) / "tmpname.partial").exists()
+            assert (Path(tmpdir) /
+                    "tmpname").read_bytes() == b"This is my file"
+
+    def test_temp_directory(self):
+        with TemporaryDirectory() as tmpdir, TemporaryDirectory() as tempdir:
+            tempfile = tempbackupfile.TemporaryBackupFile(
+                "tmpname", tmpdir, temp_directory=tempdir)
+            tempfile.write(b"This is my file")
+            assert tempfile.name.startswith(tempdir)
+            tempfile.close()
+            assert os.listdir(tempdir) == []
+            assert (Path(tmpdir) /
+                    "tmpname").read_bytes() == b"This is my file"
+
+    def test_context_manager_exception_discards(self):
+        with TemporaryDirectory() as tmpdir:
+            with raises(Exception):
+                with tempbackupfile.TemporaryBackupFile("tmpname",
+                                                        tmpdir) as tempfile:
+                    tempfile.write(b'Hello\n my friend')
+                    raise Exception("dump failed")
+            assert os.listdir(tmpdir) == []
+
+    def test_compress_single_gzip_stream(self):
+        with TemporaryDirectory() as tmpdir:
+            with tempbackupfile.TemporaryBackupFile(
+                    "tmpname", tmpdir, compress=True) as tempfile:
+                tempfile.write(b"This is my file")
+            final_file = Path(tmpdir) / "tmpname.gz"
+            assert os.listdir(tmpdir) == ["tmpname.gz"]
+            with gzip.open(final_file) as f:
+                assert f.read() == b"This is my file"
+
+    def test_compress_seekable(self):
+        with TemporaryDirectory() as tmpdir:
+            with tempbackupfile.TemporaryBackupFile(
+                    "tmpname", tmpdir, compress=True,
+                    compress_seekable=True) as tempfile:
+                tempfile.write(b"This is my file")
+            final_file = Path(tmpdir) / "tmpname.gz"
+            with gzip.open(final_file) as f:
+                assert f.read() == b"This is my file"
+            with compression.open_decompressed(final_file) as f:
+                assert f.seekable()
+                assert f.read() == b"This is my file"
+
+    def test_checksum(self):
+        with TemporaryDirectory() as tmpdir:
+            backup_file = tempbackupfile.TemporaryBackupFile(
+                "tmpname", tmpdir, compress="gzip", checksum="sha256")
+            with backup_file as tempfile:
+                tempfile.write(b"This is my file")
+            final_file = Path(tmpdir) / "tmpname.gz"
+            # The checksum is the one of the compressed file
+            assert backup_file.checksum == "sha256:" + hashlib.sha256(
+                final_file.read_bytes()).hexdigest()
+
+    def test_checksum_direct(self):
+        # The process writes to the file itself, and can seek in it
+        command = [
+            sys.executable, "-c",
+            "import sys; sys.stdout.buffer.write(b'xxxx'); "
+            "sys.stdout.flush(); sys.stdout.buffer.seek(0); "
+            "sys.stdout.buffer.write(b'ab')"
+        ]
+        with TemporaryDirectory() as tmpdir:
+            backup_file = tempbackupfile.TemporaryBackupFile(
+                "tmpname", tmpdir, checksum="sha256", direct=True)
+            with backup_file as tempfile:
+                assert isinstance(tempfile, io.BufferedRandom)
+                streaming.run_to_file(command, tempfile)
+            assert (Path(tmpdir) / "tmpname").read_bytes() == b"abxx"
+            assert backup_file.checksum == "sha256:" + hashlib.sha256(
+                b"abxx").hexdigest()
+
+            # Compressed files are hashed as they are written
+            backup_file = tempbackupfile.TemporaryBackupFile(
+                "tmpname", tmpdir, compress="gzip", checksum="sha256",
+                direct=True)
+            with backup_file as tempfile:
+                assert not isinstance(tempfile, io.BufferedRandom)
+                tempfile.write(b"This is my file")
+            assert backup_file.checksum == "sha256:" + hashlib.sha256(
+                (Path(tmpdir) / "tmpname.gz").read_bytes()).hexdigest()
+
+    def test_no_checksum(self):
+        with TemporaryDirectory() as tmpdir:
+            backup_file = tempbackupfile.TemporaryBackupFile("tmpname", tmpdir)
+            with backup_file as tempfile:
+                tempfile.write(b"This is my file")
+            assert backup_file.checksum is None
+
+    def test_copies(self):
+        with TemporaryDirectory() as tmpdir, \
+                TemporaryDirectory() as copy_dir:
+            copy = storage.LocalStorage(copy_dir)
+            missing = storage.LocalStorage(str(Path(copy_dir) / "missing"))
+            backup_file = tempbackupfile.TemporaryBackupFile(
+                "tmpname",
+                tmpdir,
+                compress="gzip",
+                checksum="sha256",
+                copies=[copy, missing])
+            with backup_file as tempfile:
+                tempfile.write(b"This is my file")
+            final_file = Path(tmpdir) / "tmpname.gz"
+            # The copies are identical, a failing copy does not fail the
+            # backup
+            assert (Path(copy_dir) / "tmpname.gz").read_bytes() == (
+                final_file.read_bytes())
+            assert backup_file.checksum == "sha256:" + hashlib.sha256(
+                final_file.read_bytes()).hexdigest()
+            assert os.listdir(copy_dir) == ["tmpname.gz"]
+            assert backup_file.copy_errors[copy] is None
+            assert isinstance(backup_file.copy_errors[missing],
+                              FileNotFoundError)
+
+    def test_copies_discarded(self):
+        with TemporaryDirectory() as tmpdir, \
+                TemporaryDirectory() as copy_dir:
+            with raises(Exception):
+                with tempbackupfile.TemporaryBackupFile(
+                        "tmpname",
+                        tmpdir,
+                        copies=[storage.LocalStorage(copy_dir)]) as tempfile:
+                    tempfile.write(b'Hello\n my friend')
+                    raise Exception("dump failed")
+            assert os.listdir(tmpdir) == []
+            assert os.listdir(copy_dir) == []
+
+    @unittest.skipIf(not encryption.AESGCM, "requires cryptography")
+    def test_encryption(self):
+        key = encryption.Encryption(bytes(32))
+        with TemporaryDirectory() as tmpdir:
+            backup_file = tempbackupfile.TemporaryBackupFile(
+                "tmpname",
+                tmpdir,
+                compress="gzip",
+                checksum="sha256",
+                encryption=key)
+            with backup_file as tempfile:
+                tempfile.write(b"This is my file")
+            final_file = Path(tmpdir) / "tmpname.gz.enc"
+            assert os.listdir(tmpdir) == ["tmpname.gz.enc"]
+            # The checksum is the one of the encrypted file
+            assert backup_file.checksum == "sha256:" + hashlib.sha256(
+                final_file.read_bytes()).hexdigest()
+            with open(final_file, "rb") as f, key.open_reader(f) as reader:
+                assert gzip.decompress(reader.read()) == b"This is my file"
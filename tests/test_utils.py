@@ -0,0 +1,95 @@
+import errno
+import os
+import unittest
+from unittest import mock
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from dbbackup import utils
+
+
+class TestUtils(unittest.TestCase):
+    def test_move_file(self):
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir) / "source"
+            source.write_bytes(b"backup content")
+            destination = Path(tmpdir) / "destination"
+            utils.move_file(str(source), str(destination))
+            assert not source.exists()
+            assert destination.read_bytes() == b"backup content"
+
+    def test_link_file(self):
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir) / "source"
+            source.write_bytes(b"backup content")
+            os.utime(source, (0, 0))
+            destination = Path(tmpdir) / "destination"
+            utils.link_file(source, destination)
+            assert os.path.samefile(source, destination)
+            # The previous backup does not look newer
+            assert source.stat().st_mtime == 0
+
+    def test_link_file_not_supported(self):
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir) / "source"
+            source.write_bytes(b"backup content")
+            destination = Path(tmpdir) / "destination"
+            with mock.patch('os.link') as link:
+                link.side_effect = OSError(errno.EPERM, "Not permitted")
+                utils.link_file(source, destination)
+            assert not os.path.samefile(source, destination)
+            assert destination.read_bytes() == b"backup content"
+            assert sorted(os.listdir(tmpdir)) == ["destination", "source"]
+
+    def test_replace_with_link(self):
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir) / "source"
+            source.write_bytes(b"backup content")
+            destination = Path(tmpdir) / "destination"
+            destination.write_bytes(b"backup content")
+            os.utime(source, (0, 0))
+            assert utils.replace_with_link(source, destination)
+            assert os.path.samefile(source, destination)
+            # The previous backup does not look newer
+            assert source.stat().st_mtime == 0
+            with mock.patch('os.link') as link, \
+                    mock.patch('dbbackup.utils.fcntl', None):
+                link.side_effect = OSError(errno.EPERM, "Not permitted")
+                destination.unlink()
+                destination.write_bytes(b"backup content")
+                assert not utils.replace_with_link(source, destination)
+            assert not os.path.samefile(source, destination)
+            assert sorted(os.listdir(tmpdir)) == ["destination", "source"]
+
+    def test_move_file_cross_device(self):
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir) / "source"
+            source.write_bytes(b"backup content" * 1024)
+            destination = Path(tmpdir) / "destination"
+            replace = os.replace
+
+            def fake_replace(src, dst):
+                if src == str(source):
+                    raise OSError(errno.EXDEV, "Invalid cross-device link")
+                return replace(src, dst)
+
+            with mock.patch('dbbackup.utils.os.replace', fake_replace):
+                utils.move_file(str(source), str(destination))
+            assert not source.exists()
+            assert destination.read_bytes() == b"backup content" * 1024
+            assert os.listdir(tmpdir) == ["destination"]
+
+    def test_copy_file_fallback(self):
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir) / "source"
+            source.write_bytes(b"backup content")
+            destination = Path(tmpdir) / "destination"
+            with mock.patch('dbbackup.utils._copy_file_range') as cfr, \
+                    mock.patch('dbbackup.utils._sendfile') as sf:
+                cfr.side_effect = OSError(errno.ENOSYS, "Not supported")
+                sf.side_effect = OSError(errno.EINVAL, "Invalid argument")
+                cfr.__name__ = "_copy_file_range"
+                sf.__name__ = "_sendfile"
+                with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                    utils.copy_file(src, dst)
+            assert destination.read_bytes() == b"backup content"
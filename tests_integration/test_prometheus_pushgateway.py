@@ -3,42 +3,67 @@ from datetime import datetime
 import requests
 from dbbackup import config
 from dbbackup.callbacks.prometheus import PrometheusPushGatewayCallback
+from dbbackup.providers import BackupResult
+
+GROUP = 'database="test",instance="myhostname",job="dbbackup"'
 
 
 class TestPrometheusPushgateway:
+    def backup(self, pushgateway, size):
+        pushgateway.backup_done(datetime.now().isoformat(), "test", "test.sql",
+                                size)
+        pushgateway.backups_done(
+            [BackupResult("test", "test.sql", size, 1, None)])
+        pushgateway.wait()
+
+    def get_metrics(self):
+        response = requests.get(f"{config.PROMETHEUS_PUSHGATEWAY_URL}/metrics")
+        assert response.status_code == 200
+        return response.text
+
     @mock.patch(
         'dbbackup.callbacks.prometheus.PrometheusPushGatewayCallback.get_hostname'
     )
-    def test_backup_done(self, mock_get_hostname):
+    def test_backups_done(self, mock_get_hostname):
         mock_get_hostname.return_value = "myhostname"
         pushgateway = PrometheusPushGatewayCallback(
             config.PROMETHEUS_PUSHGATEWAY_URL)
-        pushgateway.backup_done(datetime.now().isoformat(), "test", "test.sql",
-                                "1024")
-        response = requests.get(f"{config.PROMETHEUS_PUSHGATEWAY_URL}/metrics")
-        assert response.status_code == 200
-        metrics = response.text
-        assert 'dbbackup_last_backup_file_size{instance="",job="myhostname-test"} 1024' in metrics
-        assert 'dbbackup_last_success_timestamp{instance="",job="myhostname-test"}' in metrics
+        self.backup(pushgateway, 1024)
+        metrics = self.get_metrics()
+        assert f'dbbackup_last_backup_file_size{{{GROUP}}} 1024' in metrics
+        assert f'dbbackup_last_success_timestamp{{{GROUP}}}' in metrics
+        assert f'dbbackup_last_backup_success{{{GROUP}}} 1' in metrics
 
     @mock.patch(
         'dbbackup.callbacks.prometheus.PrometheusPushGatewayCallback.get_hostname'
     )
-    def test_backup_done_metric_replaced(self, mock_get_hostname):
+    def test_backups_done_metric_replaced(self, mock_get_hostname):
         """
         Ensure that the metrics pushed to the gateway are replacing old values
-        for the same grouping key (which is represented by the job, 
-        which is a concatenation of the hostname and the database).
+        for the same grouping key (the job, the hostname and the database).
         """
         mock_get_hostname.return_value = "myhostname"
         pushgateway = PrometheusPushGatewayCallback(
             config.PROMETHEUS_PUSHGATEWAY_URL)
-        pushgateway.backup_done(datetime.now().isoformat(), "test", "test.sql",
-                                "1024")
-        pushgateway.backup_done(datetime.now().isoformat(), "test", "test.sql",
-                                "2048")
-        response = requests.get(f"{config.PROMETHEUS_PUSHGATEWAY_URL}/metrics")
-        assert response.status_code == 200
-        metrics = response.text
-        assert 'dbbackup_last_backup_file_size{instance="",job="myhostname-test"} 2048' in metrics
-        assert 'dbbackup_last_backup_file_size{instance="",job="myhostname-test"} 1024' not in metrics
+        self.backup(pushgateway, 1024)
+        self.backup(pushgateway, 2048)
+        metrics = self.get_metrics()
+        assert f'dbbackup_last_backup_file_size{{{GROUP}}} 2048' in metrics
+        assert f'dbbackup_last_backup_file_size{{{GROUP}}} 1024' \
+            not in metrics
+
+    @mock.patch(
+        'dbbackup.callbacks.prometheus.PrometheusPushGatewayCallback.get_hostname'
+    )
+    def test_backups_done_failure_keeps_last_success(self, mock_get_hostname):
+        mock_get_hostname.return_value = "myhostname"
+        pushgateway = PrometheusPushGatewayCallback(
+            config.PROMETHEUS_PUSHGATEWAY_URL)
+        self.backup(pushgateway, 1024)
+        pushgateway.backups_done(
+            [BackupResult("test", None, None, None, Exception("failed"))])
+        pushgateway.wait()
+        metrics = self.get_metrics()
+        assert f'dbbackup_last_backup_success{{{GROUP}}} 0' in metrics
+        assert f'dbbackup_last_backup_file_size{{{GROUP}}} 1024' in metrics
+        assert f'dbbackup_last_success_timestamp{{{GROUP}}}' in metrics